@@ -22,28 +22,48 @@
  * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
  */
 
+#include <getopt.h>
 #include <signal.h>
-#include <verilated_vcd_c.h>
+#include <sys/resource.h>
+#include <verilated_fst_c.h>
+#ifdef CORUNDUM_SAVABLE
+#include <verilated_save.h>
+#endif
 
 #include <algorithm>
+#include <chrono>
+#include <cstdio>
+#include <cstring>
 #include <iostream>
 #include <memory>
+#include <string>
+#include <unordered_map>
+#include <vector>
 
 #include <simbricks/axi/axi_s.hpp>
 #include <simbricks/axi/axi_subordinate.hh>
 #include <simbricks/axi/axil_manager.hh>
 
-#include "/corundum_src/corundum/obj_dir/Vmqnic_core_axi.h"
+// resolved from the verilator output directory the adapter is built in, i.e.
+// either the single- or the multi-threaded model
+#include "Vmqnic_core_axi.h"
 
 extern "C"
 {
+#include <simbricks/base/if.h>
+#include <simbricks/network/if.h>
 #include <simbricks/nicif/nicif.h>
 #include <simbricks/parser/parser.h>
+#include <simbricks/pcie/if.h>
 }
 
 // #define CORUNDUM_VERILATOR_DEBUG 1
-// #define CORUNDUM_VERILATOR_TRACE 1
-#define CORUNDUM_VERILATOR_TRACE_LEVEL 40
+
+// maximum number of concurrently pending DMA reads and writes each, set with
+// `make DMA_MAX_PENDING=<n>`
+#ifndef CORUNDUM_DMA_MAX_PENDING
+#define CORUNDUM_DMA_MAX_PENDING 16
+#endif
 
 /* **************************************************************************
  * signal handling
@@ -51,15 +71,277 @@ extern "C"
 
 static uint64_t main_time = 0;
 static volatile int exiting = 0;
+static volatile sig_atomic_t stats_requested = 0;
+static volatile sig_atomic_t checkpoint_requested = 0;
 static void sigint_handler(int dummy)
 {
   exiting = 1;
 }
 static void sigusr1_handler(int dummy)
 {
-  sim_log::LogError("main_time = %lu\n", main_time);
+  // handled in the main loop, logging here is not async-signal-safe
+  stats_requested = 1;
+}
+static void sigusr2_handler(int dummy)
+{
+  checkpoint_requested = 1;
+}
+
+/* **************************************************************************
+ * statistics
+ * ************************************************************************** */
+
+// DMA sizes are counted in power of two buckets, bucket i holds the requests
+// with a length in [2^i, 2^(i+1)), the last bucket everything larger
+static constexpr unsigned kDmaSizeBuckets = 16;
+
+static unsigned dma_size_bucket(size_t len)
+{
+  unsigned bucket = 0;
+  while (len >>= 1)
+  {
+    bucket++;
+  }
+  return std::min(bucket, kDmaSizeBuckets - 1);
 }
 
+// Counters of one NIC, updated by its handlers below. The adapter is single
+// threaded, so keeping them costs no more than an increment.
+struct NicStats
+{
+  uint64_t rx_packets = 0;
+  uint64_t rx_bytes = 0;
+  uint64_t rx_dropped = 0;
+  uint64_t tx_packets = 0;
+  uint64_t tx_bytes = 0;
+  uint64_t dma_reads = 0;
+  uint64_t dma_read_bytes = 0;
+  uint64_t dma_read_sizes[kDmaSizeBuckets] = {};
+  uint64_t dma_writes = 0;
+  uint64_t dma_write_bytes = 0;
+  uint64_t dma_write_sizes[kDmaSizeBuckets] = {};
+  uint64_t dma_split = 0;
+  uint64_t mmio_reads = 0;
+  uint64_t mmio_writes = 0;
+  uint64_t msis = 0;
+  uint64_t msis_coalesced = 0;
+
+  void add(const NicStats &other)
+  {
+    rx_packets += other.rx_packets;
+    rx_bytes += other.rx_bytes;
+    rx_dropped += other.rx_dropped;
+    tx_packets += other.tx_packets;
+    tx_bytes += other.tx_bytes;
+    dma_reads += other.dma_reads;
+    dma_read_bytes += other.dma_read_bytes;
+    dma_writes += other.dma_writes;
+    dma_write_bytes += other.dma_write_bytes;
+    for (unsigned i = 0; i < kDmaSizeBuckets; i++)
+    {
+      dma_read_sizes[i] += other.dma_read_sizes[i];
+      dma_write_sizes[i] += other.dma_write_sizes[i];
+    }
+    dma_split += other.dma_split;
+    mmio_reads += other.mmio_reads;
+    mmio_writes += other.mmio_writes;
+    msis += other.msis;
+    msis_coalesced += other.msis_coalesced;
+  }
+};
+
+// Counters of the process, all NICs are stepped with the same clock.
+struct AdapterStats
+{
+  uint64_t cycles = 0;
+  uint64_t skipped_cycles = 0;
+};
+static AdapterStats stats;
+
+// Appends a snapshot of the counters as one JSON object per line to a file, on
+// request, periodically in wall-clock time and at exit. The NIC counters of a
+// snapshot are the sums over all NICs, `nics` holds them for each NIC.
+class StatsDumper
+{
+  using Clock = std::chrono::steady_clock;
+
+  FILE *out_ = nullptr;
+  Clock::duration period_{0};
+  Clock::time_point start_;
+  Clock::time_point last_;
+  Clock::time_point next_;
+  double start_cpu_ = 0;
+  uint64_t last_cycles_ = 0;
+  std::string label_;
+  std::vector<const NicStats *> nics_;
+
+  // CPU time of all threads of the process so far
+  static double cpu_time(const struct rusage &usage)
+  {
+    return usage.ru_utime.tv_sec + usage.ru_stime.tv_sec +
+           (usage.ru_utime.tv_usec + usage.ru_stime.tv_usec) / 1e6;
+  }
+
+  // the label comes from the command line and may contain any character
+  static std::string json_escape(const char *str)
+  {
+    std::string escaped;
+    for (const char *c = str; *c; c++)
+    {
+      if (*c == '"' or *c == '\\')
+      {
+        escaped += '\\';
+        escaped += *c;
+      }
+      else if (static_cast<unsigned char>(*c) < 0x20)
+      {
+        char buf[8];
+        snprintf(buf, sizeof(buf), "\\u%04x", *c);
+        escaped += buf;
+      }
+      else
+      {
+        escaped += *c;
+      }
+    }
+    return escaped;
+  }
+
+  static void write_sizes(FILE *out, const char *name, const uint64_t *sizes)
+  {
+    fprintf(out, "\"%s\":[", name);
+    for (unsigned i = 0; i < kDmaSizeBuckets; i++)
+    {
+      fprintf(out, "%s%lu", i ? "," : "", sizes[i]);
+    }
+    fputs("],", out);
+  }
+
+  static void write_nic(FILE *out, const NicStats &nic)
+  {
+    fprintf(out,
+            "\"rx_packets\":%lu,\"rx_bytes\":%lu,\"rx_dropped\":%lu,"
+            "\"tx_packets\":%lu,\"tx_bytes\":%lu,",
+            nic.rx_packets, nic.rx_bytes, nic.rx_dropped, nic.tx_packets,
+            nic.tx_bytes);
+    fprintf(out,
+            "\"dma_reads\":%lu,\"dma_read_bytes\":%lu,\"dma_writes\":%lu,"
+            "\"dma_write_bytes\":%lu,\"dma_split\":%lu,",
+            nic.dma_reads, nic.dma_read_bytes, nic.dma_writes,
+            nic.dma_write_bytes, nic.dma_split);
+    write_sizes(out, "dma_read_sizes", nic.dma_read_sizes);
+    write_sizes(out, "dma_write_sizes", nic.dma_write_sizes);
+    fprintf(out,
+            "\"mmio_reads\":%lu,\"mmio_writes\":%lu,\"msis\":%lu,"
+            "\"msis_coalesced\":%lu",
+            nic.mmio_reads, nic.mmio_writes, nic.msis, nic.msis_coalesced);
+  }
+
+public:
+  ~StatsDumper()
+  {
+    if (out_)
+    {
+      fclose(out_);
+    }
+  }
+
+  // label is copied into every snapshot, e.g. to tell the configurations of
+  // resource calibration runs apart
+  bool open(const char *path, double period_s, const char *label)
+  {
+    out_ = fopen(path, "w");
+    if (not out_)
+    {
+      return false;
+    }
+    period_ = std::chrono::duration_cast<Clock::duration>(
+        std::chrono::duration<double>(period_s));
+    // wall_time and cpu_time both count from here, so that the ratio of the
+    // two excludes loading the model and connecting to the peers
+    struct rusage usage;
+    getrusage(RUSAGE_SELF, &usage);
+    start_cpu_ = cpu_time(usage);
+    start_ = last_ = Clock::now();
+    next_ = start_ + period_;
+    if (label)
+    {
+      label_ = json_escape(label);
+    }
+    return true;
+  }
+
+  // the counters of each NIC, in the order of the NICs
+  void add_nic(const NicStats &nic)
+  {
+    nics_.push_back(&nic);
+  }
+
+  // cheap enough to be called every cycle, only looks at the clock every few
+  // thousand cycles
+  void poll(uint64_t time)
+  {
+    if (not out_ or period_.count() == 0 or (stats.cycles & 0xfff) != 0)
+    {
+      return;
+    }
+    if (Clock::now() >= next_)
+    {
+      dump(time, "periodic");
+      next_ += period_;
+    }
+  }
+
+  void dump(uint64_t time, const char *reason)
+  {
+    if (not out_)
+    {
+      return;
+    }
+    Clock::time_point now = Clock::now();
+    double wall = std::chrono::duration<double>(now - start_).count();
+    double interval = std::chrono::duration<double>(now - last_).count();
+
+    struct rusage usage;
+    getrusage(RUSAGE_SELF, &usage);
+    double cpu = cpu_time(usage) - start_cpu_;
+
+    fprintf(out_, "{\"reason\":\"%s\",\"main_time\":%lu,\"wall_time\":%.3f,",
+            reason, time, wall);
+    if (not label_.empty())
+    {
+      fprintf(out_, "\"label\":\"%s\",", label_.c_str());
+    }
+    // peak resident set size in KiB on Linux, CPU time of all threads since
+    // the stats file was opened
+    fprintf(out_, "\"max_rss_kb\":%ld,\"cpu_time\":%.3f,", usage.ru_maxrss,
+            cpu);
+    fprintf(out_, "\"cycles_per_second\":%.1f,\"cycles_per_second_avg\":%.1f,",
+            interval > 0 ? (stats.cycles - last_cycles_) / interval : 0.0,
+            wall > 0 ? stats.cycles / wall : 0.0);
+    fprintf(out_, "\"cycles\":%lu,\"skipped_cycles\":%lu,", stats.cycles,
+            stats.skipped_cycles);
+    NicStats total;
+    for (const NicStats *nic : nics_)
+    {
+      total.add(*nic);
+    }
+    write_nic(out_, total);
+    fputs(",\"nics\":[", out_);
+    for (size_t i = 0; i < nics_.size(); i++)
+    {
+      fprintf(out_, "%s{\"nic\":%zu,", i ? "," : "", i);
+      write_nic(out_, *nics_[i]);
+      fputs("}", out_);
+    }
+    fputs("]}\n", out_);
+    fflush(out_);
+
+    last_ = now;
+    last_cycles_ = stats.cycles;
+  }
+};
+
 /* **************************************************************************
  * helpers
  * ************************************************************************** */
@@ -162,15 +444,37 @@ static volatile union SimbricksProtoPcieD2H *d2h_alloc(
  * AXI, AXIL and AXIS interface definitions required by this adapter
  * ************************************************************************** */
 
+// DMA requests that do not fit into a single SimBricks message are split into
+// several. The parts use request ids with the top bit set, the remaining bits
+// hold a tag identifying the split request and the index of the part.
+static constexpr uint64_t kDmaSplitFlag = 1ULL << 63;
+static constexpr unsigned kDmaSplitPartBits = 16;
+
+static uint64_t dma_split_req_id(uint64_t tag, uint64_t part)
+{
+  return kDmaSplitFlag | (tag << kDmaSplitPartBits) | part;
+}
+
+static uint64_t dma_split_tag(uint64_t req_id)
+{
+  return (req_id & ~kDmaSplitFlag) >> kDmaSplitPartBits;
+}
+
+static uint64_t dma_split_part(uint64_t req_id)
+{
+  return req_id & ((1ULL << kDmaSplitPartBits) - 1);
+}
+
 // handles DMA read requests
 class CorundumAXISubordinateRead
     : public simbricks::AXISubordinateRead<
           4, 1, 16,
-          /*num concurrently pending requests*/ 16>
+          /*num concurrently pending requests*/ CORUNDUM_DMA_MAX_PENDING>
 {
 public:
   explicit CorundumAXISubordinateRead(struct SimbricksNicIf &nicif,
-                                      Vmqnic_core_axi &top_verilator_interface)
+                                      Vmqnic_core_axi &top_verilator_interface,
+                                      NicStats &stats)
       : AXISubordinateRead(
             reinterpret_cast<uint8_t *>(&top_verilator_interface.m_axi_araddr),
             &top_verilator_interface.m_axi_arid,
@@ -184,12 +488,83 @@ public:
             top_verilator_interface.m_axi_rready,
             top_verilator_interface.m_axi_rvalid,
             top_verilator_interface.m_axi_rlast),
-        nicif_(nicif)
+        nicif_(nicif),
+        stats_(stats)
+  {
+  }
+
+  // number of DMA reads sent to the host that are not completed yet
+  size_t outstanding() const
   {
+    return outstanding_;
+  }
+
+  void complete(uint64_t req_id, const uint8_t *data)
+  {
+    if (not(req_id & kDmaSplitFlag))
+    {
+      outstanding_--;
+      read_done(req_id, data);
+      return;
+    }
+
+    auto it = splits_.find(dma_split_tag(req_id));
+    if (it == splits_.end())
+    {
+      sim_log::LogError(
+          "CorundumAXISubordinateRead::complete() unknown req_id=0x%lx\n",
+          req_id);
+      std::terminate();
+    }
+
+    SplitRead &split = it->second;
+    size_t off = dma_split_part(req_id) * split.part_size;
+    std::memcpy(split.buf.get() + off, data,
+                std::min(split.part_size, split.len - off));
+    if (--split.parts_left != 0)
+    {
+      return;
+    }
+    outstanding_--;
+    read_done(split.axi_id, split.buf.get());
+    splits_.erase(it);
   }
 
 private:
+  // a read that is split across several messages, the completions are
+  // gathered in buf until all parts arrived
+  struct SplitRead
+  {
+    uint64_t axi_id;
+    size_t len;
+    size_t part_size;
+    size_t parts_left;
+    std::unique_ptr<uint8_t[]> buf;
+  };
+
   struct SimbricksNicIf &nicif_;
+  NicStats &stats_;
+  size_t outstanding_ = 0;
+  std::unordered_map<uint64_t, SplitRead> splits_;
+  uint64_t next_split_tag_ = 0;
+
+  void send_read(uint64_t req_id, uint64_t addr, size_t len)
+  {
+    volatile union SimbricksProtoPcieD2H *msg = d2h_alloc(nicif_, main_time);
+    if (not msg)
+    {
+      sim_log::LogError(
+          "CorundumAXISubordinateRead::doRead() dma read alloc failed\n");
+      std::terminate();
+    }
+
+    volatile struct SimbricksProtoPcieD2HRead *read = &msg->read;
+    read->req_id = req_id;
+    read->offset = addr;
+    read->len = len;
+    SimbricksPcieIfD2HOutSend(&nicif_.pcie, msg,
+                              SIMBRICKS_PROTO_PCIE_D2H_MSG_READ);
+  }
 
   void do_read(const simbricks::AXIOperation &axi_op) final
   {
@@ -200,32 +575,30 @@ private:
         main_time, axi_op.id, axi_op.addr, axi_op.len);
 #endif
 
-    volatile union SimbricksProtoPcieD2H *msg = d2h_alloc(nicif_, main_time);
-    if (not msg)
+    outstanding_++;
+    stats_.dma_reads++;
+    stats_.dma_read_bytes += axi_op.len;
+    stats_.dma_read_sizes[dma_size_bucket(axi_op.len)]++;
+    size_t max_size = SimbricksPcieIfH2DOutMsgLen(&nicif_.pcie) -
+                      sizeof(SimbricksProtoPcieH2DReadcomp);
+    if (axi_op.len <= max_size)
     {
-      sim_log::LogError(
-          "CorundumAXISubordinateRead::doRead() dma read alloc failed\n");
-      std::terminate();
+      send_read(axi_op.id, axi_op.addr, axi_op.len);
+      return;
     }
 
-    unsigned int max_size = SimbricksPcieIfH2DOutMsgLen(&nicif_.pcie) -
-                            sizeof(SimbricksProtoPcieH2DReadcomp);
-    if (axi_op.len > max_size)
+    // the read completion would not fit into a single message
+    stats_.dma_split++;
+    uint64_t tag = next_split_tag_++;
+    size_t parts = (axi_op.len + max_size - 1) / max_size;
+    splits_.emplace(tag, SplitRead{axi_op.id, axi_op.len, max_size, parts,
+                                   std::make_unique<uint8_t[]>(axi_op.len)});
+    for (size_t part = 0; part < parts; part++)
     {
-      sim_log::LogError(
-          "CorundumAXISubordinateRead error: read data of length=%lu doesn't "
-          "fit into a SimBricks "
-          "message\n",
-          axi_op.len);
-      std::terminate();
+      size_t off = part * max_size;
+      send_read(dma_split_req_id(tag, part), axi_op.addr + off,
+                std::min(max_size, axi_op.len - off));
     }
-
-    volatile struct SimbricksProtoPcieD2HRead *read = &msg->read;
-    read->req_id = axi_op.id;
-    read->offset = axi_op.addr;
-    read->len = axi_op.len;
-    SimbricksPcieIfD2HOutSend(&nicif_.pcie, msg,
-                              SIMBRICKS_PROTO_PCIE_D2H_MSG_READ);
   }
 };
 
@@ -233,11 +606,12 @@ private:
 class CorundumAXISubordinateWrite
     : public simbricks::AXISubordinateWrite<
           4, 1, 16,
-          /*num concurrently pending requests*/ 16>
+          /*num concurrently pending requests*/ CORUNDUM_DMA_MAX_PENDING>
 {
 public:
   explicit CorundumAXISubordinateWrite(struct SimbricksNicIf &nicif,
-                                       Vmqnic_core_axi &top_verilator_interface)
+                                       Vmqnic_core_axi &top_verilator_interface,
+                                       NicStats &stats)
       : AXISubordinateWrite(
             reinterpret_cast<uint8_t *>(&top_verilator_interface.m_axi_awaddr),
             &top_verilator_interface.m_axi_awid,
@@ -255,12 +629,79 @@ public:
             top_verilator_interface.m_axi_bready,
             top_verilator_interface.m_axi_bvalid,
             top_verilator_interface.m_axi_bresp),
-        nicif_(nicif)
+        nicif_(nicif),
+        stats_(stats)
+  {
+  }
+
+  // number of DMA writes sent to the host that are not completed yet
+  size_t outstanding() const
+  {
+    return outstanding_;
+  }
+
+  void complete(uint64_t req_id)
   {
+    if (not(req_id & kDmaSplitFlag))
+    {
+      outstanding_--;
+      write_done(req_id);
+      return;
+    }
+
+    auto it = splits_.find(dma_split_tag(req_id));
+    if (it == splits_.end())
+    {
+      sim_log::LogError(
+          "CorundumAXISubordinateWrite::complete() unknown req_id=0x%lx\n",
+          req_id);
+      std::terminate();
+    }
+
+    SplitWrite &split = it->second;
+    if (--split.parts_left != 0)
+    {
+      return;
+    }
+    outstanding_--;
+    write_done(split.axi_id);
+    splits_.erase(it);
   }
 
 private:
+  // a write that is split across several messages, it is done once all parts
+  // are completed
+  struct SplitWrite
+  {
+    uint64_t axi_id;
+    size_t parts_left;
+  };
+
   struct SimbricksNicIf &nicif_;
+  NicStats &stats_;
+  size_t outstanding_ = 0;
+  std::unordered_map<uint64_t, SplitWrite> splits_;
+  uint64_t next_split_tag_ = 0;
+
+  void send_write(uint64_t req_id, uint64_t addr, const uint8_t *data,
+                  size_t len)
+  {
+    volatile union SimbricksProtoPcieD2H *msg = d2h_alloc(nicif_, main_time);
+    if (not msg)
+    {
+      sim_log::LogError(
+          "CorundumAXISubordinateWrite::doWrite() dma write alloc failed\n");
+      std::terminate();
+    }
+
+    volatile struct SimbricksProtoPcieD2HWrite *write = &msg->write;
+    write->req_id = req_id;
+    write->offset = addr;
+    write->len = len;
+    std::memcpy(const_cast<uint8_t *>(write->data), data, len);
+    SimbricksPcieIfD2HOutSend(&nicif_.pcie, msg,
+                              SIMBRICKS_PROTO_PCIE_D2H_MSG_WRITE);
+  }
 
   void do_write(const simbricks::AXIOperation &axi_op) final
   {
@@ -275,34 +716,30 @@ private:
     fputs("\n", stdout);
 #endif
 
-    volatile union SimbricksProtoPcieD2H *msg = d2h_alloc(nicif_, main_time);
-    if (not msg)
+    outstanding_++;
+    stats_.dma_writes++;
+    stats_.dma_write_bytes += axi_op.len;
+    stats_.dma_write_sizes[dma_size_bucket(axi_op.len)]++;
+    // the write is a D2H message, bounded by our outgoing queue entries
+    size_t max_size = SimbricksPcieIfD2HOutMsgLen(&nicif_.pcie) -
+                      sizeof(SimbricksProtoPcieD2HWrite);
+    if (axi_op.len <= max_size)
     {
-      sim_log::LogError(
-          "CorundumAXISubordinateWrite::doWrite() dma read alloc failed\n");
-      std::terminate();
+      send_write(axi_op.id, axi_op.addr, axi_op.buf.get(), axi_op.len);
+      return;
     }
 
-    volatile struct SimbricksProtoPcieD2HWrite *write = &msg->write;
-    unsigned int max_size =
-        SimbricksPcieIfH2DOutMsgLen(&nicif_.pcie) - sizeof(*write);
-    if (axi_op.len > max_size)
+    // the write data does not fit into a single message
+    stats_.dma_split++;
+    uint64_t tag = next_split_tag_++;
+    size_t parts = (axi_op.len + max_size - 1) / max_size;
+    splits_.emplace(tag, SplitWrite{axi_op.id, parts});
+    for (size_t part = 0; part < parts; part++)
     {
-      sim_log::LogError(
-          "CorundumAXISubordinateWrite error: write data of length=%lu doesn't "
-          "fit into a SimBricks "
-          "message\n",
-          axi_op.len);
-      std::terminate();
+      size_t off = part * max_size;
+      send_write(dma_split_req_id(tag, part), axi_op.addr + off,
+                 axi_op.buf.get() + off, std::min(max_size, axi_op.len - off));
     }
-
-    write->req_id = axi_op.id;
-    write->offset = axi_op.addr;
-    write->len = axi_op.len;
-    std::memcpy(const_cast<uint8_t *>(write->data), axi_op.buf.get(),
-                axi_op.len);
-    SimbricksPcieIfD2HOutSend(&nicif_.pcie, msg,
-                              SIMBRICKS_PROTO_PCIE_D2H_MSG_WRITE);
   }
 };
 
@@ -311,7 +748,8 @@ class CorundumAXILManager : public simbricks::AXILManager<3, 4>
 {
 public:
   explicit CorundumAXILManager(struct SimbricksNicIf &nicif,
-                               Vmqnic_core_axi &top_verilator_interface)
+                               Vmqnic_core_axi &top_verilator_interface,
+                               NicStats &stats)
       : AXILManager(reinterpret_cast<uint8_t *>(
                         &top_verilator_interface.s_axil_ctrl_araddr),
                     top_verilator_interface.s_axil_ctrl_arready,
@@ -333,15 +771,39 @@ public:
                     top_verilator_interface.s_axil_ctrl_bready,
                     top_verilator_interface.s_axil_ctrl_bvalid,
                     top_verilator_interface.s_axil_ctrl_bresp),
-        nicif_(nicif)
+        nicif_(nicif),
+        stats_(stats)
+  {
+  }
+
+  // number of register accesses issued to the model that are not done yet
+  size_t outstanding() const
+  {
+    return outstanding_;
+  }
+
+  void issue_read(uint64_t req_id, uint64_t addr)
+  {
+    outstanding_++;
+    stats_.mmio_reads++;
+    AXILManager::issue_read(req_id, addr);
+  }
+
+  void issue_write(uint64_t req_id, uint64_t addr, uint32_t data, bool posted)
   {
+    outstanding_++;
+    stats_.mmio_writes++;
+    AXILManager::issue_write(req_id, addr, data, posted);
   }
 
 private:
   struct SimbricksNicIf &nicif_;
+  NicStats &stats_;
+  size_t outstanding_ = 0;
 
   void read_done(simbricks::AXILOperationR &axi_op) final
   {
+    outstanding_--;
 #ifdef CORUNDUM_VERILATOR_DEBUG
     sim_log::LogInfo(
         "CorundumAXILManager::read_done() ts=%lu  id=%lu  addr=0x%lx data=",
@@ -369,6 +831,7 @@ private:
 
   void write_done(simbricks::AXILOperationW &axi_op) final
   {
+    outstanding_--;
 #ifdef CORUNDUM_VERILATOR_DEBUG
     sim_log::LogInfo(
         "CorundumAXILManager::write_done() ts=%lu  id=%lu  addr=0x%lx "
@@ -404,89 +867,341 @@ private:
 using AxiSFromNetworkT = simbricks::AXISManager<8, 32, 2048>;
 using AxiSToNetworkT = simbricks::AXISSubordinate<8, 2048>;
 
-/* **************************************************************************
- * H2D handling methods
- * ************************************************************************** */
-
-void h2d_read(volatile struct SimbricksProtoPcieH2DRead &read, uint64_t cur_ts,
-              CorundumAXILManager &mmio)
+// Stages packets received from the network while the AXI stream manager
+// feeding the NIC cannot accept them. Packets are only dropped once the ring
+// is full. In hold mode they are instead left in the Ethernet queue, which
+// propagates the backpressure to the network simulator.
+class RxStagingRing
 {
-#ifdef CORUNDUM_VERILATOR_DEBUG
-  sim_log::LogInfo("h2d_read ts=%lu bar=%d offset=0x%lx len=%lu\n", cur_ts,
-                   static_cast<int>(read.bar),
-                   static_cast<uint64_t>(read.offset),
-                   static_cast<uint64_t>(read.len));
-#endif
+  static constexpr size_t kMaxPacketLen = 2048;
 
-  if (read.bar != 0)
+  struct Packet
   {
-    sim_log::LogError("write to unexpected bar=%d", static_cast<int>(read.bar));
-    std::terminate();
-  }
-
-  mmio.issue_read(read.req_id, read.offset);
-}
-
-void h2d_write(struct SimbricksNicIf &nicif,
-               volatile struct SimbricksProtoPcieH2DWrite &write,
-               uint64_t cur_ts, bool posted, CorundumAXILManager &mmio)
-{
-#ifdef CORUNDUM_VERILATOR_DEBUG
-  sim_log::LogInfo(
-      "h2d_write ts=%lu bar=%d offset=0x%lx len=%lu posted=%d data=", cur_ts,
-      static_cast<int>(write.bar), static_cast<uint64_t>(write.offset),
-      static_cast<uint64_t>(write.len), posted);
-  std::for_each_n(const_cast<uint8_t *>(write.data), write.len,
-                  [](uint8_t &val)
-                  { fprintf(stdout, "%02X ", val); });
-  fputs("\n", stdout);
-#endif
+    size_t len = 0;
+    std::unique_ptr<uint8_t[]> data;
+  };
+
+  AxiSFromNetworkT &axis_;
+  NicStats &stats_;
+  std::vector<Packet> ring_;
+  size_t head_ = 0;
+  size_t count_ = 0;
+  bool hold_ = false;
+
+  uint64_t received_ = 0;
+  uint64_t dropped_ = 0;
+  uint64_t staged_ = 0;
+  uint64_t held_cycles_ = 0;
+  uint64_t cycles_ = 0;
+  uint64_t occupancy_sum_ = 0;
+  size_t max_occupancy_ = 0;
 
-  if (write.bar != 0)
+public:
+  RxStagingRing(AxiSFromNetworkT &axis, NicStats &stats)
+      : axis_(axis), stats_(stats)
   {
-    sim_log::LogError("write to unexpected bar=%d", write.bar);
-    std::terminate();
   }
 
-  if (write.len != 4)
+  void configure(size_t depth, bool hold)
   {
-    sim_log::LogError(
-        "h2d_write() Corundum register write only supported up to 8 bytes\n");
-    std::terminate();
+    ring_.resize(depth);
+    for (Packet &packet : ring_)
+    {
+      packet.data = std::make_unique<uint8_t[]>(kMaxPacketLen);
+    }
+    hold_ = hold;
   }
 
-  uint32_t data = 0;
-  std::memcpy(&data, const_cast<uint8_t *>(write.data), write.len);
-  mmio.issue_write(write.req_id, write.offset, data, posted);
-
-  if (!posted)
+  bool empty() const
   {
-    volatile union SimbricksProtoPcieD2H *msg = d2h_alloc(nicif, cur_ts);
-    volatile struct SimbricksProtoPcieD2HWritecomp &writecomp = msg->writecomp;
-    writecomp.req_id = write.req_id;
+    return count_ == 0;
+  }
 
-    SimbricksPcieIfD2HOutSend(&nicif.pcie, msg,
-                              SIMBRICKS_PROTO_PCIE_D2H_MSG_WRITECOMP);
+  // true if the next packet from the network must stay in the Ethernet queue
+  bool blocked() const
+  {
+    return hold_ and count_ == ring_.size() and axis_.full();
   }
-  return;
-}
 
-void h2d_readcomp(volatile struct SimbricksProtoPcieH2DReadcomp &readcomp,
-                  uint64_t cur_ts, CorundumAXISubordinateRead &dma_read)
-{
-  dma_read.read_done(readcomp.req_id, const_cast<uint8_t *>(readcomp.data));
-}
+  // number of packets received from the network, including dropped ones
+  uint64_t received() const
+  {
+    return received_;
+  }
 
-void h2d_writecomp(volatile struct SimbricksProtoPcieH2DWritecomp &writecomp,
+  void receive(const uint8_t *data, size_t len)
+  {
+    received_++;
+    if (count_ == 0 and not axis_.full())
+    {
+      axis_.read(data, len);
+      return;
+    }
+
+    if (count_ == ring_.size() or len > kMaxPacketLen)
+    {
+#ifdef CORUNDUM_VERILATOR_DEBUG
+      sim_log::LogError("corundum verilator n2d_recv: dropping packet\n");
+#endif
+      stats_.rx_dropped++;
+      dropped_++;
+      return;
+    }
+
+    Packet &packet = ring_[(head_ + count_) % ring_.size()];
+    std::memcpy(packet.data.get(), data, len);
+    packet.len = len;
+    count_++;
+    staged_++;
+    max_occupancy_ = std::max(max_occupancy_, count_);
+  }
+
+  // move staged packets to the AXI stream manager, called once per cycle
+  void drain()
+  {
+    while (count_ != 0 and not axis_.full())
+    {
+      Packet &packet = ring_[head_];
+      axis_.read(packet.data.get(), packet.len);
+      head_ = (head_ + 1) % ring_.size();
+      count_--;
+    }
+    cycles_++;
+    occupancy_sum_ += count_;
+    if (blocked())
+    {
+      held_cycles_++;
+    }
+  }
+
+  void report(unsigned nic) const
+  {
+    sim_log::LogInfo(
+        "rx staging nic %u: depth=%zu hold=%d received=%lu staged=%lu "
+        "dropped=%lu max_occupancy=%zu avg_occupancy=%.3f held_cycles=%lu\n",
+        nic, ring_.size(), hold_, received_, staged_, dropped_,
+        max_occupancy_,
+        cycles_ ? static_cast<double>(occupancy_sum_) / cycles_ : 0.0,
+        held_cycles_);
+  }
+};
+
+/* **************************************************************************
+ * host control registers
+ * ************************************************************************** */
+
+// Each NIC has a small BAR with registers of the adapter itself, next to the
+// registers of the Corundum design in BAR 0. The mqnic driver does not use
+// it. Through it, a program in the host (`corundum-checkpoint`) requests a
+// checkpoint right before the host takes its own, so that both capture the
+// same state: the adapter saves once the NIC is quiescent, then stops
+// simulating the NIC until it exits. Registers are 32 bits wide.
+static constexpr uint8_t kControlBar = 4;
+static constexpr uint32_t kControlBarLen = 1 << 12;
+// read: status of the checkpoint, write 1: request a checkpoint
+static constexpr uint64_t kControlCheckpoint = 0x0;
+
+class HostControl
+{
+public:
+  enum Status : uint32_t
+  {
+    kDisabled = 0, // the adapter does not save checkpoints
+    kIdle = 1,
+    kPending = 2, // requested, waiting for the NIC to become quiescent
+    kSaved = 3,
+    kFailed = 4,
+  };
+
+private:
+  Status status_ = kDisabled;
+  bool frozen_ = false;
+  bool diverged_ = false;
+
+public:
+  void enable()
+  {
+    status_ = kIdle;
+  }
+
+  // a checkpoint was already saved without the host asking for it
+  void disable()
+  {
+    status_ = kDisabled;
+  }
+
+  uint32_t read(uint64_t offset) const
+  {
+    return offset == kControlCheckpoint ? status_ : 0;
+  }
+
+  void write(uint64_t offset, uint32_t value)
+  {
+    if (offset == kControlCheckpoint and value == 1 and status_ == kIdle)
+    {
+      status_ = kPending;
+    }
+  }
+
+  bool requested() const
+  {
+    return status_ == kPending;
+  }
+
+  void finish(bool saved)
+  {
+    status_ = saved ? kSaved : kFailed;
+  }
+
+  // the NIC is no longer simulated after a checkpoint the host requested, as
+  // the host's checkpoint would not contain any of its further effects
+  void freeze()
+  {
+    frozen_ = true;
+  }
+
+  bool frozen() const
+  {
+    return frozen_;
+  }
+
+  // the host accessed the frozen NIC, so its state differs from the NIC's
+  void diverge()
+  {
+    diverged_ = true;
+  }
+
+  bool diverged() const
+  {
+    return diverged_;
+  }
+};
+
+static void control_read(struct SimbricksNicIf &nicif,
+                         volatile struct SimbricksProtoPcieH2DRead &read,
+                         uint64_t cur_ts, uint32_t value)
+{
+  volatile union SimbricksProtoPcieD2H *msg = d2h_alloc(nicif, cur_ts);
+  volatile struct SimbricksProtoPcieD2HReadcomp &readcomp = msg->readcomp;
+  size_t len = std::min<size_t>(read.len, sizeof(value));
+  std::memset(const_cast<uint8_t *>(readcomp.data), 0, read.len);
+  std::memcpy(const_cast<uint8_t *>(readcomp.data), &value, len);
+  readcomp.req_id = read.req_id;
+  SimbricksPcieIfD2HOutSend(&nicif.pcie, msg,
+                            SIMBRICKS_PROTO_PCIE_D2H_MSG_READCOMP);
+}
+
+/* **************************************************************************
+ * H2D handling methods
+ * ************************************************************************** */
+
+void h2d_read(struct SimbricksNicIf &nicif,
+              volatile struct SimbricksProtoPcieH2DRead &read, uint64_t cur_ts,
+              CorundumAXILManager &mmio, HostControl &ctrl)
+{
+#ifdef CORUNDUM_VERILATOR_DEBUG
+  sim_log::LogInfo("h2d_read ts=%lu bar=%d offset=0x%lx len=%lu\n", cur_ts,
+                   static_cast<int>(read.bar),
+                   static_cast<uint64_t>(read.offset),
+                   static_cast<uint64_t>(read.len));
+#endif
+
+  if (read.bar == kControlBar)
+  {
+    control_read(nicif, read, cur_ts, ctrl.read(read.offset));
+    return;
+  }
+
+  if (read.bar != 0)
+  {
+    sim_log::LogError("write to unexpected bar=%d", static_cast<int>(read.bar));
+    std::terminate();
+  }
+
+  if (ctrl.frozen())
+  {
+    // answered like a missing device, the checkpoint is void now
+    ctrl.diverge();
+    control_read(nicif, read, cur_ts, UINT32_MAX);
+    return;
+  }
+
+  mmio.issue_read(read.req_id, read.offset);
+}
+
+void h2d_write(struct SimbricksNicIf &nicif,
+               volatile struct SimbricksProtoPcieH2DWrite &write,
+               uint64_t cur_ts, bool posted, CorundumAXILManager &mmio,
+               HostControl &ctrl)
+{
+#ifdef CORUNDUM_VERILATOR_DEBUG
+  sim_log::LogInfo(
+      "h2d_write ts=%lu bar=%d offset=0x%lx len=%lu posted=%d data=", cur_ts,
+      static_cast<int>(write.bar), static_cast<uint64_t>(write.offset),
+      static_cast<uint64_t>(write.len), posted);
+  std::for_each_n(const_cast<uint8_t *>(write.data), write.len,
+                  [](uint8_t &val)
+                  { fprintf(stdout, "%02X ", val); });
+  fputs("\n", stdout);
+#endif
+
+  if (write.bar != 0 and write.bar != kControlBar)
+  {
+    sim_log::LogError("write to unexpected bar=%d", write.bar);
+    std::terminate();
+  }
+
+  if (write.len != 4)
+  {
+    sim_log::LogError(
+        "h2d_write() Corundum register write only supported up to 8 bytes\n");
+    std::terminate();
+  }
+
+  uint32_t data = 0;
+  std::memcpy(&data, const_cast<uint8_t *>(write.data), write.len);
+  if (write.bar == kControlBar)
+  {
+    ctrl.write(write.offset, data);
+  }
+  else if (ctrl.frozen())
+  {
+    ctrl.diverge();
+  }
+  else
+  {
+    mmio.issue_write(write.req_id, write.offset, data, posted);
+  }
+
+  if (!posted)
+  {
+    volatile union SimbricksProtoPcieD2H *msg = d2h_alloc(nicif, cur_ts);
+    volatile struct SimbricksProtoPcieD2HWritecomp &writecomp = msg->writecomp;
+    writecomp.req_id = write.req_id;
+
+    SimbricksPcieIfD2HOutSend(&nicif.pcie, msg,
+                              SIMBRICKS_PROTO_PCIE_D2H_MSG_WRITECOMP);
+  }
+  return;
+}
+
+void h2d_readcomp(volatile struct SimbricksProtoPcieH2DReadcomp &readcomp,
+                  uint64_t cur_ts, CorundumAXISubordinateRead &dma_read)
+{
+  dma_read.complete(readcomp.req_id, const_cast<uint8_t *>(readcomp.data));
+}
+
+void h2d_writecomp(volatile struct SimbricksProtoPcieH2DWritecomp &writecomp,
                    uint64_t cur_ts, CorundumAXISubordinateWrite &dma_write)
 {
-  dma_write.write_done(writecomp.req_id);
+  dma_write.complete(writecomp.req_id);
 }
 
-void poll_h2d(struct SimbricksNicIf &nicif, uint64_t cur_ts,
+// returns true if a message other than a sync message was handled
+bool poll_h2d(struct SimbricksNicIf &nicif, uint64_t cur_ts,
               CorundumAXISubordinateRead &dma_read,
               CorundumAXISubordinateWrite &dma_write,
-              CorundumAXILManager &mmio)
+              CorundumAXILManager &mmio, HostControl &ctrl)
 {
   volatile union SimbricksProtoPcieH2D *msg =
       SimbricksPcieIfH2DInPoll(&nicif.pcie, cur_ts);
@@ -496,22 +1211,22 @@ void poll_h2d(struct SimbricksNicIf &nicif, uint64_t cur_ts,
 #ifdef CORUNDUM_VERILATOR_DEBUG
     // sim_log::LogWarn("poll_h2d msg NULL\n");
 #endif
-    return;
+    return false;
   }
 
   uint8_t type = SimbricksPcieIfH2DInType(&nicif.pcie, msg);
   switch (type)
   {
   case SIMBRICKS_PROTO_PCIE_H2D_MSG_READ:
-    h2d_read(msg->read, cur_ts, mmio);
+    h2d_read(nicif, msg->read, cur_ts, mmio, ctrl);
     break;
 
   case SIMBRICKS_PROTO_PCIE_H2D_MSG_WRITE:
-    h2d_write(nicif, msg->write, cur_ts, false, mmio);
+    h2d_write(nicif, msg->write, cur_ts, false, mmio, ctrl);
     break;
 
   case SIMBRICKS_PROTO_PCIE_H2D_MSG_WRITE_POSTED:
-    h2d_write(nicif, msg->write, cur_ts, true, mmio);
+    h2d_write(nicif, msg->write, cur_ts, true, mmio, ctrl);
     break;
 
   case SIMBRICKS_PROTO_PCIE_H2D_MSG_READCOMP:
@@ -535,6 +1250,7 @@ void poll_h2d(struct SimbricksNicIf &nicif, uint64_t cur_ts,
   }
 
   SimbricksPcieIfH2DInDone(&nicif.pcie, msg);
+  return type != SIMBRICKS_PROTO_MSG_TYPE_SYNC;
 }
 
 /* **************************************************************************
@@ -542,19 +1258,14 @@ void poll_h2d(struct SimbricksNicIf &nicif, uint64_t cur_ts,
  * ************************************************************************** */
 
 void n2d_recv(volatile struct SimbricksProtoNetMsgPacket &packet,
-              uint64_t cur_ts, AxiSFromNetworkT &axis_from_network)
+              uint64_t cur_ts, RxStagingRing &rx_staging, NicStats &stats)
 {
-  if (axis_from_network.full())
-  {
-#ifdef CORUNDUM_VERILATOR_DEBUG
-    sim_log::LogError("corundum verilator n2d_recv: dropping packet\n");
-#endif
-    return;
-  }
+  stats.rx_packets++;
+  stats.rx_bytes += packet.len;
 
   // NOTE: const_cast ing the member of the volatile struct to non-volatile is
   // undefined behavior...
-  axis_from_network.read(const_cast<const uint8_t *>(packet.data), packet.len);
+  rx_staging.receive(const_cast<const uint8_t *>(packet.data), packet.len);
 
 #ifdef CORUNDUM_VERILATOR_DEBUG
   sim_log::LogInfo(
@@ -566,9 +1277,16 @@ void n2d_recv(volatile struct SimbricksProtoNetMsgPacket &packet,
 #endif
 }
 
-void poll_n2d(struct SimbricksNicIf &nicif, uint64_t cur_ts,
-              AxiSFromNetworkT &axis_from_network)
+// returns true if a message other than a sync message was handled
+bool poll_n2d(struct SimbricksNicIf &nicif, uint64_t cur_ts,
+              RxStagingRing &rx_staging, NicStats &stats)
 {
+  // in hold mode leave the message in the queue until there is space again
+  if (rx_staging.blocked())
+  {
+    return false;
+  }
+
   volatile union SimbricksProtoNetMsg *msg =
       SimbricksNetIfInPoll(&nicif.net, cur_ts);
 
@@ -577,14 +1295,14 @@ void poll_n2d(struct SimbricksNicIf &nicif, uint64_t cur_ts,
 #ifdef CORUNDUM_VERILATOR_DEBUG
     // sim_log::LogWarn("poll_n2d msg NULL\n");
 #endif
-    return;
+    return false;
   }
 
   uint8_t type = SimbricksNetIfInType(&nicif.net, msg);
   switch (type)
   {
   case SIMBRICKS_PROTO_NET_MSG_PACKET:
-    n2d_recv(msg->packet, cur_ts, axis_from_network);
+    n2d_recv(msg->packet, cur_ts, rx_staging, stats);
     break;
 
   case SIMBRICKS_PROTO_MSG_TYPE_SYNC:
@@ -595,17 +1313,19 @@ void poll_n2d(struct SimbricksNicIf &nicif, uint64_t cur_ts,
   }
 
   SimbricksNetIfInDone(&nicif.net, msg);
+  return type != SIMBRICKS_PROTO_MSG_TYPE_SYNC;
 }
 
-void packet_d2n(struct SimbricksNicIf &nicif, uint64_t cur_ts,
+// returns true if a packet was sent to the network
+bool packet_d2n(struct SimbricksNicIf &nicif, uint64_t cur_ts,
                 AxiSToNetworkT &axis_to_network,
-                Vmqnic_core_axi &top_verilator_interface)
+                Vmqnic_core_axi &top_verilator_interface, NicStats &stats)
 {
   if (not axis_to_network.is_packet_done())
   {
     top_verilator_interface.s_axis_tx_cpl_valid = 0;
     // if no packet is done we have nothing to do
-    return;
+    return false;
   }
 
 #ifdef CORUNDUM_VERILATOR_DEBUG
@@ -631,6 +1351,8 @@ void packet_d2n(struct SimbricksNicIf &nicif, uint64_t cur_ts,
     std::terminate();
   }
   packet->len = static_cast<uint16_t>(packet_len);
+  stats.tx_packets++;
+  stats.tx_bytes += packet_len;
 
   // send courundum completion
   top_verilator_interface.s_axis_tx_cpl_valid = 1;
@@ -647,16 +1369,31 @@ void packet_d2n(struct SimbricksNicIf &nicif, uint64_t cur_ts,
   fputs("\n", stdout);
 #endif
   SimbricksNetIfOutSend(&nicif.net, msg, SIMBRICKS_PROTO_NET_MSG_PACKET);
+  return true;
 }
 
 /* **************************************************************************
  * interrupt handling
  * ************************************************************************** */
 
+// Sends an MSI for every asserted bit of the irq vector. With coalescing
+// enabled, an asserted vector is only sent once min_interval has passed since
+// its last interrupt, or earlier once packet_threshold packets were sent or
+// received since the last batch. All pending vectors are sent together then.
 class MsiInterruptHandler
 {
+  static constexpr uint32_t kNumVectors = 32;
+
   const uint32_t &msi_irq_;
   struct SimbricksNicIf &nicif_;
+  NicStats &stats_;
+
+  uint64_t min_interval_ = 0;
+  uint64_t packet_threshold_ = 0;
+  uint32_t pending_ = 0;
+  uint64_t next_due_ = UINT64_MAX;
+  uint64_t last_sent_[kNumVectors] = {};
+  uint64_t packets_at_batch_ = 0;
 
   void msi_issue(uint32_t intr_vec, uint64_t main_time) const
   {
@@ -674,6 +1411,7 @@ class MsiInterruptHandler
       std::terminate();
     }
 
+    stats_.msis++;
     volatile struct SimbricksProtoPcieD2HInterrupt *intr = &msg->interrupt;
     intr->vector = intr_vec;
     intr->inttype = SIMBRICKS_PROTO_PCIE_INT_MSI;
@@ -682,21 +1420,80 @@ class MsiInterruptHandler
                               SIMBRICKS_PROTO_PCIE_D2H_MSG_INTERRUPT);
   }
 
-  uint32_t get_intr_bit_pos_i(uint32_t i) const
+  void issue_all(uint32_t vectors, uint64_t main_time)
+  {
+    for (uint32_t i = 0; i < kNumVectors; i++)
+    {
+      if (vectors & (1U << i))
+      {
+        msi_issue(i, main_time);
+        last_sent_[i] = main_time;
+      }
+    }
+  }
+
+  void coalesce(uint64_t main_time, uint64_t packets)
   {
-    uint32_t res = (1ULL << i) & msi_irq_;
-    return res;
+    uint32_t asserted = msi_irq_;
+    stats_.msis_coalesced += __builtin_popcount(asserted & pending_);
+    for (uint32_t i = 0; i < kNumVectors; i++)
+    {
+      if (asserted & ~pending_ & (1U << i))
+      {
+        next_due_ = std::min(next_due_, last_sent_[i] + min_interval_);
+      }
+    }
+    pending_ |= asserted;
+
+    bool threshold_hit = packet_threshold_ != 0 and
+                         packets - packets_at_batch_ >= packet_threshold_;
+    if (not pending_ or (main_time < next_due_ and not threshold_hit))
+    {
+      return;
+    }
+
+    issue_all(pending_, main_time);
+    pending_ = 0;
+    next_due_ = UINT64_MAX;
+    packets_at_batch_ = packets;
   }
 
 public:
-  MsiInterruptHandler(struct SimbricksNicIf &nicif, const uint32_t &msi_irq)
-      : msi_irq_(msi_irq), nicif_(nicif)
+  MsiInterruptHandler(struct SimbricksNicIf &nicif, const uint32_t &msi_irq,
+                      NicStats &stats)
+      : msi_irq_(msi_irq), nicif_(nicif), stats_(stats)
+  {
+  }
+
+  void configure(uint64_t min_interval, uint64_t packet_threshold)
+  {
+    min_interval_ = min_interval;
+    packet_threshold_ = packet_threshold;
+  }
+
+  // true if there are asserted vectors that were not sent yet
+  bool pending() const
+  {
+    return pending_ != 0;
+  }
+
+#ifdef CORUNDUM_SAVABLE
+  // only called without pending vectors, so the send times are all there is
+  void save(VerilatedSave &os) const
   {
+    os.write(last_sent_, sizeof(last_sent_));
   }
 
-  void step(uint64_t main_time)
+  void restore(VerilatedRestore &is)
   {
-    if (not msi_irq_)
+    is.read(last_sent_, sizeof(last_sent_));
+  }
+#endif
+
+  // packets is the number of packets this NIC sent and received so far
+  void step(uint64_t main_time, uint64_t packets)
+  {
+    if (not msi_irq_ and not pending_)
     {
       return;
     }
@@ -707,233 +1504,1279 @@ public:
         main_time, msi_irq_);
 #endif
 
-    for (uint32_t i = 0; i < 32; i++)
+    if (min_interval_ == 0)
     {
-      uint32_t bit = get_intr_bit_pos_i(i);
-      if (not static_cast<bool>(bit))
-      {
-        continue;
-      }
-
-      msi_issue(i, main_time);
+      issue_all(msi_irq_, main_time);
+      return;
     }
+    coalesce(main_time, packets);
   }
 };
 
 /* **************************************************************************
- * main adapter driver
+ * waveform tracing
  * ************************************************************************** */
 
-int main(int argc, char *argv[])
+// Writes an FST waveform for the simulated time window [start, stop]. The
+// tracer is only attached to the model once the window opens, outside of it
+// the per-dump cost is a single comparison.
+class WaveformTracer
 {
-  // declarations
-  auto top_verilator_interface = std::make_unique<Vmqnic_core_axi>();
-  auto trace = std::make_unique<VerilatedVcdC>();
-
-  struct SimbricksBaseIfParams netParams;
-  struct SimbricksBaseIfParams pcieParams;
-  struct SimbricksAdapterParams *pcieAdapterParams = nullptr;
-  struct SimbricksAdapterParams *netAdapterParams = nullptr;
-  struct SimbricksNicIf nicif;
-  struct SimbricksProtoPcieDevIntro di;
-  uint64_t clock_period = 4 * 1000ULL; // 4ns -> 250MHz
-
-  AxiSFromNetworkT axis_from_network{
-      top_verilator_interface->s_axis_rx_tvalid,
-      top_verilator_interface->s_axis_rx_tready,
-      reinterpret_cast<uint8_t *>(&top_verilator_interface->s_axis_rx_tdata),
-      &top_verilator_interface->s_axis_rx_tkeep,
-      top_verilator_interface->s_axis_rx_tlast,
-      reinterpret_cast<uint8_t *>(&top_verilator_interface->s_axis_rx_tuser)};
-
-  AxiSToNetworkT axis_to_network{
-      top_verilator_interface->m_axis_tx_tvalid,
-      top_verilator_interface->m_axis_tx_tready,
-      reinterpret_cast<uint8_t *>(&top_verilator_interface->m_axis_tx_tdata),
-      &top_verilator_interface->m_axis_tx_tkeep,
-      top_verilator_interface->m_axis_tx_tlast,
-      reinterpret_cast<uint8_t *>(&top_verilator_interface->m_axis_tx_tuser)};
+  Vmqnic_core_axi &top_;
+  std::unique_ptr<VerilatedFstC> fst_;
+  std::string path_;
+  uint64_t start_ = 0;
+  uint64_t stop_ = UINT64_MAX;
+  int depth_ = 99;
+  // next timestamp at which dump() has to do something
+  uint64_t next_event_ = UINT64_MAX;
+
+  void dump_slow(uint64_t time)
+  {
+    if (not fst_)
+    {
+      sim_log::LogInfo("WaveformTracer: start tracing to %s at ts=%lu\n",
+                       path_.c_str(), time);
+      fst_ = std::make_unique<VerilatedFstC>();
+      top_.trace(fst_.get(), depth_);
+      fst_->open(path_.c_str());
+    }
 
-  CorundumAXISubordinateRead dma_read{nicif, *top_verilator_interface};
-  CorundumAXISubordinateWrite dma_write{nicif, *top_verilator_interface};
-  CorundumAXILManager mmio{nicif, *top_verilator_interface};
+    fst_->dump(time);
+    if (time >= stop_)
+    {
+      close(time);
+    }
+  }
 
-  MsiInterruptHandler msi_intr_handler{nicif, top_verilator_interface->irq};
+public:
+  explicit WaveformTracer(Vmqnic_core_axi &top) : top_(top)
+  {
+  }
 
-  // argument parsing and initialization
-  if (argc < 3 || argc > 5)
+  void configure(const std::string &path, uint64_t start, uint64_t stop,
+                 int depth)
   {
-    fprintf(stderr,
-            "Usage: corundum_verilator PCI-PARAMS ETH-PARAMS "
-            "[START-TICK] [CLOCK-FREQ-MHZ]\n");
-    return EXIT_FAILURE;
+    path_ = path;
+    start_ = start;
+    stop_ = stop;
+    depth_ = depth;
+    next_event_ = start_;
   }
-  if (argc >= 4)
-    main_time = strtoull(argv[3], NULL, 0);
-  if (argc >= 5)
-    clock_period = 1000000ULL / strtoull(argv[4], NULL, 0);
 
-  pcieAdapterParams = SimbricksParametersParse(argv[1]);
-  netAdapterParams = SimbricksParametersParse(argv[2]);
+  bool enabled() const
+  {
+    return not path_.empty();
+  }
 
-  if (!(pcieAdapterParams && netAdapterParams))
+  void dump(uint64_t time)
   {
-    fprintf(stderr, "Failed to parse PCIe or Ethernet parameters\n");
-    return EXIT_FAILURE;
+    if (time < next_event_)
+    {
+      return;
+    }
+    dump_slow(time);
   }
 
-  if (!(pcieAdapterParams->listen && netAdapterParams->listen))
+  void close(uint64_t time)
   {
-    fprintf(stderr, "Corundum Verilator currently only supports "
-                    "listening adapters\n");
-    return EXIT_FAILURE;
+    next_event_ = UINT64_MAX;
+    if (not fst_ or not fst_->isOpen())
+    {
+      return;
+    }
+    sim_log::LogInfo("WaveformTracer: stop tracing at ts=%lu\n", time);
+    fst_->dump(time + 1);
+    fst_->close();
   }
+};
 
-  if (pcieAdapterParams->sync_interval_set)
-    pcieParams.sync_interval = pcieAdapterParams->sync_interval * 1000ULL;
-  if (netAdapterParams->sync_interval_set)
-    netParams.sync_interval = netAdapterParams->sync_interval * 1000ULL;
-  if (pcieAdapterParams->link_latency_set)
-    pcieParams.link_latency = pcieAdapterParams->link_latency * 1000ULL;
-  if (netAdapterParams->link_latency_set)
-    netParams.link_latency = netAdapterParams->link_latency * 1000ULL;
-
-  SimbricksNetIfDefaultParams(&netParams);
-  SimbricksPcieIfDefaultParams(&pcieParams);
-
-  pcieParams.sock_path = pcieAdapterParams->socket_path;
-  netParams.sock_path = netAdapterParams->socket_path;
-  // Since the NIC interface uses a single shared memory pool for both pcie and
-  // net interface, we just take the shm path provided for the pcie adapter here
-  const char *shmPath = pcieAdapterParams->shm_path;
-
-  pcieParams.sync_mode = GetSyncMode(pcieAdapterParams->sync);
-  netParams.sync_mode = GetSyncMode(netAdapterParams->sync);
-
-  memset(&di, 0, sizeof(di));
-  di.bars[0].len = 1 << 24;
-  di.bars[0].flags = SIMBRICKS_PROTO_PCIE_BAR_64;
-  di.pci_vendor_id = 0x5543;
-  di.pci_device_id = 0x1001;
-  di.pci_class = 0x02;
-  di.pci_subclass = 0x00;
-  di.pci_revision = 0x00;
-  di.pci_msi_nvecs = 32;
+/* **************************************************************************
+ * idle fast-forward
+ * ************************************************************************** */
 
-  sim_log::Logger::GetRegistry().SetFlush(true);
+// Whether the NIC is quiescent, i.e. there is no operation pending in any of
+// the handlers and none of the interfaces or interrupt lines of the model is
+// active. This does not cover state inside the design, IdleFastForward only
+// uses it to decide when to look at the full model state.
+bool nic_quiescent(const Vmqnic_core_axi &top,
+                   const CorundumAXISubordinateRead &dma_read,
+                   const CorundumAXISubordinateWrite &dma_write,
+                   const CorundumAXILManager &mmio)
+{
+  return dma_read.outstanding() == 0 and dma_write.outstanding() == 0 and
+         mmio.outstanding() == 0 and not top.m_axi_arvalid and
+         not top.m_axi_rvalid and not top.m_axi_awvalid and
+         not top.m_axi_wvalid and not top.m_axi_bvalid and
+         not top.s_axil_ctrl_arvalid and not top.s_axil_ctrl_rvalid and
+         not top.s_axil_ctrl_awvalid and not top.s_axil_ctrl_wvalid and
+         not top.s_axil_ctrl_bvalid and not top.s_axis_rx_tvalid and
+         not top.m_axis_tx_tvalid and not top.s_axis_tx_cpl_valid and
+         not top.irq;
+}
+
+#ifdef CORUNDUM_SAVABLE
+// Serializes the state of a Verilated model into memory instead of a file.
+class StateSnapshot : public VerilatedSerialize
+{
+  std::vector<uint8_t> &data_;
 
-  if (SimbricksNicIfInit(&nicif, shmPath, &netParams, &pcieParams, &di))
+public:
+  explicit StateSnapshot(std::vector<uint8_t> &data) : data_(data)
   {
-    sim_log::LogError("corundum simbricks adapter SimbricksNicIfInit failed\n");
-    return EXIT_FAILURE;
+    data_.clear();
+    m_isOpen = true;
   }
 
-  bool sync_pci = SimbricksBaseIfSyncEnabled(&nicif.pcie.base);
-  bool sync_eth = SimbricksBaseIfSyncEnabled(&nicif.net.base);
-#ifdef CORUNDUM_VERILATOR_DEBUG
-  sim_log::LogRegistry().SetFlush(true);
-  sim_log::LogInfo("sync_pci=%d sync_eth=%d\n", sync_pci, sync_eth);
-#endif
-
-  signal(SIGINT, sigint_handler);
-  signal(SIGUSR1, sigusr1_handler);
+  ~StateSnapshot() override
+  {
+    flush();
+  }
 
-#ifdef CORUNDUM_VERILATOR_TRACE
-  Verilated::traceEverOn(true);
-  top_verilator_interface->trace(trace.get(), CORUNDUM_VERILATOR_TRACE_LEVEL);
-  trace->open("corundum-verilator-debug.vcd");
+  void flush() override
+  {
+    data_.insert(data_.end(), m_bufp, m_cp);
+    m_cp = m_bufp;
+  }
+};
 #endif
 
-  reset_corundum(*top_verilator_interface);
-  top_verilator_interface->rst = 1;
-  top_verilator_interface->tx_rst = 1;
-  top_verilator_interface->rx_rst = 1;
-  top_verilator_interface->eval();
-
-  /* raising edge */
-  top_verilator_interface->clk = 1;
-  top_verilator_interface->eval();
-  top_verilator_interface->rst = 0;
-  top_verilator_interface->tx_rst = 0;
-  top_verilator_interface->rx_rst = 0;
-  top_verilator_interface->tx_status = 1;
-  top_verilator_interface->rx_status = 1;
+// Skips clock cycles while the NICs provably do nothing. Once all NICs have
+// been quiescent for a configurable number of cycles, the full state of the
+// models is compared before and after one more cycle. If it did not change,
+// the models are at a fixed point: until the next message arrives, the
+// handlers drive the same inputs and every further cycle ends in the same
+// state. Skipping cycles up to the next message then gives exactly the same
+// results. Designs with free running state, e.g. a running PTP clock, never
+// reach a fixed point and are simulated cycle by cycle. After a failed
+// comparison the number of idle cycles before the next one doubles, which
+// bounds the cost of the snapshots.
+class IdleFastForward
+{
+  static constexpr uint64_t kMaxIdleRequired = 1ULL << 24;
 
-#ifdef CORUNDUM_VERILATOR_DEBUG
-  sim_log::LogInfo("corundum start main simulation loop\n");
-#endif
+  uint64_t idle_threshold_ = 0;
+  uint64_t idle_required_ = 0;
+  uint64_t idle_cycles_ = 0;
+  bool proving_ = false;
+  bool fixed_point_ = false;
+  std::vector<std::vector<uint8_t>> before_;
+  uint64_t proofs_ = 0;
+  uint64_t proofs_failed_ = 0;
 
-  // main simulation loop
-  while (not exiting)
+public:
+  void configure(uint64_t idle_threshold)
   {
-    while (SimbricksNicIfSync(&nicif, main_time) < 0)
-    {
+    idle_threshold_ = idle_threshold;
+    idle_required_ = idle_threshold;
+  }
+
+  bool enabled() const
+  {
+    return idle_threshold_ != 0;
+  }
+
+  // called once per cycle, after the incoming messages were handled
+  void observe(bool idle)
+  {
+    if (idle)
+    {
+      idle_cycles_++;
+      return;
+    }
+    idle_cycles_ = 0;
+    proving_ = false;
+    fixed_point_ = false;
+  }
+
+  // whether the state should be compared across the next cycle
+  bool wants_proof() const
+  {
+    return not fixed_point_ and not proving_ and
+           idle_cycles_ >= idle_required_;
+  }
+
+  void begin_proof(std::vector<std::vector<uint8_t>> &&before)
+  {
+    before_ = std::move(before);
+    proving_ = true;
+  }
+
+  bool proving() const
+  {
+    return proving_;
+  }
+
+  void end_proof(const std::vector<std::vector<uint8_t>> &after)
+  {
+    proving_ = false;
+    proofs_++;
+    if (after == before_)
+    {
+      fixed_point_ = true;
+      idle_required_ = idle_threshold_;
+    }
+    else
+    {
+      proofs_failed_++;
+      idle_cycles_ = 0;
+      idle_required_ = std::min(idle_required_ * 2, kMaxIdleRequired);
+    }
+    before_.clear();
+  }
+
+  // Returns the time to continue the simulation at. This is the last point on
+  // the clock grid that is not after next_event, or main_time if the models
+  // are not known to be at a fixed point.
+  uint64_t skip(uint64_t main_time, uint64_t next_event, uint64_t cycle)
+  {
+    if (not fixed_point_ or next_event <= main_time)
+    {
+      return main_time;
+    }
+    uint64_t cycles = (next_event - main_time) / cycle;
+    stats.skipped_cycles += cycles;
+    return main_time + cycles * cycle;
+  }
+
+  void report() const
+  {
+    sim_log::LogInfo("fast-forward skipped %lu clock cycles, %lu of %lu "
+                     "state comparisons found a fixed point\n",
+                     stats.skipped_cycles, proofs_ - proofs_failed_, proofs_);
+    if (proofs_ != 0 and proofs_failed_ == proofs_)
+    {
+      sim_log::LogWarn("fast-forward: the model state changes in every idle "
+                       "cycle, e.g. because of a running PTP clock, so no "
+                       "cycles could be skipped\n");
+    }
+  }
+};
+
+/* **************************************************************************
+ * NIC instances
+ * ************************************************************************** */
+
+// File name for one of several NICs simulated by the same process, e.g.
+// trace.fst becomes trace.1.fst for the second NIC. Unchanged for a single
+// NIC.
+static std::string nic_file_path(const char *path, unsigned index,
+                                 unsigned count)
+{
+  std::string file(path);
+  if (count == 1)
+  {
+    return file;
+  }
+  size_t dot = file.rfind('.');
+  size_t slash = file.rfind('/');
+  if (dot == std::string::npos or (slash != std::string::npos and dot < slash))
+  {
+    return file + "." + std::to_string(index);
+  }
+  return file.substr(0, dot) + "." + std::to_string(index) + file.substr(dot);
+}
+
+// One Corundum model together with its SimBricks PCIe and Ethernet interfaces
+// and the handlers in between. An adapter process can simulate several of
+// these, they share the clock and the poll loop in main.
+class CorundumNic
+{
+  const unsigned index_;
+  struct SimbricksNicIf nicif_;
+  struct SimbricksBaseIfParams pcie_params_;
+  struct SimbricksBaseIfParams net_params_;
+  std::string shm_path_;
+  struct SimbricksProtoPcieDevIntro dev_intro_;
+  struct SimbricksProtoPcieHostIntro host_intro_;
+  struct SimbricksProtoNetIntro net_intro_;
+  bool sync_pci_ = false;
+  bool sync_eth_ = false;
+
+  NicStats stats_;
+  std::unique_ptr<Vmqnic_core_axi> top_;
+  WaveformTracer tracer_;
+  AxiSFromNetworkT axis_from_network_;
+  RxStagingRing rx_staging_;
+  AxiSToNetworkT axis_to_network_;
+  CorundumAXISubordinateRead dma_read_;
+  CorundumAXISubordinateWrite dma_write_;
+  CorundumAXILManager mmio_;
+  MsiInterruptHandler msi_;
+  HostControl control_;
+
+  uint64_t tx_packets_ = 0;
+  // whether a message other than a sync message was handled this cycle
+  bool msg_handled_ = false;
+
+  // models sharing the Verilator context need distinct names
+  static std::string model_name(unsigned index)
+  {
+    return index == 0 ? "TOP" : "TOP" + std::to_string(index);
+  }
+
+public:
+  explicit CorundumNic(unsigned index)
+      : index_(index),
+        top_(std::make_unique<Vmqnic_core_axi>(model_name(index).c_str())),
+        tracer_(*top_),
+        axis_from_network_{
+            top_->s_axis_rx_tvalid,
+            top_->s_axis_rx_tready,
+            reinterpret_cast<uint8_t *>(&top_->s_axis_rx_tdata),
+            &top_->s_axis_rx_tkeep,
+            top_->s_axis_rx_tlast,
+            reinterpret_cast<uint8_t *>(&top_->s_axis_rx_tuser)},
+        rx_staging_(axis_from_network_, stats_),
+        axis_to_network_{
+            top_->m_axis_tx_tvalid,
+            top_->m_axis_tx_tready,
+            reinterpret_cast<uint8_t *>(&top_->m_axis_tx_tdata),
+            &top_->m_axis_tx_tkeep,
+            top_->m_axis_tx_tlast,
+            reinterpret_cast<uint8_t *>(&top_->m_axis_tx_tuser)},
+        dma_read_(nicif_, *top_, stats_),
+        dma_write_(nicif_, *top_, stats_),
+        mmio_(nicif_, *top_, stats_),
+        msi_(nicif_, top_->irq, stats_)
+  {
+    memset(&dev_intro_, 0, sizeof(dev_intro_));
+    dev_intro_.bars[0].len = 1 << 24;
+    dev_intro_.bars[0].flags = SIMBRICKS_PROTO_PCIE_BAR_64;
+    dev_intro_.bars[kControlBar].len = kControlBarLen;
+    dev_intro_.pci_vendor_id = 0x5543;
+    dev_intro_.pci_device_id = 0x1001;
+    dev_intro_.pci_class = 0x02;
+    dev_intro_.pci_subclass = 0x00;
+    dev_intro_.pci_revision = 0x00;
+    dev_intro_.pci_msi_nvecs = 32;
+  }
+
+  // parses the PCIe and Ethernet parameters of this NIC, count is the number
+  // of NICs in this process
+  bool configure_ifs(const char *pcie_url, const char *net_url, unsigned count)
+  {
+    struct SimbricksAdapterParams *pcieAdapterParams =
+        SimbricksParametersParse(pcie_url);
+    struct SimbricksAdapterParams *netAdapterParams =
+        SimbricksParametersParse(net_url);
+
+    if (!(pcieAdapterParams && netAdapterParams))
+    {
+      fprintf(stderr, "Failed to parse PCIe or Ethernet parameters\n");
+      return false;
+    }
+
+    if (!(pcieAdapterParams->listen && netAdapterParams->listen))
+    {
+      fprintf(stderr, "Corundum Verilator currently only supports "
+                      "listening adapters\n");
+      return false;
+    }
+
+    // defaults first, the latency and sync interval of each interface are
+    // given separately and may differ
+    SimbricksNetIfDefaultParams(&net_params_);
+    SimbricksPcieIfDefaultParams(&pcie_params_);
+
+    if (pcieAdapterParams->sync_interval_set)
+      pcie_params_.sync_interval = pcieAdapterParams->sync_interval * 1000ULL;
+    if (netAdapterParams->sync_interval_set)
+      net_params_.sync_interval = netAdapterParams->sync_interval * 1000ULL;
+    if (pcieAdapterParams->link_latency_set)
+      pcie_params_.link_latency = pcieAdapterParams->link_latency * 1000ULL;
+    if (netAdapterParams->link_latency_set)
+      net_params_.link_latency = netAdapterParams->link_latency * 1000ULL;
+
+    pcie_params_.sock_path = pcieAdapterParams->socket_path;
+    net_params_.sock_path = netAdapterParams->socket_path;
+    // Since the NIC interface uses a single shared memory pool for both pcie
+    // and net interface, we just take the shm path provided for the pcie
+    // adapter here. The orchestration passes the same path to all NICs of a
+    // process, so each additional NIC gets its own pool next to it.
+    shm_path_ = pcieAdapterParams->shm_path;
+    if (count > 1)
+    {
+      shm_path_ += "." + std::to_string(index_);
+    }
+
+    pcie_params_.sync_mode = GetSyncMode(pcieAdapterParams->sync);
+    net_params_.sync_mode = GetSyncMode(netAdapterParams->sync);
+    return true;
+  }
+
+  void configure(size_t rx_ring_depth, bool rx_hold, uint64_t msi_interval,
+                 uint64_t msi_packets)
+  {
+    rx_staging_.configure(rx_ring_depth, rx_hold);
+    msi_.configure(msi_interval, msi_packets);
+  }
+
+  void configure_trace(const std::string &path, uint64_t start, uint64_t stop,
+                       int depth)
+  {
+    tracer_.configure(path, start, stop, depth);
+  }
+
+  // Creates the shared memory pool and the listening sockets of this NIC and
+  // appends both interfaces to ests. This is what SimbricksNicIfInit does,
+  // except that the connections are established for all NICs at once.
+  bool listen(std::vector<struct SimBricksBaseIfEstablishData> &ests)
+  {
+    size_t pool_size =
+        pcie_params_.in_num_entries * pcie_params_.in_entries_size +
+        pcie_params_.out_num_entries * pcie_params_.out_entries_size +
+        net_params_.in_num_entries * net_params_.in_entries_size +
+        net_params_.out_num_entries * net_params_.out_entries_size;
+    if (SimbricksBaseIfSHMPoolCreate(&nicif_.pool, shm_path_.c_str(),
+                                     pool_size))
+    {
+      sim_log::LogError("nic %u: failed to create shm pool %s\n", index_,
+                        shm_path_.c_str());
+      return false;
+    }
+
+    if (SimbricksBaseIfInit(&nicif_.pcie.base, &pcie_params_) or
+        SimbricksBaseIfListen(&nicif_.pcie.base, &nicif_.pool))
+    {
+      sim_log::LogError("nic %u: failed to listen on %s\n", index_,
+                        pcie_params_.sock_path);
+      return false;
+    }
+    if (SimbricksBaseIfInit(&nicif_.net.base, &net_params_) or
+        SimbricksBaseIfListen(&nicif_.net.base, &nicif_.pool))
+    {
+      sim_log::LogError("nic %u: failed to listen on %s\n", index_,
+                        net_params_.sock_path);
+      return false;
+    }
+
+    struct SimBricksBaseIfEstablishData est;
+    est.base_if = &nicif_.pcie.base;
+    est.tx_intro = &dev_intro_;
+    est.tx_intro_len = sizeof(dev_intro_);
+    est.rx_intro = &host_intro_;
+    est.rx_intro_len = sizeof(host_intro_);
+    ests.push_back(est);
+
+    memset(&net_intro_, 0, sizeof(net_intro_));
+    est.base_if = &nicif_.net.base;
+    est.tx_intro = &net_intro_;
+    est.tx_intro_len = sizeof(net_intro_);
+    est.rx_intro = &net_intro_;
+    est.rx_intro_len = sizeof(net_intro_);
+    ests.push_back(est);
+    return true;
+  }
+
+  // called once the connections are established
+  void connected()
+  {
+    sync_pci_ = SimbricksBaseIfSyncEnabled(&nicif_.pcie.base);
+    sync_eth_ = SimbricksBaseIfSyncEnabled(&nicif_.net.base);
+#ifdef CORUNDUM_VERILATOR_DEBUG
+    sim_log::LogInfo("nic %u: sync_pci=%d sync_eth=%d\n", index_, sync_pci_,
+                     sync_eth_);
+#endif
+  }
+
+  bool sync_enabled() const
+  {
+    return sync_pci_ and sync_eth_;
+  }
+
+  const NicStats &stats() const
+  {
+    return stats_;
+  }
+
+  HostControl &control()
+  {
+    return control_;
+  }
+
+  uint64_t sync_interval() const
+  {
+    return std::min(pcie_params_.sync_interval, net_params_.sync_interval);
+  }
+
+  void reset()
+  {
+    reset_corundum(*top_);
+    top_->rst = 1;
+    top_->tx_rst = 1;
+    top_->rx_rst = 1;
+    top_->eval();
+
+    /* raising edge */
+    top_->clk = 1;
+    top_->eval();
+    top_->rst = 0;
+    top_->tx_rst = 0;
+    top_->rx_rst = 0;
+    top_->tx_status = 1;
+    top_->rx_status = 1;
+  }
+
+  // sends sync messages to the peers if due, starts a new cycle
+  void sync_out(uint64_t main_time)
+  {
+    while (SimbricksNicIfSync(&nicif_, main_time) < 0)
+    {
       sim_log::LogWarn(
           "SimbricksPcieIfD2HOutSync or SimbricksNetIfOutSync failed (t=%lu)\n",
           main_time);
     }
+    msg_handled_ = false;
+  }
 
-    do
+  // handles at most one message per interface, returns true if further
+  // messages are due at main_time
+  bool poll(uint64_t main_time)
+  {
+    msg_handled_ |=
+        poll_h2d(nicif_, main_time, dma_read_, dma_write_, mmio_, control_);
+    if (control_.frozen())
     {
-      poll_h2d(nicif, main_time, dma_read, dma_write, mmio);
-      poll_n2d(nicif, main_time, axis_from_network);
-    } while (
-        not exiting and
-        ((sync_pci and
-          SimbricksPcieIfH2DInTimestamp(&nicif.pcie) <= main_time) or
-         (sync_eth and SimbricksNetIfInTimestamp(&nicif.net) <= main_time)));
+      // packets stay in the queue, the NIC must not receive them anymore
+      return sync_pci_ and
+             SimbricksPcieIfH2DInTimestamp(&nicif_.pcie) <= main_time;
+    }
+    msg_handled_ |= poll_n2d(nicif_, main_time, rx_staging_, stats_);
+    return (sync_pci_ and
+            SimbricksPcieIfH2DInTimestamp(&nicif_.pcie) <= main_time) or
+           (sync_eth_ and not rx_staging_.blocked() and
+            SimbricksNetIfInTimestamp(&nicif_.net) <= main_time);
+  }
 
-    /* falling edge */
-    top_verilator_interface->clk = 0;
-    top_verilator_interface->tx_clk = 0;
-    top_verilator_interface->rx_clk = 0;
-    // top_verilator_interface->ptp_clk = 0;
-    // top_verilator_interface->tx_ptp_clk = 0;
-    // top_verilator_interface->rx_ptp_clk = 0;
-    top_verilator_interface->eval();
-#ifdef CORUNDUM_VERILATOR_TRACE
-    trace->dump(main_time);
-#endif
-    main_time += clock_period / 2;
+  // timestamp of the next incoming message on either interface
+  uint64_t next_event()
+  {
+    return std::min(SimbricksPcieIfH2DInTimestamp(&nicif_.pcie),
+                    SimbricksNetIfInTimestamp(&nicif_.net));
+  }
 
-    // evaluate on rising edge
-    if (top_verilator_interface->tx_status == 0)
-      sim_log::LogInfo("corundum-verilator-nic tx_status %lu\n", top_verilator_interface->tx_status);
-    top_verilator_interface->clk = 1;
-    top_verilator_interface->tx_clk = 1;
-    top_verilator_interface->rx_clk = 1;
-    // top_verilator_interface->ptp_clk = 1;
-    // top_verilator_interface->tx_ptp_clk = 1;
-    // top_verilator_interface->rx_ptp_clk = 1;
-    dma_read.step(main_time);
-    dma_write.step(main_time);
-    mmio.step(main_time);
-    axis_from_network.step();
-    axis_to_network.step();
-    packet_d2n(nicif, main_time, axis_to_network, *top_verilator_interface);
-    msi_intr_handler.step(main_time);
-    top_verilator_interface->eval();
+  // nothing is in flight in the model or in any of the handlers
+  bool quiescent() const
+  {
+    return rx_staging_.empty() and not msi_.pending() and
+           nic_quiescent(*top_, dma_read_, dma_write_, mmio_);
+  }
+
+  // quiescent and no message arrived in this cycle
+  bool idle() const
+  {
+    return not msg_handled_ and quiescent();
+  }
+
+  void falling_edge(uint64_t main_time)
+  {
+    if (control_.frozen())
+      return;
+    top_->clk = 0;
+    top_->tx_clk = 0;
+    top_->rx_clk = 0;
+    // top_->ptp_clk = 0;
+    // top_->tx_ptp_clk = 0;
+    // top_->rx_ptp_clk = 0;
+    top_->eval();
+    tracer_.dump(main_time);
+  }
+
+  void rising_edge(uint64_t main_time)
+  {
+    if (control_.frozen())
+      return;
+    if (top_->tx_status == 0)
+      sim_log::LogInfo("corundum-verilator-nic tx_status %lu\n", top_->tx_status);
+    top_->clk = 1;
+    top_->tx_clk = 1;
+    top_->rx_clk = 1;
+    // top_->ptp_clk = 1;
+    // top_->tx_ptp_clk = 1;
+    // top_->rx_ptp_clk = 1;
+    dma_read_.step(main_time);
+    dma_write_.step(main_time);
+    mmio_.step(main_time);
+    axis_from_network_.step();
+    rx_staging_.drain();
+    axis_to_network_.step();
+    if (packet_d2n(nicif_, main_time, axis_to_network_, *top_, stats_))
+      tx_packets_++;
+    msi_.step(main_time, rx_staging_.received() + tx_packets_);
+    top_->eval();
 
     //  finalize updates
-    dma_read.step_apply();
-    dma_write.step_apply();
-    mmio.step_apply();
+    dma_read_.step_apply();
+    dma_write_.step_apply();
+    mmio_.step_apply();
+
+    tracer_.dump(main_time);
+  }
+
+#ifdef CORUNDUM_SAVABLE
+  void snapshot(std::vector<uint8_t> &data)
+  {
+    StateSnapshot os(data);
+    os << *top_;
+  }
 
-#ifdef CORUNDUM_VERILATOR_TRACE
-    trace->dump(main_time);
+  void save(VerilatedSave &os)
+  {
+    msi_.save(os);
+    os << *top_;
+  }
+
+  void restore(VerilatedRestore &is)
+  {
+    msi_.restore(is);
+    is >> *top_;
+  }
 #endif
-    main_time += clock_period / 2;
+
+  void finish(uint64_t main_time)
+  {
+    tracer_.close(main_time);
+    rx_staging_.report(index_);
+    top_->final();
   }
+};
+
+/* **************************************************************************
+ * checkpointing
+ * ************************************************************************** */
+
+// Checkpoints contain a small header followed by the state of the adapter and
+// of the Verilated model for each NIC of the process. They are only written
+// while all NICs are quiescent, so the AXI, AXI-Lite and AXI stream handlers
+// hold no pending operations and need not be saved. This also holds for the
+// checkpoint at exit: if a NIC still has operations in flight then, no
+// checkpoint is written and the adapter exits with an error.
+//
+// A host checkpoint only lines up with ours if the host requests it through
+// the control BAR right before taking its own (see HostControl). After such a
+// checkpoint the NICs are frozen; should the host still access them before it
+// saves, the two checkpoints differ and ours is removed again.
+struct CheckpointHeader
+{
+  uint64_t magic;
+  uint64_t version;
+  uint64_t main_time;
+  uint64_t clock_period;
+  uint64_t nics;
+};
+static constexpr uint64_t kCheckpointMagic = 0x43524e44434b5054ULL;
+static constexpr uint64_t kCheckpointVersion = 2;
+
+class Checkpointer
+{
+  const char *path_ = nullptr;
+  uint64_t at_ = UINT64_MAX;
+  // only the hosts' request saves, a checkpoint at another time would not
+  // line up with theirs
+  bool host_only_ = false;
+  bool done_ = false;
 
-#ifdef CORUNDUM_VERILATOR_TRACE
-  trace->dump(main_time + 1);
-  trace->close();
+public:
+  void configure(const char *path, uint64_t at, bool host_only)
+  {
+    path_ = path;
+    at_ = at;
+    host_only_ = host_only;
+  }
+
+  bool enabled() const
+  {
+    return path_ != nullptr;
+  }
+
+  // a checkpoint should be taken once the NICs are quiescent, the hosts of
+  // all NICs requesting one count like SIGUSR2
+  bool due(uint64_t time, bool host_requested) const
+  {
+    if (host_only_)
+      return path_ and not done_ and host_requested;
+    return path_ and not done_ and
+           (time >= at_ or checkpoint_requested or host_requested);
+  }
+
+  // the checkpoint has not been taken yet and has to be saved at exit, which
+  // is only possible if the NICs are quiescent by then
+  bool due_at_exit() const
+  {
+    return path_ and not done_ and not host_only_;
+  }
+
+#ifdef CORUNDUM_SAVABLE
+  bool save(std::vector<std::unique_ptr<CorundumNic>> &nics, uint64_t time,
+            uint64_t clock_period)
+  {
+    done_ = true;
+    checkpoint_requested = 0;
+
+    VerilatedSave os;
+    os.open(path_);
+    if (not os.isOpen())
+    {
+      sim_log::LogError("checkpoint: failed to open %s\n", path_);
+      return false;
+    }
+    CheckpointHeader hdr{kCheckpointMagic, kCheckpointVersion, time,
+                         clock_period, nics.size()};
+    os.write(&hdr, sizeof(hdr));
+    for (auto &nic : nics)
+    {
+      nic->save(os);
+    }
+    os.close();
+    sim_log::LogInfo("checkpoint: saved to %s at ts=%lu\n", path_, time);
+    return true;
+  }
 #endif
 
-  top_verilator_interface->final();
+  void discard()
+  {
+    std::remove(path_);
+    sim_log::LogError("checkpoint: removed %s\n", path_);
+  }
+};
+
+#ifdef CORUNDUM_SAVABLE
+static bool checkpoint_restore(const char *path,
+                               std::vector<std::unique_ptr<CorundumNic>> &nics,
+                               uint64_t &time, uint64_t clock_period)
+{
+  VerilatedRestore is;
+  is.open(path);
+  if (not is.isOpen())
+  {
+    sim_log::LogError("checkpoint: failed to open %s\n", path);
+    return false;
+  }
+
+  CheckpointHeader hdr;
+  is.read(&hdr, sizeof(hdr));
+  if (hdr.magic != kCheckpointMagic or hdr.version != kCheckpointVersion)
+  {
+    sim_log::LogError("checkpoint: %s is not a checkpoint of this adapter\n",
+                      path);
+    return false;
+  }
+  if (hdr.clock_period != clock_period)
+  {
+    sim_log::LogError("checkpoint: %s was taken with a clock period of %lu, "
+                      "not %lu\n",
+                      path, hdr.clock_period, clock_period);
+    return false;
+  }
+  if (hdr.nics != nics.size())
+  {
+    sim_log::LogError("checkpoint: %s contains %lu NICs, not %zu\n", path,
+                      hdr.nics, nics.size());
+    return false;
+  }
+  for (auto &nic : nics)
+  {
+    nic->restore(is);
+  }
+  is.close();
+
+  time = hdr.main_time;
+  sim_log::LogInfo("checkpoint: restored %s at ts=%lu\n", path, time);
+  return true;
+}
+#endif
+
+/* **************************************************************************
+ * main adapter driver
+ * ************************************************************************** */
+
+static void usage()
+{
+  fprintf(stderr,
+          "Usage: corundum_verilator [OPTIONS] PCI-PARAMS ETH-PARAMS "
+          "[PCI-PARAMS ETH-PARAMS ...]\n"
+          "                          [START-TICK] [CLOCK-FREQ-MHZ]\n"
+          "\n"
+          "Options:\n"
+          "  --nics=N            simulate N NICs in this process, each given by "
+          "a pair of\n"
+          "                      PCI-PARAMS and ETH-PARAMS (default 1)\n"
+          "  --trace=FILE        write an FST waveform to FILE, with several "
+          "NICs to\n"
+          "                      FILE with the NIC index inserted before the "
+          "extension\n"
+          "  --trace-start=TICK  start of the trace window (default 0)\n"
+          "  --trace-stop=TICK   end of the trace window (default end of "
+          "simulation)\n"
+          "  --trace-depth=N     hierarchy depth to trace (default 99)\n"
+          "  --fast-forward=N    skip clock cycles once the NIC was idle for N "
+          "cycles and\n"
+          "                      its state stopped changing, requires "
+          "synchronized PCIe\n"
+          "                      and Ethernet channels\n"
+          "  --rx-ring=N         stage up to N received packets while the NIC "
+          "is busy\n"
+          "                      instead of dropping them (default 0)\n"
+          "  --rx-hold           leave packets in the Ethernet queue once the "
+          "ring is full\n"
+          "  --stats=FILE        append counter snapshots as JSON lines to FILE "
+          "on SIGUSR1\n"
+          "                      and at exit\n"
+          "  --stats-period=SEC  additionally write a snapshot every SEC "
+          "wall-clock seconds\n"
+          "  --stats-label=LABEL include LABEL in every snapshot\n"
+          "  --msi-interval=TICK coalesce interrupts, send each vector at most "
+          "once per TICK\n"
+          "  --msi-packets=N     with --msi-interval, send pending interrupts "
+          "early once\n"
+          "                      N packets were sent or received\n"
+          "  --checkpoint=FILE   save the model state to FILE at exit, on "
+          "SIGUSR2 or at\n"
+          "                      --checkpoint-at, once all NICs are "
+          "quiescent; fails at\n"
+          "                      exit if they are not\n"
+          "  --checkpoint-at=TICK save the checkpoint at the first quiescent "
+          "cycle after TICK\n"
+          "                      the host can also request it through BAR 4, "
+          "e.g. with\n"
+          "                      corundum-checkpoint, the NICs are frozen "
+          "afterwards\n"
+          "  --checkpoint-host   only save the checkpoint when the host "
+          "requests it\n"
+          "  --restore=FILE      start from a checkpoint instead of "
+          "resetting the NIC,\n"
+          "                      a non-zero START-TICK overrides its time\n");
+}
+
+
+int main(int argc, char *argv[])
+{
+  // declarations
+  std::vector<std::unique_ptr<CorundumNic>> nics;
+  IdleFastForward fast_forward;
+  StatsDumper stats_dumper;
+  Checkpointer checkpointer;
+  uint64_t clock_period = 4 * 1000ULL; // 4ns -> 250MHz
+
+  // argument parsing and initialization
+  enum
+  {
+    kOptTrace = 256,
+    kOptTraceStart,
+    kOptTraceStop,
+    kOptTraceDepth,
+    kOptFastForward,
+    kOptRxRing,
+    kOptRxHold,
+    kOptStats,
+    kOptStatsPeriod,
+    kOptStatsLabel,
+    kOptMsiInterval,
+    kOptMsiPackets,
+    kOptCheckpoint,
+    kOptCheckpointAt,
+    kOptCheckpointHost,
+    kOptRestore,
+    kOptNics,
+  };
+  static const struct option long_opts[] = {
+      {"trace", required_argument, nullptr, kOptTrace},
+      {"trace-start", required_argument, nullptr, kOptTraceStart},
+      {"trace-stop", required_argument, nullptr, kOptTraceStop},
+      {"trace-depth", required_argument, nullptr, kOptTraceDepth},
+      {"fast-forward", required_argument, nullptr, kOptFastForward},
+      {"rx-ring", required_argument, nullptr, kOptRxRing},
+      {"rx-hold", no_argument, nullptr, kOptRxHold},
+      {"stats", required_argument, nullptr, kOptStats},
+      {"stats-period", required_argument, nullptr, kOptStatsPeriod},
+      {"stats-label", required_argument, nullptr, kOptStatsLabel},
+      {"msi-interval", required_argument, nullptr, kOptMsiInterval},
+      {"msi-packets", required_argument, nullptr, kOptMsiPackets},
+      {"checkpoint", required_argument, nullptr, kOptCheckpoint},
+      {"checkpoint-at", required_argument, nullptr, kOptCheckpointAt},
+      {"checkpoint-host", no_argument, nullptr, kOptCheckpointHost},
+      {"restore", required_argument, nullptr, kOptRestore},
+      {"nics", required_argument, nullptr, kOptNics},
+      {nullptr, 0, nullptr, 0},
+  };
+  const char *trace_path = nullptr;
+  uint64_t trace_start = 0;
+  uint64_t trace_stop = UINT64_MAX;
+  int trace_depth = 99;
+  size_t rx_ring_depth = 0;
+  bool rx_hold = false;
+  const char *stats_path = nullptr;
+  double stats_period = 0;
+  const char *stats_label = nullptr;
+  uint64_t msi_interval = 0;
+  uint64_t msi_packets = 0;
+  const char *checkpoint_path = nullptr;
+  uint64_t checkpoint_at = UINT64_MAX;
+  bool checkpoint_host = false;
+  const char *restore_path = nullptr;
+  unsigned num_nics = 1;
+  int opt;
+  while ((opt = getopt_long(argc, argv, "", long_opts, nullptr)) != -1)
+  {
+    switch (opt)
+    {
+    case kOptTrace:
+      trace_path = optarg;
+      break;
+    case kOptTraceStart:
+      trace_start = strtoull(optarg, NULL, 0);
+      break;
+    case kOptTraceStop:
+      trace_stop = strtoull(optarg, NULL, 0);
+      break;
+    case kOptTraceDepth:
+      trace_depth = static_cast<int>(strtol(optarg, NULL, 0));
+      break;
+    case kOptFastForward:
+      fast_forward.configure(strtoull(optarg, NULL, 0));
+      break;
+    case kOptRxRing:
+      rx_ring_depth = strtoull(optarg, NULL, 0);
+      break;
+    case kOptRxHold:
+      rx_hold = true;
+      break;
+    case kOptStats:
+      stats_path = optarg;
+      break;
+    case kOptStatsPeriod:
+      stats_period = strtod(optarg, NULL);
+      break;
+    case kOptStatsLabel:
+      stats_label = optarg;
+      break;
+    case kOptMsiInterval:
+      msi_interval = strtoull(optarg, NULL, 0);
+      break;
+    case kOptMsiPackets:
+      msi_packets = strtoull(optarg, NULL, 0);
+      break;
+    case kOptCheckpoint:
+      checkpoint_path = optarg;
+      break;
+    case kOptCheckpointAt:
+      checkpoint_at = strtoull(optarg, NULL, 0);
+      break;
+    case kOptCheckpointHost:
+      checkpoint_host = true;
+      break;
+    case kOptRestore:
+      restore_path = optarg;
+      break;
+    case kOptNics:
+      num_nics = static_cast<unsigned>(strtoul(optarg, NULL, 0));
+      break;
+    default:
+      usage();
+      return EXIT_FAILURE;
+    }
+  }
+
+  checkpointer.configure(checkpoint_path, checkpoint_at, checkpoint_host);
+#ifndef CORUNDUM_SAVABLE
+  if (checkpoint_path or restore_path)
+  {
+    fprintf(stderr, "This adapter was built without checkpoint support\n");
+    return EXIT_FAILURE;
+  }
+  // fast-forward compares serialized model states
+  if (fast_forward.enabled())
+  {
+    fprintf(stderr, "This adapter was built without fast-forward support\n");
+    return EXIT_FAILURE;
+  }
+#endif
+
+  // the interface parameters of all NICs come first, followed by the optional
+  // start tick and clock frequency
+  char **args = argv + optind;
+  int nargs = argc - optind;
+  int nif_args = 2 * static_cast<int>(num_nics);
+  if (num_nics == 0 || nargs < nif_args || nargs > nif_args + 2)
+  {
+    usage();
+    return EXIT_FAILURE;
+  }
+  if (nargs >= nif_args + 1)
+    main_time = strtoull(args[nif_args], NULL, 0);
+  const uint64_t start_tick = main_time;
+  if (nargs >= nif_args + 2)
+    clock_period = 1000000ULL / strtoull(args[nif_args + 1], NULL, 0);
+  // the main loop advances by two half periods per cycle
+  const uint64_t half_period = clock_period / 2;
+
+  for (unsigned i = 0; i < num_nics; i++)
+  {
+    nics.push_back(std::make_unique<CorundumNic>(i));
+    CorundumNic &nic = *nics.back();
+    if (not nic.configure_ifs(args[2 * i], args[2 * i + 1], num_nics))
+    {
+      return EXIT_FAILURE;
+    }
+    nic.configure(rx_ring_depth, rx_hold, msi_interval, msi_packets);
+  }
+
+  sim_log::Logger::GetRegistry().SetFlush(true);
+
+  // all NICs listen before waiting for any of the peers, as the orchestration
+  // only starts the peers once every socket of this simulator exists
+  std::vector<struct SimBricksBaseIfEstablishData> ests;
+  for (auto &nic : nics)
+  {
+    if (not nic->listen(ests))
+    {
+      return EXIT_FAILURE;
+    }
+  }
+  if (SimBricksBaseIfEstablish(ests.data(), ests.size()))
+  {
+    sim_log::LogError(
+        "corundum simbricks adapter SimBricksBaseIfEstablish failed\n");
+    return EXIT_FAILURE;
+  }
+
+  bool sync = true;
+  uint64_t sync_interval = UINT64_MAX;
+  for (auto &nic : nics)
+  {
+    nic->connected();
+    sync = sync and nic->sync_enabled();
+    sync_interval = std::min(sync_interval, nic->sync_interval());
+  }
+
+  // without synchronization there is no upper bound on the time of the next
+  // incoming message, so nothing can be skipped safely
+  if (fast_forward.enabled() and not sync)
+  {
+    sim_log::LogWarn(
+        "fast-forward requires synchronized PCIe and Ethernet channels, "
+        "disabling it\n");
+    fast_forward.configure(0);
+  }
+
+  signal(SIGINT, sigint_handler);
+  signal(SIGUSR1, sigusr1_handler);
+  signal(SIGUSR2, sigusr2_handler);
+
+  // opened only now so the wall-clock rates do not include waiting for peers
+  if (stats_path and not stats_dumper.open(stats_path, stats_period,
+                                               stats_label))
+  {
+    sim_log::LogError("failed to open stats file %s\n", stats_path);
+    return EXIT_FAILURE;
+  }
+  for (auto &nic : nics)
+  {
+    stats_dumper.add_nic(nic->stats());
+  }
+
+  if (trace_path)
+  {
+    // must happen before the first evaluation of the model
+    Verilated::traceEverOn(true);
+    for (unsigned i = 0; i < num_nics; i++)
+    {
+      nics[i]->configure_trace(nic_file_path(trace_path, i, num_nics),
+                               trace_start, trace_stop, trace_depth);
+    }
+  }
+
+  if (restore_path)
+  {
+#ifdef CORUNDUM_SAVABLE
+    if (not checkpoint_restore(restore_path, nics, main_time, clock_period))
+    {
+      return EXIT_FAILURE;
+    }
+#endif
+    // a start tick given on the command line takes precedence
+    if (start_tick != 0)
+      main_time = start_tick;
+  }
+  else
+  {
+    for (auto &nic : nics)
+    {
+      nic->reset();
+    }
+  }
+  if (checkpointer.enabled())
+  {
+    for (auto &nic : nics)
+    {
+      nic->control().enable();
+    }
+  }
+
+#ifdef CORUNDUM_SAVABLE
+  auto all_idle = [&]()
+  {
+    return std::all_of(nics.begin(), nics.end(),
+                       [](const auto &nic)
+                       { return nic->idle(); });
+  };
+
+  auto snapshot_all = [&]()
+  {
+    std::vector<std::vector<uint8_t>> states(nics.size());
+    for (size_t i = 0; i < nics.size(); i++)
+    {
+      nics[i]->snapshot(states[i]);
+    }
+    return states;
+  };
+#endif
+
+#ifdef CORUNDUM_VERILATOR_DEBUG
+  sim_log::LogInfo("corundum start main simulation loop\n");
+#endif
+
+  // main simulation loop
+  int status = EXIT_SUCCESS;
+  while (not exiting)
+  {
+    if (stats_requested)
+    {
+      stats_requested = 0;
+      sim_log::LogError("main_time = %lu\n", main_time);
+      stats_dumper.dump(main_time, "signal");
+    }
+    stats_dumper.poll(main_time);
+
+    for (auto &nic : nics)
+    {
+      nic->sync_out(main_time);
+    }
+
+    bool pending;
+    do
+    {
+      pending = false;
+      for (auto &nic : nics)
+      {
+        pending |= nic->poll(main_time);
+      }
+    } while (not exiting and pending);
+
+#ifdef CORUNDUM_SAVABLE
+    bool host_requested =
+        std::all_of(nics.begin(), nics.end(),
+                    [](auto &nic) { return nic->control().requested(); });
+    if (checkpointer.due(main_time, host_requested) and all_idle())
+    {
+      bool saved = checkpointer.save(nics, main_time, clock_period);
+      for (auto &nic : nics)
+      {
+        HostControl &ctrl = nic->control();
+        if (not ctrl.requested())
+        {
+          ctrl.disable();
+          continue;
+        }
+        ctrl.finish(saved);
+        if (saved)
+          ctrl.freeze();
+      }
+    }
+    if (std::any_of(nics.begin(), nics.end(),
+                    [](auto &nic) { return nic->control().diverged(); }))
+    {
+      sim_log::LogError("checkpoint: host accessed a NIC after requesting "
+                        "the checkpoint\n");
+      checkpointer.discard();
+      status = EXIT_FAILURE;
+      break;
+    }
+#endif
+
+#ifdef CORUNDUM_SAVABLE
+    if (fast_forward.enabled() and not exiting)
+    {
+      fast_forward.observe(all_idle());
+      // never skip past the next incoming message or the next point at which
+      // we owe our peers a sync message
+      uint64_t next_event = main_time + sync_interval;
+      for (auto &nic : nics)
+      {
+        next_event = std::min(next_event, nic->next_event());
+      }
+      uint64_t next_time =
+          fast_forward.skip(main_time, next_event, 2 * half_period);
+      if (next_time != main_time)
+      {
+        main_time = next_time;
+        continue;
+      }
+      if (fast_forward.wants_proof())
+      {
+        fast_forward.begin_proof(snapshot_all());
+      }
+    }
+#endif
+
+    /* falling edge */
+    for (auto &nic : nics)
+    {
+      nic->falling_edge(main_time);
+    }
+    main_time += half_period;
+
+    // evaluate on rising edge
+    for (auto &nic : nics)
+    {
+      nic->rising_edge(main_time);
+    }
+    main_time += half_period;
+    stats.cycles++;
+
+#ifdef CORUNDUM_SAVABLE
+    if (fast_forward.proving())
+    {
+      fast_forward.end_proof(snapshot_all());
+    }
+#endif
+  }
+
+#ifdef CORUNDUM_SAVABLE
+  if (checkpointer.due_at_exit())
+  {
+    // the handlers' pending operations are not part of the checkpoint, a
+    // restored run would never see them complete
+    bool quiescent = true;
+    for (size_t i = 0; i < nics.size(); i++)
+    {
+      if (not nics[i]->quiescent())
+      {
+        sim_log::LogError("checkpoint: NIC %zu is not quiescent at exit, not "
+                          "saving a checkpoint\n",
+                          i);
+        quiescent = false;
+      }
+    }
+    if (not quiescent or not checkpointer.save(nics, main_time, clock_period))
+    {
+      status = EXIT_FAILURE;
+    }
+  }
+#endif
+  stats_dumper.dump(main_time, "exit");
+  if (fast_forward.enabled())
+  {
+    fast_forward.report();
+  }
+  for (auto &nic : nics)
+  {
+    nic->finish(main_time);
+  }
 
 #ifdef CORUNDUM_VERILATOR_DEBUG
   sim_log::LogInfo("corundum simbricks adapter finished\n");
 #endif
-  return EXIT_SUCCESS;
+  return status;
 }
@@ -0,0 +1,1178 @@
+/*
+ * Copyright 2024 Max Planck Institute for Software Systems, and
+ * National University of Singapore
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining
+ * a copy of this software and associated documentation files (the
+ * "Software"), to deal in the Software without restriction, including
+ * without limitation the rights to use, copy, modify, merge, publish,
+ * distribute, sublicense, and/or sell copies of the Software, and to
+ * permit persons to whom the Software is furnished to do so, subject to
+ * the following conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+ * MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+ * IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ * CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+ * TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+ * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+
+// Light-weight stand-in peers for benchmarking the Corundum adapter without
+// booting full hosts. Depending on the first argument the binary connects to
+// the adapter either as
+//
+//   host: the PCIe host. It finds the interface's queue managers through the
+//         mqnic register block list and sets up one TX and one RX queue,
+//         each with a completion queue, in a sparse host memory. It then
+//         posts packets of a given size at a given rate on the TX queue,
+//         keeps the RX queue filled with buffers and consumes the completion
+//         records like the driver's poll loop, ringing the doorbells as it
+//         goes. It also serves the NIC's DMA reads and writes and can keep
+//         the register interface busy with additional register reads.
+//   eth:  the Ethernet peer. It sends packets of a given size at a given rate
+//         and counts the packets transmitted by the NIC.
+//
+// Both print a JSON report when they exit.
+
+#include <getopt.h>
+#include <signal.h>
+
+#include <algorithm>
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <deque>
+#include <functional>
+#include <memory>
+#include <unordered_map>
+#include <vector>
+
+extern "C"
+{
+#include <simbricks/network/if.h>
+#include <simbricks/parser/parser.h>
+#include <simbricks/pcie/if.h>
+}
+
+static volatile sig_atomic_t exiting = 0;
+static void sigint_handler(int dummy)
+{
+  exiting = 1;
+}
+
+/* **************************************************************************
+ * PCIe host peer
+ * ************************************************************************** */
+
+class HostPeer
+{
+  static constexpr uint64_t kPageSize = 4096;
+
+  // every mqnic register block starts with its type, its version and the
+  // offset of the next block in the list
+  static constexpr uint64_t kRbRegType = 0x00;
+  static constexpr uint64_t kRbRegVer = 0x04;
+  static constexpr uint64_t kRbRegNextPtr = 0x08;
+  static constexpr unsigned kMaxRegBlocks = 64;
+
+  // the register blocks the rings are set up with, all of them keep the
+  // offset of their registers or of their own block list at 0x0C
+  static constexpr uint32_t kRbTypeIf = 0x0000C000;
+  static constexpr uint32_t kRbTypePort = 0x0000C002;
+  static constexpr uint32_t kRbTypePortCtrl = 0x0000C003;
+  static constexpr uint32_t kRbTypeSchedBlock = 0x0000C004;
+  static constexpr uint32_t kRbTypeCqm = 0x0000C020;
+  static constexpr uint32_t kRbTypeTxQm = 0x0000C030;
+  static constexpr uint32_t kRbTypeRxQm = 0x0000C031;
+  static constexpr uint32_t kRbTypeSchedRr = 0x0000C040;
+  static constexpr uint64_t kRbRegOffset = 0x0C;
+  static constexpr uint64_t kRbIfRegCsrOffset = 0x18;
+  static constexpr uint64_t kRbQmRegStride = 0x14;
+  static constexpr uint64_t kRbPortCtrlRegTxCtrl = 0x10;
+  static constexpr uint64_t kRbPortCtrlRegRxCtrl = 0x14;
+  static constexpr uint64_t kRbSchedRrRegChStride = 0x14;
+  static constexpr uint64_t kRbSchedRrRegCtrl = 0x18;
+
+  // queue and completion queue managers, both are programmed through
+  // commands written to their control register
+  static constexpr uint32_t kQmVer = 0x00000400;
+  static constexpr uint64_t kQueueRegBaseAddr = 0x00;
+  static constexpr uint64_t kQueueRegCtrlStatus = 0x08;
+  static constexpr uint32_t kQueueCmdSetSize = 0x80020000;
+  static constexpr uint32_t kQueueCmdSetCqn = 0xC0000000;
+  static constexpr uint32_t kQueueCmdSetProdPtr = 0x80800000;
+  static constexpr uint32_t kQueueCmdSetConsPtr = 0x80900000;
+  static constexpr uint32_t kQueueCmdSetEnable = 0x40000100;
+  static constexpr uint32_t kQueuePtrMask = 0xFFFF;
+
+  // round-robin TX scheduler, version 0x100 takes the queue enable bits
+  // directly, version 0x200 takes commands
+  static constexpr uint32_t kSchedRrVerBits = 0x00000100;
+  static constexpr uint32_t kSchedRrVerCmds = 0x00000200;
+  static constexpr uint32_t kSchedRrCmdSetPortTc = 0x80010000;
+  static constexpr uint32_t kSchedRrCmdSetPortEnable = 0x80020000;
+  static constexpr uint32_t kSchedRrCmdSetQueueEnable = 0x40000100;
+
+  // descriptors and completion records
+  static constexpr uint64_t kDescSize = 16;
+  static constexpr uint64_t kCplSize = 32;
+  static constexpr uint64_t kCplLen = 4;
+  static constexpr uint64_t kCplPhase = 28;
+
+  // where the rings and packet buffers live in host memory
+  static constexpr uint64_t kTxRingAddr = 0x10000000;
+  static constexpr uint64_t kTxCqAddr = 0x10100000;
+  static constexpr uint64_t kRxRingAddr = 0x10200000;
+  static constexpr uint64_t kRxCqAddr = 0x10300000;
+  static constexpr uint64_t kTxBufAddr = 0x20000000;
+  static constexpr uint64_t kRxBufAddr = 0x40000000;
+  static constexpr uint32_t kRxBufSize = 16384;
+  static constexpr uint32_t kTxCqn = 0;
+  static constexpr uint32_t kRxCqn = 1;
+
+  struct RegBlock
+  {
+    uint32_t type;
+    uint32_t ver;
+    uint64_t offset;
+  };
+  using RegBlocks = std::vector<RegBlock>;
+
+  // A register access. Reads are answered in order, so the next access is
+  // only issued once the pending read completed. Accesses without a register
+  // offset only run their callback, once all accesses before them are done.
+  struct MmioOp
+  {
+    enum
+    {
+      kRead,
+      kWrite,
+      kCall
+    } kind;
+    uint64_t offset;
+    uint32_t val;
+    std::function<void(uint32_t)> done;
+  };
+
+  // A descriptor or completion ring. Pointers are free-running counters, the
+  // NIC sees their lower 16 bits.
+  struct Ring
+  {
+    uint64_t regs = 0;
+    uint64_t addr = 0;
+    uint32_t size = 0;
+    uint32_t prod = 0;
+    uint32_t cons = 0;
+    // the pointer the host owns changed since it was last written to the NIC
+    bool dirty = false;
+  };
+
+  struct SimbricksPcieIf &pcie_;
+  std::unordered_map<uint64_t, std::unique_ptr<uint8_t[]>> memory_;
+
+  std::deque<MmioOp> mmio_ops_;
+  bool mmio_pending_ = false;
+  uint64_t mmio_issued_at_ = 0;
+  uint64_t mmio_req_id_ = 0;
+
+  // interface registers found while probing the NIC
+  RegBlocks blocks_;
+  uint64_t if_base_ = 0;
+  uint64_t if_csr_offset_ = 0;
+  uint64_t cqm_offset_ = 0;
+  uint64_t cqm_stride_ = 0;
+  uint64_t txqm_offset_ = 0;
+  uint64_t txqm_stride_ = 0;
+  uint64_t rxqm_offset_ = 0;
+  uint64_t rxqm_stride_ = 0;
+  uint64_t port_offset_ = 0;
+  uint64_t sched_block_offset_ = 0;
+  uint64_t port_ctrl_ = 0;
+  uint64_t sched_rr_ = 0;
+  uint32_t sched_rr_ver_ = 0;
+  uint64_t sched_queues_ = 0;
+  uint64_t sched_stride_ = 0;
+  bool have_port_ = false;
+  bool rings_up_ = false;
+  bool failed_ = false;
+
+  Ring tx_;
+  Ring tx_cq_;
+  Ring rx_;
+  Ring rx_cq_;
+  uint32_t ring_size_;
+  uint32_t packet_size_;
+  uint64_t tx_interval_;
+  uint64_t next_tx_ = 0;
+
+  // register walk keeping the register interface busy
+  uint64_t mmio_interval_;
+  uint64_t next_mmio_ = 0;
+  size_t walk_index_ = 0;
+
+  uint64_t dma_reads_ = 0;
+  uint64_t dma_read_bytes_ = 0;
+  uint64_t dma_writes_ = 0;
+  uint64_t dma_write_bytes_ = 0;
+  uint64_t msis_ = 0;
+  uint64_t mmio_reads_ = 0;
+  uint64_t mmio_writes_ = 0;
+  uint64_t mmio_latency_ = 0;
+  uint64_t walks_ = 0;
+  uint64_t doorbells_ = 0;
+  uint64_t tx_packets_ = 0;
+  uint64_t tx_bytes_ = 0;
+  uint64_t tx_backlogged_ = 0;
+  uint64_t rx_packets_ = 0;
+  uint64_t rx_bytes_ = 0;
+
+  uint8_t *page(uint64_t addr)
+  {
+    std::unique_ptr<uint8_t[]> &page = memory_[addr / kPageSize];
+    if (not page)
+    {
+      page = std::make_unique<uint8_t[]>(kPageSize);
+    }
+    return page.get();
+  }
+
+  void mem_read(uint64_t addr, void *dst, size_t len)
+  {
+    uint8_t *d = static_cast<uint8_t *>(dst);
+    while (len > 0)
+    {
+      size_t off = addr % kPageSize;
+      size_t n = std::min(len, kPageSize - off);
+      std::memcpy(d, page(addr) + off, n);
+      addr += n;
+      d += n;
+      len -= n;
+    }
+  }
+
+  void mem_write(uint64_t addr, const void *src, size_t len)
+  {
+    const uint8_t *s = static_cast<const uint8_t *>(src);
+    while (len > 0)
+    {
+      size_t off = addr % kPageSize;
+      size_t n = std::min(len, kPageSize - off);
+      std::memcpy(page(addr) + off, s, n);
+      addr += n;
+      s += n;
+      len -= n;
+    }
+  }
+
+  volatile union SimbricksProtoPcieH2D *alloc(uint64_t now)
+  {
+    volatile union SimbricksProtoPcieH2D *msg =
+        SimbricksPcieIfH2DOutAlloc(&pcie_, now);
+    if (not msg)
+    {
+      fprintf(stderr, "host: H2D queue full\n");
+      abort();
+    }
+    return msg;
+  }
+
+  void dma_read(volatile struct SimbricksProtoPcieD2HRead &read, uint64_t now)
+  {
+    volatile union SimbricksProtoPcieH2D *msg = alloc(now);
+    volatile struct SimbricksProtoPcieH2DReadcomp *readcomp = &msg->readcomp;
+    readcomp->req_id = read.req_id;
+    mem_read(read.offset, const_cast<uint8_t *>(readcomp->data), read.len);
+    SimbricksPcieIfH2DOutSend(&pcie_, msg,
+                              SIMBRICKS_PROTO_PCIE_H2D_MSG_READCOMP);
+    dma_reads_++;
+    dma_read_bytes_ += read.len;
+  }
+
+  void dma_write(volatile struct SimbricksProtoPcieD2HWrite &write,
+                 uint64_t now)
+  {
+    mem_write(write.offset, const_cast<uint8_t *>(write.data), write.len);
+    volatile union SimbricksProtoPcieH2D *msg = alloc(now);
+    volatile struct SimbricksProtoPcieH2DWritecomp *writecomp =
+        &msg->writecomp;
+    writecomp->req_id = write.req_id;
+    SimbricksPcieIfH2DOutSend(&pcie_, msg,
+                              SIMBRICKS_PROTO_PCIE_H2D_MSG_WRITECOMP);
+    dma_writes_++;
+    dma_write_bytes_ += write.len;
+  }
+
+  /* register accesses ****************************************************/
+
+  void read(uint64_t offset, std::function<void(uint32_t)> done)
+  {
+    mmio_ops_.push_back({MmioOp::kRead, offset, 0, std::move(done)});
+  }
+
+  void write(uint64_t offset, uint32_t val)
+  {
+    mmio_ops_.push_back({MmioOp::kWrite, offset, val, nullptr});
+  }
+
+  void then(std::function<void()> done)
+  {
+    mmio_ops_.push_back(
+        {MmioOp::kCall, 0, 0, [done](uint32_t) { done(); }});
+  }
+
+  // issue queued register accesses up to the next read
+  void issue_mmio(uint64_t now)
+  {
+    while (not mmio_pending_ and not mmio_ops_.empty())
+    {
+      MmioOp &op = mmio_ops_.front();
+      if (op.kind == MmioOp::kCall)
+      {
+        std::function<void(uint32_t)> done = std::move(op.done);
+        mmio_ops_.pop_front();
+        done(0);
+        continue;
+      }
+
+      volatile union SimbricksProtoPcieH2D *msg = alloc(now);
+      if (op.kind == MmioOp::kRead)
+      {
+        volatile struct SimbricksProtoPcieH2DRead *read = &msg->read;
+        read->req_id = mmio_req_id_++;
+        read->offset = op.offset;
+        read->len = 4;
+        read->bar = 0;
+        SimbricksPcieIfH2DOutSend(&pcie_, msg,
+                                  SIMBRICKS_PROTO_PCIE_H2D_MSG_READ);
+        mmio_pending_ = true;
+        mmio_issued_at_ = now;
+        return;
+      }
+
+      // register writes are posted like on a real host, reads behind them
+      // are answered after the NIC applied them
+      volatile struct SimbricksProtoPcieH2DWrite *write = &msg->write;
+      write->req_id = mmio_req_id_++;
+      write->offset = op.offset;
+      write->len = 4;
+      write->bar = 0;
+      std::memcpy(const_cast<uint8_t *>(write->data), &op.val, 4);
+      SimbricksPcieIfH2DOutSend(&pcie_, msg,
+                                SIMBRICKS_PROTO_PCIE_H2D_MSG_WRITE_POSTED);
+      mmio_writes_++;
+      mmio_ops_.pop_front();
+    }
+  }
+
+  void mmio_done(volatile struct SimbricksProtoPcieD2HReadcomp &readcomp,
+                 uint64_t now)
+  {
+    uint32_t val = 0;
+    std::memcpy(&val, const_cast<uint8_t *>(readcomp.data), sizeof(val));
+    mmio_pending_ = false;
+    mmio_reads_++;
+    mmio_latency_ += now - mmio_issued_at_;
+
+    std::function<void(uint32_t)> done = std::move(mmio_ops_.front().done);
+    mmio_ops_.pop_front();
+    done(val);
+  }
+
+  /* probing the NIC and setting up the rings *****************************/
+
+  void fail(const char *what)
+  {
+    fprintf(stderr, "host: %s, cannot set up the queues\n", what);
+    failed_ = true;
+    exiting = 1;
+  }
+
+  // read the register block list starting at base + offset
+  void enumerate(uint64_t base, uint64_t offset,
+                 std::function<void(const RegBlocks &)> done,
+                 std::shared_ptr<RegBlocks> blocks = nullptr)
+  {
+    if (not blocks)
+    {
+      blocks = std::make_shared<RegBlocks>();
+    }
+    uint64_t addr = base + offset;
+    auto block = std::make_shared<RegBlock>(RegBlock{0, 0, addr});
+    read(addr + kRbRegType, [block](uint32_t val) { block->type = val; });
+    read(addr + kRbRegVer, [block](uint32_t val) { block->ver = val; });
+    read(addr + kRbRegNextPtr,
+         [this, base, offset, done, blocks, block](uint32_t next)
+         {
+           blocks->push_back(*block);
+           if (next == 0 or next == offset or blocks->size() >= kMaxRegBlocks)
+           {
+             done(*blocks);
+           }
+           else
+           {
+             enumerate(base, next, done, blocks);
+           }
+         });
+  }
+
+  static const RegBlock *find(const RegBlocks &blocks, uint32_t type)
+  {
+    for (const RegBlock &block : blocks)
+    {
+      if (block.type == type)
+      {
+        return &block;
+      }
+    }
+    return nullptr;
+  }
+
+  void probe()
+  {
+    enumerate(0, 0,
+              [this](const RegBlocks &blocks)
+              {
+                blocks_ = blocks;
+                for (const RegBlock &block : blocks)
+                {
+                  fprintf(stderr,
+                          "host: register block type=0x%08x ver=0x%08x at "
+                          "0x%lx\n",
+                          block.type, block.ver, block.offset);
+                }
+                const RegBlock *iface = find(blocks, kRbTypeIf);
+                if (not iface)
+                {
+                  fail("no interface register block");
+                  return;
+                }
+                read(iface->offset + kRbRegOffset,
+                     [this](uint32_t val) { if_base_ = val; });
+                read(iface->offset + kRbIfRegCsrOffset,
+                     [this](uint32_t val) { if_csr_offset_ = val; });
+                then([this]
+                     { enumerate(if_base_, if_csr_offset_,
+                                 [this](const RegBlocks &blocks)
+                                 { probe_interface(blocks); }); });
+              });
+  }
+
+  void probe_interface(const RegBlocks &blocks)
+  {
+    const RegBlock *cqm = find(blocks, kRbTypeCqm);
+    const RegBlock *txqm = find(blocks, kRbTypeTxQm);
+    const RegBlock *rxqm = find(blocks, kRbTypeRxQm);
+    const RegBlock *sched_block = find(blocks, kRbTypeSchedBlock);
+    const RegBlock *port = find(blocks, kRbTypePort);
+    if (not cqm or not txqm or not rxqm or not sched_block)
+    {
+      fail("queue managers or TX scheduler missing");
+      return;
+    }
+    for (const RegBlock *qm : {cqm, txqm, rxqm})
+    {
+      if (qm->ver != kQmVer)
+      {
+        fprintf(stderr, "host: queue manager 0x%08x has version 0x%08x\n",
+                qm->type, qm->ver);
+        fail("unsupported queue manager version");
+        return;
+      }
+    }
+
+    read(cqm->offset + kRbRegOffset, [this](uint32_t val) { cqm_offset_ = val; });
+    read(cqm->offset + kRbQmRegStride,
+         [this](uint32_t val) { cqm_stride_ = val; });
+    read(txqm->offset + kRbRegOffset,
+         [this](uint32_t val) { txqm_offset_ = val; });
+    read(txqm->offset + kRbQmRegStride,
+         [this](uint32_t val) { txqm_stride_ = val; });
+    read(rxqm->offset + kRbRegOffset,
+         [this](uint32_t val) { rxqm_offset_ = val; });
+    read(rxqm->offset + kRbQmRegStride,
+         [this](uint32_t val) { rxqm_stride_ = val; });
+    read(sched_block->offset + kRbRegOffset,
+         [this](uint32_t val) { sched_block_offset_ = val; });
+    if (port)
+    {
+      have_port_ = true;
+      read(port->offset + kRbRegOffset,
+           [this](uint32_t val) { port_offset_ = val; });
+    }
+    then([this]
+         { enumerate(if_base_, sched_block_offset_,
+                     [this](const RegBlocks &blocks)
+                     { probe_scheduler(blocks); }); });
+  }
+
+  void probe_scheduler(const RegBlocks &blocks)
+  {
+    const RegBlock *sched = find(blocks, kRbTypeSchedRr);
+    if (not sched or
+        (sched->ver != kSchedRrVerBits and sched->ver != kSchedRrVerCmds))
+    {
+      fail("no supported round-robin TX scheduler");
+      return;
+    }
+    sched_rr_ = sched->offset;
+    sched_rr_ver_ = sched->ver;
+    read(sched->offset + kRbRegOffset,
+         [this](uint32_t val) { sched_queues_ = if_base_ + val; });
+    read(sched->offset + kRbSchedRrRegChStride,
+         [this](uint32_t val) { sched_stride_ = val; });
+    if (have_port_)
+    {
+      // ports without a control block always pass packets
+      then([this]
+           { enumerate(if_base_, port_offset_,
+                       [this](const RegBlocks &blocks)
+                       {
+                         const RegBlock *ctrl = find(blocks, kRbTypePortCtrl);
+                         port_ctrl_ = ctrl ? ctrl->offset : 0;
+                         start_rings();
+                       }); });
+    }
+    else
+    {
+      then([this] { start_rings(); });
+    }
+  }
+
+  // program a queue or completion queue the way mqnic_open_cq() and
+  // mqnic_open_tx_ring() do
+  void open_ring(Ring &ring, uint64_t regs, uint64_t addr, uint32_t link)
+  {
+    ring.regs = regs;
+    ring.addr = addr;
+    ring.size = ring_size_;
+    uint32_t log_size = __builtin_ctz(ring_size_);
+    write(regs + kQueueRegCtrlStatus, kQueueCmdSetEnable | 0);
+    write(regs + kQueueRegBaseAddr, addr & 0xfffff000);
+    write(regs + kQueueRegBaseAddr + 4, addr >> 32);
+    write(regs + kQueueRegCtrlStatus, kQueueCmdSetSize | log_size);
+    // the completion queue of a queue, or the event queue of a completion
+    // queue (never armed, the host polls its completion queues)
+    write(regs + kQueueRegCtrlStatus, kQueueCmdSetCqn | link);
+    write(regs + kQueueRegCtrlStatus, kQueueCmdSetProdPtr | 0);
+    write(regs + kQueueRegCtrlStatus, kQueueCmdSetConsPtr | 0);
+    write(regs + kQueueRegCtrlStatus, kQueueCmdSetEnable | 1);
+  }
+
+  void start_rings()
+  {
+    open_ring(tx_cq_, if_base_ + cqm_offset_ + kTxCqn * cqm_stride_,
+              kTxCqAddr, 0);
+    open_ring(rx_cq_, if_base_ + cqm_offset_ + kRxCqn * cqm_stride_,
+              kRxCqAddr, 0);
+    open_ring(tx_, if_base_ + txqm_offset_, kTxRingAddr, kTxCqn);
+    open_ring(rx_, if_base_ + rxqm_offset_, kRxRingAddr, kRxCqn);
+
+    // hand all RX buffers to the NIC
+    while (rx_.prod - rx_.cons < rx_.size)
+    {
+      post_rx();
+    }
+    ring_doorbells();
+
+    // let the TX scheduler serve queue 0 on port 0
+    if (sched_rr_ver_ == kSchedRrVerBits)
+    {
+      write(sched_queues_, 3);
+    }
+    else
+    {
+      write(sched_queues_, kSchedRrCmdSetPortTc | (0 << 8) | 0);
+      write(sched_queues_, kSchedRrCmdSetPortEnable | (0 << 8) | 1);
+      write(sched_queues_, kSchedRrCmdSetQueueEnable | 1);
+    }
+    write(sched_rr_ + kRbSchedRrRegCtrl, 1);
+
+    if (port_ctrl_)
+    {
+      write(port_ctrl_ + kRbPortCtrlRegTxCtrl, 1);
+      write(port_ctrl_ + kRbPortCtrlRegRxCtrl, 1);
+    }
+
+    then([this]
+         {
+           fprintf(stderr, "host: %u entry TX and RX rings set up\n",
+                   ring_size_);
+           rings_up_ = true;
+         });
+  }
+
+  /* datapath ***************************************************************/
+
+  void post(Ring &ring, uint64_t buf, uint32_t len)
+  {
+    uint8_t desc[kDescSize] = {};
+    std::memcpy(desc + 4, &len, sizeof(len));
+    std::memcpy(desc + 8, &buf, sizeof(buf));
+    mem_write(ring.addr + (ring.prod & (ring.size - 1)) * kDescSize, desc,
+              sizeof(desc));
+    ring.prod++;
+    ring.dirty = true;
+  }
+
+  void post_rx()
+  {
+    post(rx_, kRxBufAddr + (rx_.prod & (rx_.size - 1)) * kRxBufSize,
+         kRxBufSize);
+  }
+
+  // Consume the completion records the NIC wrote to a completion queue. A
+  // record is valid while its phase bit differs from the lap of the
+  // consumer pointer.
+  template <typename F>
+  void reap(Ring &cq, F handle)
+  {
+    while (true)
+    {
+      uint64_t cpl = cq.addr + (cq.cons & (cq.size - 1)) * kCplSize;
+      uint32_t phase = 0;
+      mem_read(cpl + kCplPhase, &phase, sizeof(phase));
+      if (((phase >> 31) != 0) == ((cq.cons & cq.size) != 0))
+      {
+        return;
+      }
+      uint16_t len = 0;
+      mem_read(cpl + kCplLen, &len, sizeof(len));
+      handle(len);
+      cq.cons++;
+      cq.dirty = true;
+    }
+  }
+
+  void ring_doorbells()
+  {
+    // new descriptors first, then free completion records
+    for (Ring *ring : {&tx_, &rx_})
+    {
+      if (ring->dirty)
+      {
+        write(ring->regs + kQueueRegCtrlStatus,
+              kQueueCmdSetProdPtr | (ring->prod & kQueuePtrMask));
+        ring->dirty = false;
+        doorbells_++;
+      }
+    }
+    for (Ring *cq : {&tx_cq_, &rx_cq_})
+    {
+      if (cq->dirty)
+      {
+        write(cq->regs + kQueueRegCtrlStatus,
+              kQueueCmdSetConsPtr | (cq->cons & kQueuePtrMask));
+        cq->dirty = false;
+      }
+    }
+  }
+
+  void datapath(uint64_t now)
+  {
+    reap(tx_cq_,
+         [this](uint16_t len)
+         {
+           tx_.cons++;
+           tx_packets_++;
+           tx_bytes_ += packet_size_;
+         });
+    reap(rx_cq_,
+         [this](uint16_t len)
+         {
+           rx_.cons++;
+           rx_packets_++;
+           rx_bytes_ += len;
+           post_rx();
+         });
+
+    while (tx_interval_ != 0 and next_tx_ <= now)
+    {
+      if (tx_.prod - tx_.cons >= tx_.size)
+      {
+        // the NIC does not keep up, try again later
+        tx_backlogged_++;
+        break;
+      }
+      post(tx_, kTxBufAddr, packet_size_);
+      next_tx_ += tx_interval_;
+    }
+
+    ring_doorbells();
+  }
+
+  void walk_step(uint64_t now)
+  {
+    const RegBlock &block = blocks_[walk_index_++];
+    if (walk_index_ == blocks_.size())
+    {
+      walk_index_ = 0;
+      walks_++;
+    }
+    read(block.offset + kRbRegType, [](uint32_t) {});
+    next_mmio_ = now + mmio_interval_;
+  }
+
+public:
+  HostPeer(struct SimbricksPcieIf &pcie, uint64_t mmio_interval,
+           uint32_t ring_size, uint32_t packet_size, uint64_t tx_interval)
+      : pcie_(pcie),
+        ring_size_(ring_size),
+        packet_size_(packet_size),
+        tx_interval_(tx_interval),
+        mmio_interval_(mmio_interval)
+  {
+    // broadcast frame with the local experimental ethertype
+    std::vector<uint8_t> frame(packet_size, 0);
+    std::fill_n(frame.begin(), 6, 0xff);
+    const uint8_t src[6] = {0x02, 0x00, 0x00, 0x00, 0x00, 0x02};
+    std::copy_n(src, 6, frame.begin() + 6);
+    frame[12] = 0x88;
+    frame[13] = 0xb5;
+    mem_write(kTxBufAddr, frame.data(), frame.size());
+
+    probe();
+  }
+
+  bool failed() const
+  {
+    return failed_;
+  }
+
+  uint64_t next_event() const
+  {
+    uint64_t next = UINT64_MAX;
+    if (rings_up_ and tx_interval_ != 0 and tx_.prod - tx_.cons < tx_.size)
+    {
+      next = next_tx_;
+    }
+    if (rings_up_ and mmio_interval_ != 0 and not mmio_pending_)
+    {
+      next = std::min(next, next_mmio_);
+    }
+    return next;
+  }
+
+  void step(uint64_t now)
+  {
+    if (rings_up_)
+    {
+      datapath(now);
+      if (mmio_interval_ != 0 and not mmio_pending_ and next_mmio_ <= now)
+      {
+        walk_step(now);
+      }
+    }
+    issue_mmio(now);
+  }
+
+  bool poll(uint64_t now)
+  {
+    volatile union SimbricksProtoPcieD2H *msg =
+        SimbricksPcieIfD2HInPoll(&pcie_, now);
+    if (not msg)
+    {
+      return false;
+    }
+
+    uint8_t type = SimbricksPcieIfD2HInType(&pcie_, msg);
+    switch (type)
+    {
+    case SIMBRICKS_PROTO_PCIE_D2H_MSG_READ:
+      dma_read(msg->read, now);
+      break;
+    case SIMBRICKS_PROTO_PCIE_D2H_MSG_WRITE:
+      dma_write(msg->write, now);
+      break;
+    case SIMBRICKS_PROTO_PCIE_D2H_MSG_INTERRUPT:
+      msis_++;
+      break;
+    case SIMBRICKS_PROTO_PCIE_D2H_MSG_READCOMP:
+      mmio_done(msg->readcomp, now);
+      break;
+    case SIMBRICKS_PROTO_PCIE_D2H_MSG_WRITECOMP:
+    case SIMBRICKS_PROTO_MSG_TYPE_SYNC:
+      break;
+    default:
+      fprintf(stderr, "host: unsupported type=%d\n", type);
+    }
+
+    SimbricksPcieIfD2HInDone(&pcie_, msg);
+    return true;
+  }
+
+  uint64_t in_timestamp()
+  {
+    return SimbricksPcieIfD2HInTimestamp(&pcie_);
+  }
+
+  int sync(uint64_t now)
+  {
+    return SimbricksPcieIfH2DOutSync(&pcie_, now);
+  }
+
+  void report(FILE *out) const
+  {
+    fprintf(out,
+            "\"rings_up\":%s,\"tx_packets\":%lu,\"tx_bytes\":%lu,"
+            "\"tx_backlogged\":%lu,\"rx_packets\":%lu,\"rx_bytes\":%lu,"
+            "\"doorbells\":%lu,\"dma_reads\":%lu,\"dma_read_bytes\":%lu,"
+            "\"dma_writes\":%lu,\"dma_write_bytes\":%lu,\"msis\":%lu,"
+            "\"mmio_reads\":%lu,\"mmio_writes\":%lu,"
+            "\"mmio_latency_avg\":%.1f,\"register_walks\":%lu",
+            rings_up_ ? "true" : "false", tx_packets_, tx_bytes_,
+            tx_backlogged_, rx_packets_, rx_bytes_, doorbells_, dma_reads_,
+            dma_read_bytes_, dma_writes_, dma_write_bytes_, msis_, mmio_reads_,
+            mmio_writes_,
+            mmio_reads_ ? static_cast<double>(mmio_latency_) / mmio_reads_
+                        : 0.0,
+            walks_);
+  }
+};
+
+/* **************************************************************************
+ * Ethernet peer
+ * ************************************************************************** */
+
+class EthPeer
+{
+  struct SimbricksNetIf &net_;
+  std::vector<uint8_t> packet_;
+  uint64_t interval_;
+  uint64_t next_tx_ = 0;
+
+  uint64_t tx_packets_ = 0;
+  uint64_t tx_bytes_ = 0;
+  uint64_t tx_backlogged_ = 0;
+  uint64_t rx_packets_ = 0;
+  uint64_t rx_bytes_ = 0;
+
+public:
+  EthPeer(struct SimbricksNetIf &net, size_t packet_len, uint64_t interval)
+      : net_(net), packet_(packet_len), interval_(interval)
+  {
+    // broadcast frame with the local experimental ethertype
+    std::fill_n(packet_.begin(), 6, 0xff);
+    const uint8_t src[6] = {0x02, 0x00, 0x00, 0x00, 0x00, 0x01};
+    std::copy_n(src, 6, packet_.begin() + 6);
+    packet_[12] = 0x88;
+    packet_[13] = 0xb5;
+  }
+
+  uint64_t next_event() const
+  {
+    return interval_ == 0 ? UINT64_MAX : next_tx_;
+  }
+
+  void step(uint64_t now)
+  {
+    while (next_event() <= now)
+    {
+      volatile union SimbricksProtoNetMsg *msg =
+          SimbricksNetIfOutAlloc(&net_, now);
+      if (not msg)
+      {
+        // the adapter does not keep up, try again later
+        tx_backlogged_++;
+        return;
+      }
+
+      volatile struct SimbricksProtoNetMsgPacket *packet = &msg->packet;
+      std::memcpy(&packet_[14], &tx_packets_, sizeof(tx_packets_));
+      std::memcpy(const_cast<uint8_t *>(packet->data), packet_.data(),
+                  packet_.size());
+      packet->len = packet_.size();
+      packet->port = 0;
+      SimbricksNetIfOutSend(&net_, msg, SIMBRICKS_PROTO_NET_MSG_PACKET);
+      tx_packets_++;
+      tx_bytes_ += packet_.size();
+      next_tx_ += interval_;
+    }
+  }
+
+  bool poll(uint64_t now)
+  {
+    volatile union SimbricksProtoNetMsg *msg =
+        SimbricksNetIfInPoll(&net_, now);
+    if (not msg)
+    {
+      return false;
+    }
+
+    uint8_t type = SimbricksNetIfInType(&net_, msg);
+    if (type == SIMBRICKS_PROTO_NET_MSG_PACKET)
+    {
+      rx_packets_++;
+      rx_bytes_ += msg->packet.len;
+    }
+    else if (type != SIMBRICKS_PROTO_MSG_TYPE_SYNC)
+    {
+      fprintf(stderr, "eth: unsupported type=%d\n", type);
+    }
+
+    SimbricksNetIfInDone(&net_, msg);
+    return true;
+  }
+
+  uint64_t in_timestamp()
+  {
+    return SimbricksNetIfInTimestamp(&net_);
+  }
+
+  int sync(uint64_t now)
+  {
+    return SimbricksNetIfOutSync(&net_, now);
+  }
+
+  void report(FILE *out) const
+  {
+    fprintf(out,
+            "\"tx_packets\":%lu,\"tx_bytes\":%lu,\"tx_backlogged\":%lu,"
+            "\"rx_packets\":%lu,\"rx_bytes\":%lu",
+            tx_packets_, tx_bytes_, tx_backlogged_, rx_packets_, rx_bytes_);
+  }
+};
+
+/* **************************************************************************
+ * main loop
+ * ************************************************************************** */
+
+// Runs a peer until the simulated time reaches duration (0 runs until
+// SIGINT). With synchronization the peer only advances up to the timestamp of
+// the next incoming message, without it runs freely.
+template <typename Peer>
+static uint64_t run(Peer &peer, bool sync, uint64_t sync_interval,
+                    uint64_t duration)
+{
+  uint64_t now = 0;
+  while (not exiting and (duration == 0 or now < duration))
+  {
+    if (peer.sync(now) < 0)
+    {
+      fprintf(stderr, "sync failed (t=%lu)\n", now);
+    }
+
+    do
+    {
+      while (peer.poll(now))
+      {
+      }
+    } while (not exiting and sync and peer.in_timestamp() <= now);
+
+    peer.step(now);
+
+    uint64_t next = std::min(peer.next_event(), now + sync_interval);
+    if (sync)
+    {
+      next = std::min(next, peer.in_timestamp());
+    }
+    now = std::max(next, now + 1);
+  }
+  return now;
+}
+
+static void usage()
+{
+  fprintf(stderr,
+          "Usage: corundum_bench_peer [OPTIONS] host|eth PARAMS\n"
+          "\n"
+          "PARAMS are SimBricks adapter parameters, e.g.\n"
+          "connect:SOCKET:sync=true:latency=500:sync_interval=500\n"
+          "\n"
+          "Options:\n"
+          "  --duration=TICK       stop at this simulated time in ps "
+          "(default: run until SIGINT)\n"
+          "  --report=FILE         write the JSON report to FILE instead of "
+          "stdout\n"
+          "  --mmio-interval=TICK  host: ps between additional register "
+          "reads, 0 disables them (default 1000000)\n"
+          "  --ring-size=N         host: entries of the TX, RX and completion "
+          "rings, a power of two (default 256)\n"
+          "  --packet-size=BYTES   frame size (default 1500)\n"
+          "  --rate=GBPS           offered load, 0 disables the source "
+          "(default 10)\n");
+}
+
+int main(int argc, char *argv[])
+{
+  enum
+  {
+    kOptDuration = 256,
+    kOptReport,
+    kOptMmioInterval,
+    kOptRingSize,
+    kOptPacketSize,
+    kOptRate,
+  };
+  static const struct option long_opts[] = {
+      {"duration", required_argument, nullptr, kOptDuration},
+      {"report", required_argument, nullptr, kOptReport},
+      {"mmio-interval", required_argument, nullptr, kOptMmioInterval},
+      {"ring-size", required_argument, nullptr, kOptRingSize},
+      {"packet-size", required_argument, nullptr, kOptPacketSize},
+      {"rate", required_argument, nullptr, kOptRate},
+      {nullptr, 0, nullptr, 0},
+  };
+  uint64_t duration = 0;
+  const char *report_path = nullptr;
+  uint64_t mmio_interval = 1000000;
+  uint32_t ring_size = 256;
+  size_t packet_size = 1500;
+  double rate = 10;
+  int opt;
+  while ((opt = getopt_long(argc, argv, "", long_opts, nullptr)) != -1)
+  {
+    switch (opt)
+    {
+    case kOptDuration:
+      duration = strtoull(optarg, NULL, 0);
+      break;
+    case kOptReport:
+      report_path = optarg;
+      break;
+    case kOptMmioInterval:
+      mmio_interval = strtoull(optarg, NULL, 0);
+      break;
+    case kOptRingSize:
+      ring_size = strtoul(optarg, NULL, 0);
+      break;
+    case kOptPacketSize:
+      packet_size = strtoull(optarg, NULL, 0);
+      break;
+    case kOptRate:
+      rate = strtod(optarg, NULL);
+      break;
+    default:
+      usage();
+      return EXIT_FAILURE;
+    }
+  }
+
+  // the queue pointers are 16 bits wide and carry the lap in their top bit
+  if (argc - optind != 2 or packet_size < 64 or packet_size > 9000 or
+      ring_size < 2 or ring_size > 32768 or (ring_size & (ring_size - 1)))
+  {
+    usage();
+    return EXIT_FAILURE;
+  }
+  bool is_host = strcmp(argv[optind], "host") == 0;
+  if (not is_host and strcmp(argv[optind], "eth") != 0)
+  {
+    usage();
+    return EXIT_FAILURE;
+  }
+
+  struct SimbricksAdapterParams *adapter_params =
+      SimbricksParametersParse(argv[optind + 1]);
+  if (not adapter_params or adapter_params->listen)
+  {
+    fprintf(stderr, "Failed to parse parameters, expected a connecting "
+                    "adapter\n");
+    return EXIT_FAILURE;
+  }
+
+  struct SimbricksBaseIfParams params;
+  if (is_host)
+    SimbricksPcieIfDefaultParams(&params);
+  else
+    SimbricksNetIfDefaultParams(&params);
+  if (adapter_params->sync_interval_set)
+    params.sync_interval = adapter_params->sync_interval * 1000ULL;
+  if (adapter_params->link_latency_set)
+    params.link_latency = adapter_params->link_latency * 1000ULL;
+  params.sock_path = adapter_params->socket_path;
+  params.sync_mode = adapter_params->sync ? kSimbricksBaseIfSyncRequired
+                                          : kSimbricksBaseIfSyncDisabled;
+  params.blocking_conn = true;
+
+  struct SimbricksPcieIf pcie;
+  struct SimbricksNetIf net;
+  struct SimbricksBaseIf *base = is_host ? &pcie.base : &net.base;
+  if (SimbricksBaseIfInit(base, &params) or SimbricksBaseIfConnect(base))
+  {
+    fprintf(stderr, "Failed to connect to %s\n", params.sock_path);
+    return EXIT_FAILURE;
+  }
+
+  struct SimbricksProtoPcieHostIntro host_intro;
+  struct SimbricksProtoPcieDevIntro dev_intro;
+  struct SimbricksProtoNetIntro net_intro;
+  struct SimbricksProtoNetIntro peer_net_intro;
+  memset(&host_intro, 0, sizeof(host_intro));
+  memset(&net_intro, 0, sizeof(net_intro));
+  struct SimBricksBaseIfEstablishData est;
+  est.base_if = base;
+  if (is_host)
+  {
+    est.tx_intro = &host_intro;
+    est.tx_intro_len = sizeof(host_intro);
+    est.rx_intro = &dev_intro;
+    est.rx_intro_len = sizeof(dev_intro);
+  }
+  else
+  {
+    est.tx_intro = &net_intro;
+    est.tx_intro_len = sizeof(net_intro);
+    est.rx_intro = &peer_net_intro;
+    est.rx_intro_len = sizeof(peer_net_intro);
+  }
+  if (SimBricksBaseIfEstablish(&est, 1))
+  {
+    fprintf(stderr, "Failed to establish connection\n");
+    return EXIT_FAILURE;
+  }
+  bool sync = SimbricksBaseIfSyncEnabled(base);
+
+  signal(SIGINT, sigint_handler);
+  signal(SIGTERM, sigint_handler);
+
+  auto start = std::chrono::steady_clock::now();
+  uint64_t end_time;
+  FILE *out = report_path ? fopen(report_path, "w") : stdout;
+  if (not out)
+  {
+    fprintf(stderr, "Failed to open report file %s\n", report_path);
+    return EXIT_FAILURE;
+  }
+
+  // bits / Gbps gives ns, the peers count in ps
+  uint64_t interval =
+      rate > 0 ? static_cast<uint64_t>(packet_size * 8 * 1000 / rate) : 0;
+  bool failed = false;
+  if (is_host)
+  {
+    HostPeer peer{pcie, mmio_interval, ring_size,
+                  static_cast<uint32_t>(packet_size), interval};
+    end_time = run(peer, sync, params.sync_interval, duration);
+    double wall = std::chrono::duration<double>(
+                      std::chrono::steady_clock::now() - start)
+                      .count();
+    fprintf(out, "{\"peer\":\"host\",\"sim_time\":%lu,\"wall_time\":%.3f,",
+            end_time, wall);
+    peer.report(out);
+    failed = peer.failed();
+  }
+  else
+  {
+    EthPeer peer{net, packet_size, interval};
+    end_time = run(peer, sync, params.sync_interval, duration);
+    double wall = std::chrono::duration<double>(
+                      std::chrono::steady_clock::now() - start)
+                      .count();
+    fprintf(out, "{\"peer\":\"eth\",\"sim_time\":%lu,\"wall_time\":%.3f,",
+            end_time, wall);
+    peer.report(out);
+  }
+  fputs("}\n", out);
+  if (out != stdout)
+  {
+    fclose(out);
+  }
+  return failed ? EXIT_FAILURE : EXIT_SUCCESS;
+}
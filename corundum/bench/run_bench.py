@@ -0,0 +1,243 @@
+# Copyright 2021 Max Planck Institute for Software Systems, and
+# National University of Singapore
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Benchmark the Corundum adapter on its own. The adapter is connected to the
+stand-in PCIe host and Ethernet peers from `corundum_bench_peer.cpp` (build
+both with `make adapter bench`) instead of full host simulators, once with
+synchronized and once with unsynchronized channels.
+
+Example:
+
+    python3 bench/run_bench.py --duration-us 200 --wall-time 30
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import pathlib
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = pathlib.Path(__file__).resolve().parent
+
+
+def params(mode: str, sock: pathlib.Path, shm: pathlib.Path | None, sync: bool,
+           latency: int, sync_interval: int) -> str:
+    path = f"{sock}:{shm}" if shm is not None else f"{sock}"
+    return (
+        f"{mode}:{path}:sync={'true' if sync else 'false'}"
+        f":latency={latency}:sync_interval={sync_interval}"
+    )
+
+
+def wait_for(path: pathlib.Path, proc: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while not path.exists():
+        if proc.poll() is not None:
+            raise RuntimeError(f"adapter exited with {proc.returncode}")
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"{path} did not show up")
+        time.sleep(0.1)
+
+
+def stop(proc: subprocess.Popen, timeout: float = 30) -> None:
+    if proc.poll() is None:
+        proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def run_mode(args: argparse.Namespace, sync: bool, work_dir: pathlib.Path) -> dict:
+    work_dir.mkdir(parents=True, exist_ok=True)
+    pci_sock = work_dir / "pci"
+    eth_sock = work_dir / "eth"
+    shm = work_dir / "shm"
+    stats = work_dir / "adapter-stats.json"
+    for p in (pci_sock, eth_sock, shm, stats):
+        p.unlink(missing_ok=True)
+    eth_latency = args.eth_latency or args.latency
+    eth_sync_interval = args.eth_sync_interval or args.sync_interval
+
+    adapter_cmd = [
+        args.adapter,
+        f"--stats={stats}",
+        *args.adapter_arg,
+        params("listen", pci_sock, shm, sync, args.latency, args.sync_interval),
+        params("listen", eth_sock, shm, sync, eth_latency, eth_sync_interval),
+        "0",
+        str(args.clock_freq),
+    ]
+    # the peers stop on their own after the simulated duration when
+    # synchronized, otherwise they are stopped after the wall-clock limit
+    duration = args.duration_us * 1000 * 1000 if sync else 0
+    peer_cmd = [args.peer, f"--duration={duration}"]
+    host_cmd = peer_cmd + [
+        f"--report={work_dir / 'host.json'}",
+        f"--mmio-interval={args.mmio_interval}",
+        f"--ring-size={args.ring_size}",
+        f"--packet-size={args.packet_size}",
+        f"--rate={args.tx_rate}",
+        "host",
+        params("connect", pci_sock, None, sync, args.latency, args.sync_interval),
+    ]
+    eth_cmd = peer_cmd + [
+        f"--report={work_dir / 'eth.json'}",
+        f"--packet-size={args.packet_size}",
+        f"--rate={args.rate}",
+        "eth",
+        params("connect", eth_sock, None, sync, eth_latency, eth_sync_interval),
+    ]
+
+    with open(work_dir / "adapter.log", "w") as log:
+        adapter = subprocess.Popen(adapter_cmd, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            wait_for(pci_sock, adapter)
+            wait_for(eth_sock, adapter)
+            peers = [
+                subprocess.Popen(host_cmd, stderr=log),
+                subprocess.Popen(eth_cmd, stderr=log),
+            ]
+            if sync:
+                deadline = time.monotonic() + args.wall_time
+                for peer in peers:
+                    peer.wait(max(deadline - time.monotonic(), 0.1))
+            else:
+                time.sleep(args.wall_time)
+            for peer in peers:
+                stop(peer)
+        finally:
+            stop(adapter)
+
+    snapshots = [json.loads(line) for line in stats.read_text().splitlines() if line]
+    adapter_stats = snapshots[-1]
+    host = json.loads((work_dir / "host.json").read_text())
+    if not host["rings_up"]:
+        raise RuntimeError(
+            f"host stand-in could not set up the queues, see {log.name}"
+        )
+    eth = json.loads((work_dir / "eth.json").read_text())
+    wall = adapter_stats["wall_time"]
+    return {
+        "mode": "sync" if sync else "unsync",
+        "wall_time": wall,
+        "sim_time": adapter_stats["main_time"],
+        "cycles_per_second": adapter_stats["cycles_per_second_avg"],
+        "rx_packets_per_second": adapter_stats["rx_packets"] / wall,
+        "tx_packets_per_second": adapter_stats["tx_packets"] / wall,
+        "dma_bytes_per_second": (
+            adapter_stats["dma_read_bytes"] + adapter_stats["dma_write_bytes"]
+        ) / wall,
+        "mmio_reads_per_second": host["mmio_reads"] / wall,
+        "rx_dropped": adapter_stats["rx_dropped"],
+        "adapter": adapter_stats,
+        "host": host,
+        "eth": eth,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--adapter",
+        default=str(BENCH_DIR.parent / "adapter" / "corundum_simbricks_adapter"),
+    )
+    parser.add_argument("--peer", default=str(BENCH_DIR / "corundum_bench_peer"))
+    parser.add_argument(
+        "--adapter-arg",
+        action="append",
+        default=[],
+        help="additional adapter option, e.g. --adapter-arg=--rx-ring=64",
+    )
+    parser.add_argument("--modes", default="sync,unsync")
+    parser.add_argument(
+        "--duration-us", type=int, default=100, help="simulated time when synchronized"
+    )
+    parser.add_argument(
+        "--wall-time",
+        type=float,
+        default=30,
+        help="wall-clock limit in seconds, also the run time when unsynchronized",
+    )
+    parser.add_argument("--packet-size", type=int, default=1500)
+    parser.add_argument(
+        "--rate", type=float, default=10, help="offered RX load in Gbps, 0 disables it"
+    )
+    parser.add_argument(
+        "--tx-rate", type=float, default=10, help="offered TX load in Gbps, 0 disables it"
+    )
+    parser.add_argument(
+        "--ring-size", type=int, default=256, help="entries of the host's rings"
+    )
+    parser.add_argument(
+        "--mmio-interval",
+        type=int,
+        default=1000000,
+        help="ps between additional register reads",
+    )
+    parser.add_argument("--latency", type=int, default=500, help="link latency in ns")
+    parser.add_argument("--sync-interval", type=int, default=500, help="in ns")
+    parser.add_argument(
+        "--eth-latency", type=int, help="Ethernet link latency in ns (default --latency)"
+    )
+    parser.add_argument(
+        "--eth-sync-interval", type=int,
+        help="Ethernet sync interval in ns (default --sync-interval)",
+    )
+    parser.add_argument("--clock-freq", type=int, default=250, help="in MHz")
+    parser.add_argument("--work-dir", type=pathlib.Path)
+    parser.add_argument("--json", type=pathlib.Path, help="write the results here")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or pathlib.Path(tempfile.mkdtemp(prefix="corundum-bench-"))
+    results = []
+    for mode in args.modes.split(","):
+        if mode not in ("sync", "unsync"):
+            parser.error(f"unknown mode {mode}")
+        results.append(run_mode(args, mode == "sync", work_dir / mode))
+
+    print(
+        f"{'mode':8} {'wall s':>8} {'cycles/s':>12} {'rx pkt/s':>10} "
+        f"{'tx pkt/s':>10} {'DMA MB/s':>10} {'mmio/s':>10} {'dropped':>8}"
+    )
+    for r in results:
+        print(
+            f"{r['mode']:8} {r['wall_time']:8.2f} {r['cycles_per_second']:12.0f} "
+            f"{r['rx_packets_per_second']:10.0f} {r['tx_packets_per_second']:10.0f} "
+            f"{r['dma_bytes_per_second'] / 1e6:10.2f} "
+            f"{r['mmio_reads_per_second']:10.0f} {r['rx_dropped']:8}"
+        )
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2))
+    print(f"logs and reports in {work_dir}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
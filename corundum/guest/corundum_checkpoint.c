@@ -0,0 +1,184 @@
+/*
+ * Copyright 2024 Max Planck Institute for Software Systems, and
+ * National University of Singapore
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining
+ * a copy of this software and associated documentation files (the
+ * "Software"), to deal in the Software without restriction, including
+ * without limitation the rights to use, copy, modify, merge, publish,
+ * distribute, sublicense, and/or sell copies of the Software, and to
+ * permit persons to whom the Software is furnished to do so, subject to
+ * the following conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+ * MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+ * IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ * CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+ * TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+ * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+// Runs in the simulated host right before it takes its own checkpoint and asks
+// the Corundum adapter to save the NIC state at the same point. It requests a
+// checkpoint through the adapter's control BAR (BAR 4) of every Corundum NIC
+// and waits until the adapter has saved it. The host must not access the NICs
+// afterwards, the adapter no longer simulates them. Exits with an error if a
+// NIC does not support checkpoints or saving failed.
+//
+// usage: corundum-checkpoint [TIMEOUT-SECONDS]
+
+#include <dirent.h>
+#include <fcntl.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <time.h>
+#include <unistd.h>
+
+#define PCI_DEVICES "/sys/bus/pci/devices"
+#define CORUNDUM_VENDOR 0x5543
+#define CORUNDUM_DEVICE 0x1001
+#define CONTROL_LEN 4096
+#define MAX_NICS 16
+
+// must match HostControl in the adapter
+#define CONTROL_CHECKPOINT 0x0
+enum status
+{
+  kDisabled = 0,
+  kIdle = 1,
+  kPending = 2,
+  kSaved = 3,
+  kFailed = 4,
+};
+
+struct nic
+{
+  char name[256];
+  volatile uint32_t *regs;
+};
+
+static unsigned read_id(const char *dev, const char *attr)
+{
+  char path[512];
+  snprintf(path, sizeof(path), PCI_DEVICES "/%s/%s", dev, attr);
+  FILE *f = fopen(path, "r");
+  if (!f)
+    return 0;
+  unsigned id = 0;
+  if (fscanf(f, "%x", &id) != 1)
+    id = 0;
+  fclose(f);
+  return id;
+}
+
+static int map_control(struct nic *nic)
+{
+  char path[512];
+  snprintf(path, sizeof(path), PCI_DEVICES "/%s/enable", nic->name);
+  int fd = open(path, O_WRONLY);
+  if (fd < 0 || write(fd, "1", 1) != 1)
+  {
+    perror("enabling device failed");
+    return -1;
+  }
+  close(fd);
+
+  snprintf(path, sizeof(path), PCI_DEVICES "/%s/resource4", nic->name);
+  fd = open(path, O_RDWR | O_SYNC);
+  if (fd < 0)
+  {
+    perror("opening control BAR failed");
+    return -1;
+  }
+  void *p = mmap(NULL, CONTROL_LEN, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+  close(fd);
+  if (p == MAP_FAILED)
+  {
+    perror("mapping control BAR failed");
+    return -1;
+  }
+  nic->regs = p;
+  return 0;
+}
+
+static double now(void)
+{
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec + ts.tv_nsec / 1e9;
+}
+
+int main(int argc, char *argv[])
+{
+  double timeout = argc > 1 ? atof(argv[1]) : 60;
+
+  struct nic nics[MAX_NICS];
+  int num_nics = 0;
+  DIR *dir = opendir(PCI_DEVICES);
+  if (!dir)
+  {
+    perror("opendir " PCI_DEVICES " failed");
+    return EXIT_FAILURE;
+  }
+  struct dirent *ent;
+  while ((ent = readdir(dir)) != NULL && num_nics < MAX_NICS)
+  {
+    if (ent->d_name[0] == '.' ||
+        read_id(ent->d_name, "vendor") != CORUNDUM_VENDOR ||
+        read_id(ent->d_name, "device") != CORUNDUM_DEVICE)
+      continue;
+    struct nic *nic = &nics[num_nics++];
+    snprintf(nic->name, sizeof(nic->name), "%s", ent->d_name);
+    if (map_control(nic) != 0)
+      return EXIT_FAILURE;
+  }
+  closedir(dir);
+  if (num_nics == 0)
+  {
+    fprintf(stderr, "no Corundum NIC found\n");
+    return EXIT_FAILURE;
+  }
+
+  // the adapter saves once all of its NICs requested a checkpoint
+  for (int i = 0; i < num_nics; i++)
+  {
+    if (nics[i].regs[CONTROL_CHECKPOINT / 4] != kIdle)
+    {
+      fprintf(stderr, "%s: adapter does not take checkpoints\n",
+              nics[i].name);
+      return EXIT_FAILURE;
+    }
+    nics[i].regs[CONTROL_CHECKPOINT / 4] = 1;
+  }
+
+  double deadline = now() + timeout;
+  for (int i = 0; i < num_nics; i++)
+  {
+    uint32_t status;
+    while ((status = nics[i].regs[CONTROL_CHECKPOINT / 4]) == kPending)
+    {
+      if (now() > deadline)
+      {
+        fprintf(stderr, "%s: timed out waiting for the checkpoint\n",
+                nics[i].name);
+        return EXIT_FAILURE;
+      }
+      usleep(1000);
+    }
+    if (status != kSaved)
+    {
+      fprintf(stderr, "%s: checkpoint failed (status %u)\n", nics[i].name,
+              status);
+      return EXIT_FAILURE;
+    }
+  }
+  printf("corundum-checkpoint: saved %d NIC(s)\n", num_nics);
+  return EXIT_SUCCESS;
+}
@@ -22,14 +22,20 @@
 
 from __future__ import annotations
 
+import os
 import typing as tp
 import typing_extensions as tpe
 from simbricks.utils import base as utils_base
+from simbricks.utils import file as utils_file
 from simbricks.orchestration import system as sys
 from simbricks.orchestration.simulation import base as sim_base
 from simbricks.orchestration.simulation import pcidev as sim_pcidev
 from simbricks.orchestration.instantiation import base as inst_base
 
+from orchestration import resource_profiles
+from simbricks_examples import disks
+from simbricks_examples.disks import ConfigFile
+
 
 # System Configuration Integration
 
@@ -39,6 +45,10 @@ class CorundumNIC(sys.SimplePCIeNIC):
         super().__init__(s)
 
 
+# kept under this name for existing scripts, see simbricks_examples.disks
+CorundumConfigDiskImage = disks.CachedConfigDiskImage
+
+
 class CorundumLinuxHost(sys.LinuxHost):
     def __init__(self, sys) -> None:
         super().__init__(sys)
@@ -46,13 +56,10 @@ class CorundumLinuxHost(sys.LinuxHost):
 
     def config_files(self, inst: inst_base.Instantiation) -> dict[str, tp.IO]:
         m = {
-            "mqnic.ko": open(
-                "/corundum_src/corundum/modules/mqnic/mqnic.ko",
-                "rb",
-            ),
-            "mqnic-dump": open(
-                "/corundum_src/corundum/utils/mqnic-dump",
-                "rb",
+            "mqnic.ko": ConfigFile.get("/corundum_src/corundum/modules/mqnic/mqnic.ko"),
+            "mqnic-dump": ConfigFile.get("/corundum_src/corundum/utils/mqnic-dump"),
+            "corundum-checkpoint": ConfigFile.get(
+                "/corundum_src/guest/corundum-checkpoint"
             ),
         }
         return {**m, **super().config_files(inst=inst)}
@@ -70,53 +77,286 @@ class CorundumVerilatorNICSim(sim_pcidev.NICSim):
         )
         self.name = f"CorundumVerilatorNICSim-{self._id}"
         self.clock_freq = 250  # MHz
+        self.threads = 1
+        """Number of Verilator threads. Values other than 1 require the
+        adapter to be built with `make adapter-mt VERILATOR_THREADS=<threads>`."""
+        self.dma_max_pending = 16
+        """Maximum number of concurrently pending DMA reads and writes each.
+        Values other than 16 require the adapter to be built with
+        `make DMA_MAX_PENDING=<dma_max_pending>`."""
+        self.trace_start: int | None = None
+        """Start of the waveform trace window in picoseconds. Tracing is
+        disabled if this is None."""
+        self.trace_stop: int | None = None
+        """End of the waveform trace window in picoseconds, None traces until
+        the end of the simulation."""
+        self.trace_depth: int = 99
+        self.fast_forward_idle_cycles: int | None = None
+        """Let the adapter skip clock cycles once the NIC has been idle for
+        this many cycles and its state stopped changing, which leaves the
+        results unchanged. Only takes effect with synchronized channels and
+        the single-threaded adapter. Designs with free running state, e.g. a
+        running PTP clock, are never skipped."""
+        self.rx_ring_depth = 0
+        """Number of packets received from the network the adapter stages
+        while the NIC cannot accept them. Packets beyond that are dropped."""
+        self.rx_hold = False
+        """Instead of dropping packets once the staging ring is full, leave
+        them in the Ethernet queue so the backpressure reaches the network
+        simulator."""
+        self.msi_min_interval = 0
+        """Minimum time in picoseconds between two MSIs of the same vector.
+        0 disables interrupt coalescing."""
+        self.msi_packet_threshold = 0
+        """With coalescing enabled, send pending MSIs early once this many
+        packets were sent or received since the last batch."""
+        self.checkpoint_at: int | None = None
+        """Save a checkpoint of the NIC at the first quiescent cycle after
+        this time in picoseconds."""
+        self.restore_from: str | None = None
+        """Path of a checkpoint to start from instead of resetting the NIC."""
+        self.collect_stats = False
+        """Let the adapter write its counters to `stats_file()` at exit and on
+        SIGUSR1, and collect the file as output artifact of the run."""
+        self.stats_period: float | None = None
+        """Additionally write the counters every this many wall-clock
+        seconds."""
+        self.resource_profiles: str | None = None
+        """Profile database `resreq_mem()` and `resreq_cores()` are derived
+        from, None uses `resource_profiles.DEFAULT_PATH`."""
+        self.resreq_headroom = 1.25
+        """Factor applied to the measured peak memory."""
+        self._resreq: tuple[int, int] | None = None
+        """Cores and memory frozen into the JSON of the instantiation."""
 
-    def resreq_mem(self) -> int:
-        # this is a guess
-        return 512
+    def enable_tracing(
+        self,
+        start: int = 0,
+        stop: int | None = None,
+        ratio: utils_base.Time = utils_base.Time.Nanoseconds,
+        depth: int = 99,
+    ) -> None:
+        """Write an FST waveform of the simulated time window [start, stop]."""
+        self.trace_start = int(start * ratio * 1000)
+        self.trace_stop = int(stop * ratio * 1000) if stop is not None else None
+        self.trace_depth = depth
 
-    def run_cmd(self, inst: inst_base.Instantiation) -> str:
-        nic_devices = self.filter_components_by_type(ty=CorundumNIC)
-        nic_device = nic_devices[0]
+    def enable_interrupt_coalescing(
+        self,
+        min_interval: int,
+        ratio: utils_base.Time = utils_base.Time.Microseconds,
+        packet_threshold: int = 0,
+    ) -> None:
+        """Send each MSI vector at most once per min_interval, comparable to
+        the rx-usecs/rx-frames interrupt moderation of real NICs. Vectors
+        that fire in between are sent in one batch once the interval has
+        passed or packet_threshold packets were sent or received."""
+        self.msi_min_interval = int(min_interval * ratio * 1000)
+        self.msi_packet_threshold = packet_threshold
 
-        channels = self.get_channels()
+    def create_checkpoint(
+        self, at: int, ratio: utils_base.Time = utils_base.Time.Nanoseconds
+    ) -> None:
+        """Save the state of the NIC once it is quiescent after the given
+        simulated time, e.g. after the driver brought it up. The checkpoint
+        is written to `checkpoint_file()`."""
+        self.checkpoint_at = int(at * ratio * 1000)
 
-        pci_channels = sim_base.Simulator.filter_channels_by_sys_type(
-            channels, sys.PCIeChannel
-        )
-        pci_latency, pci_sync_period, pci_run_sync = (
-            sim_base.Simulator.get_unique_latency_period_sync(pci_channels)
-        )
-        socket = inst.get_socket(interface=nic_device._pci_if)
-        pci_params_url = self.get_parameters_url(
-            inst,
-            socket,
-            sync=pci_run_sync,
-            latency=pci_latency,
-            sync_period=pci_sync_period,
-        )
+    def restore_checkpoint(self, path: str) -> None:
+        """Start from a checkpoint saved by `create_checkpoint` instead of
+        resetting the NIC."""
+        self.restore_from = path
+
+    def supports_checkpointing(self) -> bool:
+        # only the single-threaded adapter is built with --savable
+        return self.threads == 1
 
-        eth_channels = sim_base.Simulator.filter_channels_by_sys_type(
-            channels, sys.EthChannel
+    def checkpoint_commands(self) -> list[str]:
+        """Run by the host right before its own checkpoint, see
+        `WarmupGem5Sim`. Lets the adapter save the NIC state at the same
+        point and stop simulating the NIC afterwards."""
+        if not self.supports_checkpointing():
+            return []
+        return ["/tmp/guest/corundum-checkpoint"]
+
+    def checkpoint_file(self, inst: inst_base.Instantiation) -> str:
+        return f"{inst.env.cpdir_sim(sim=self)}/corundum.ckpt"
+
+    def _checkpoint_args(self, inst: inst_base.Instantiation) -> str:
+        # Follow the checkpoints of the instantiation, i.e. of gem5 hosts. The
+        # adapter then only saves when the host runs `checkpoint_commands()`.
+        # A host that does not run them checkpoints before the driver touches
+        # the NIC, restoring it is then the same as a reset. This is evaluated
+        # on the runner that executes the simulator. The multi-threaded
+        # adapter always starts from a reset.
+        follow = self.supports_checkpointing()
+        host_cp = follow and self.checkpoint_at is None and inst.create_checkpoint
+        save = self.checkpoint_at is not None or host_cp
+        restore = self.restore_from is not None or (
+            follow
+            and inst.restore_checkpoint
+            and os.path.exists(self.checkpoint_file(inst))
         )
-        eth_latency, eth_sync_period, eth_run_sync = (
-            sim_base.Simulator.get_unique_latency_period_sync(eth_channels)
+        if not save and not restore:
+            return ""
+        if self.threads != 1:
+            raise Exception(
+                "CorundumVerilatorNICSim only supports checkpoints with the "
+                "single-threaded adapter"
+            )
+        args = ""
+        if save:
+            args += f"--checkpoint={self.checkpoint_file(inst)} "
+            if self.checkpoint_at is not None:
+                args += f"--checkpoint-at={self.checkpoint_at} "
+            if host_cp:
+                args += "--checkpoint-host "
+        if restore:
+            args += f"--restore={self.restore_from or self.checkpoint_file(inst)} "
+        return args
+
+    async def prepare(self, inst: inst_base.Instantiation) -> None:
+        await super().prepare(inst)
+        if self.checkpoint_at is not None or (
+            inst.create_checkpoint and self.supports_checkpointing()
+        ):
+            utils_file.mkdir(inst.env.cpdir_sim(sim=self))
+            # a stale checkpoint would be restored if the host does not
+            # request a new one
+            if os.path.exists(self.checkpoint_file(inst)):
+                os.remove(self.checkpoint_file(inst))
+        if self.collect_stats:
+            stats_path = inst.env.work_dir(self.stats_file())
+            artifacts = inst.assigned_fragment.output_artifact_paths
+            if stats_path not in artifacts:
+                artifacts.append(stats_path)
+
+    def add(self, nic: CorundumNIC) -> None:
+        """Add a NIC to this simulator. Unlike other NIC simulators, several
+        NICs can be added, they are then simulated by a single adapter
+        process that steps all of them with one clock and poll loop."""
+        # skip NICSim.add, which only allows a single NIC
+        sim_base.Simulator.add(self, nic)
+
+    def nic_components(self) -> list[CorundumNIC]:
+        """The simulated NICs in the order they are passed to the adapter."""
+        return sorted(
+            self.filter_components_by_type(ty=CorundumNIC), key=lambda nic: nic.id()
         )
-        socket = inst.get_socket(interface=nic_device._eth_if)
-        eth_params_url = self.get_parameters_url(
-            inst,
-            socket,
-            sync=eth_run_sync,
-            latency=eth_latency,
-            sync_period=eth_sync_period,
+
+    def trace_file(self) -> str:
+        """Name of the waveform file relative to the instantiation's working
+        directory. With several NICs the adapter inserts the index of the NIC
+        before the extension, e.g. `<name>.1.fst`."""
+        return f"{self.name}.fst"
+
+    def stats_file(self) -> str:
+        """Name of the JSON lines file the adapter appends its counters to,
+        relative to the instantiation's working directory."""
+        return f"{self.name}-stats.json"
+
+    def adapter_executable(self) -> str:
+        executable = self._executable
+        if self.threads != 1:
+            executable += f"_mt{self.threads}"
+        if self.dma_max_pending != 16:
+            executable += f"_dma{self.dma_max_pending}"
+        return executable
+
+    def profile_key(self) -> str:
+        """Configuration this simulator's resource usage is recorded under,
+        the adapter labels its stats file with it."""
+        return (
+            f"{type(self).__name__}:clock_freq={self.clock_freq}"
+            f":threads={self.threads}:nics={max(1, len(self.nic_components()))}"
+            f":dma_max_pending={self.dma_max_pending}"
+            f":tracing={int(self.trace_start is not None)}"
         )
 
-        cmd = f"{self._executable} {pci_params_url} {eth_params_url} {self._start_tick} {self.clock_freq}"
+    def _lookup_resreq(self) -> tuple[int, int]:
+        """Cores and memory for this configuration. The values are looked up
+        in the profile database when the instantiation is built and stored in
+        its JSON, so that the machine running it does not need the
+        database."""
+        if self._resreq is not None:
+            return self._resreq
+        profiles = resource_profiles.ResourceProfiles.load(self.resource_profiles)
+        cores = profiles.cores(self.profile_key())
+        mem = profiles.mem_mb(self.profile_key(), self.resreq_headroom)
+        if mem is None:
+            # uncalibrated configuration, this is a guess
+            mem = 512 * max(1, len(self.nic_components()))
+        return max(self.threads, cores or 0), mem
+
+    def resreq_cores(self) -> int:
+        return self._lookup_resreq()[0]
+
+    def resreq_mem(self) -> int:
+        return self._lookup_resreq()[1]
+
+    def run_cmd(self, inst: inst_base.Instantiation) -> str:
+        nic_devices = self.nic_components()
+
+        # the adapter takes latency and sync period per interface
+        params_urls = []
+        for nic_device in nic_devices:
+            params_urls.append(self.get_interface_url(inst, nic_device._pci_if))
+            params_urls.append(self.get_interface_url(inst, nic_device._eth_if))
+
+        cmd = f"{self.adapter_executable()} "
+        if len(nic_devices) > 1:
+            cmd += f"--nics={len(nic_devices)} "
+        if self.trace_start is not None:
+            cmd += f"--trace={inst.env.work_dir(self.trace_file())} "
+            cmd += f"--trace-start={self.trace_start} "
+            if self.trace_stop is not None:
+                cmd += f"--trace-stop={self.trace_stop} "
+            cmd += f"--trace-depth={self.trace_depth} "
+        if self.fast_forward_idle_cycles is not None:
+            if self.threads != 1:
+                raise Exception(
+                    "CorundumVerilatorNICSim only supports fast-forward with the "
+                    "single-threaded adapter"
+                )
+            cmd += f"--fast-forward={self.fast_forward_idle_cycles} "
+        if self.rx_ring_depth:
+            cmd += f"--rx-ring={self.rx_ring_depth} "
+        if self.rx_hold:
+            cmd += "--rx-hold "
+        if self.msi_min_interval:
+            cmd += f"--msi-interval={self.msi_min_interval} "
+            if self.msi_packet_threshold:
+                cmd += f"--msi-packets={self.msi_packet_threshold} "
+        cmd += self._checkpoint_args(inst)
+        if self.collect_stats:
+            cmd += f"--stats={inst.env.work_dir(self.stats_file())} "
+            if self.stats_period is not None:
+                cmd += f"--stats-period={self.stats_period} "
+            cmd += f"--stats-label={self.profile_key()} "
+        cmd += " ".join(params_urls)
+        cmd += f" {self._start_tick} {self.clock_freq}"
         return cmd
 
     def toJSON(self) -> dict:
         json_obj = super().toJSON()
         json_obj["clock_freq"] = self.clock_freq
+        json_obj["threads"] = self.threads
+        json_obj["dma_max_pending"] = self.dma_max_pending
+        json_obj["trace_start"] = self.trace_start
+        json_obj["trace_stop"] = self.trace_stop
+        json_obj["trace_depth"] = self.trace_depth
+        json_obj["fast_forward_idle_cycles"] = self.fast_forward_idle_cycles
+        json_obj["rx_ring_depth"] = self.rx_ring_depth
+        json_obj["rx_hold"] = self.rx_hold
+        json_obj["msi_min_interval"] = self.msi_min_interval
+        json_obj["msi_packet_threshold"] = self.msi_packet_threshold
+        json_obj["checkpoint_at"] = self.checkpoint_at
+        json_obj["restore_from"] = self.restore_from
+        json_obj["collect_stats"] = self.collect_stats
+        json_obj["stats_period"] = self.stats_period
+        json_obj["resource_profiles"] = self.resource_profiles
+        json_obj["resreq_headroom"] = self.resreq_headroom
+        json_obj["resreq_cores"], json_obj["resreq_mem"] = self._lookup_resreq()
         return json_obj
 
     @classmethod
@@ -125,4 +365,27 @@ class CorundumVerilatorNICSim(sim_pcidev.NICSim):
     ) -> tpe.Self:
         instance = super().fromJSON(simulation, json_obj)
         instance.clock_freq = utils_base.get_json_attr_top(json_obj, "clock_freq")
+        # keys added after the initial integration are optional, so that
+        # instantiations serialized before still deserialize
+        instance.threads = int(json_obj.get("threads", 1))
+        instance.dma_max_pending = int(json_obj.get("dma_max_pending", 16))
+        instance.trace_start = json_obj.get("trace_start")
+        instance.trace_stop = json_obj.get("trace_stop")
+        instance.trace_depth = int(json_obj.get("trace_depth", 99))
+        instance.fast_forward_idle_cycles = json_obj.get("fast_forward_idle_cycles")
+        instance.rx_ring_depth = int(json_obj.get("rx_ring_depth", 0))
+        instance.rx_hold = bool(json_obj.get("rx_hold", False))
+        instance.msi_min_interval = int(json_obj.get("msi_min_interval", 0))
+        instance.msi_packet_threshold = int(json_obj.get("msi_packet_threshold", 0))
+        instance.checkpoint_at = json_obj.get("checkpoint_at")
+        instance.restore_from = json_obj.get("restore_from")
+        instance.collect_stats = bool(json_obj.get("collect_stats", False))
+        instance.stats_period = json_obj.get("stats_period")
+        instance.resource_profiles = json_obj.get("resource_profiles")
+        instance.resreq_headroom = float(json_obj.get("resreq_headroom", 1.25))
+        if "resreq_cores" in json_obj and "resreq_mem" in json_obj:
+            instance._resreq = (
+                int(json_obj["resreq_cores"]),
+                int(json_obj["resreq_mem"]),
+            )
         return instance
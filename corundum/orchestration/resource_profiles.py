@@ -0,0 +1,169 @@
+# Copyright 2021 Max Planck Institute for Software Systems, and
+# National University of Singapore
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Local database of measured simulator resource usage.
+
+Simulators label their stats files with a profile key that describes their
+configuration, e.g. `CorundumVerilatorNICSim.profile_key()`. Each stats file
+ends with a snapshot that contains the peak RSS and the CPU time of the
+simulator process. Recording such files stores per key the peak memory and
+the number of cores the simulator kept busy, over all recorded runs. The
+simulator's `resreq_mem()` and `resreq_cores()` look these numbers up when
+the instantiation is built and store them in its JSON, so the runner does not
+need the database.
+
+Example:
+
+    python3 -m orchestration.resource_profiles record output/
+    python3 -m orchestration.resource_profiles show
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import os
+import pathlib
+import sys
+import time
+
+DEFAULT_PATH = os.environ.get(
+    "SIMBRICKS_RESOURCE_PROFILES", "~/.simbricks/resource_profiles.json"
+)
+
+
+class ResourceProfiles:
+    """Measured peak memory in MB and busy cores per profile key, stored as
+    JSON file."""
+
+    _loaded: dict[str, ResourceProfiles] = {}
+
+    def __init__(self, path: str = DEFAULT_PATH) -> None:
+        self.path = pathlib.Path(path).expanduser()
+        self.profiles: dict[str, dict] = {}
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                self.profiles = json.load(f)
+
+    @classmethod
+    def load(cls, path: str | None = None) -> ResourceProfiles:
+        """Database at path, only read once per process."""
+        path = path or DEFAULT_PATH
+        if path not in cls._loaded:
+            cls._loaded[path] = cls(path)
+        return cls._loaded[path]
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.profiles, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def record(self, key: str, max_rss_mb: float, cores: float) -> None:
+        profile = self.profiles.setdefault(
+            key, {"samples": 0, "max_rss_mb": 0.0, "cores": 0.0}
+        )
+        profile["samples"] += 1
+        profile["max_rss_mb"] = max(profile["max_rss_mb"], max_rss_mb)
+        profile["cores"] = max(profile["cores"], cores)
+        profile["updated"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    def record_stats_file(self, path: pathlib.Path) -> int:
+        """Record the final snapshot of a labelled stats file, returns the
+        number of recorded samples."""
+        last = None
+        with open(path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                snapshot = json.loads(line)
+                if "label" in snapshot and "max_rss_kb" in snapshot:
+                    last = snapshot
+        if last is None or last["wall_time"] <= 0:
+            return 0
+        self.record(
+            last["label"],
+            last["max_rss_kb"] / 1024,
+            last["cpu_time"] / last["wall_time"],
+        )
+        return 1
+
+    def mem_mb(self, key: str, headroom: float) -> int | None:
+        """Peak memory with headroom, None without a profile."""
+        profile = self.profiles.get(key)
+        if profile is None:
+            return None
+        return math.ceil(profile["max_rss_mb"] * headroom)
+
+    def cores(self, key: str) -> int | None:
+        """Number of cores kept busy, None without a profile. Small
+        measurement noise above a whole core is ignored."""
+        profile = self.profiles.get(key)
+        if profile is None:
+            return None
+        return max(1, math.ceil(profile["cores"] - 0.05))
+
+
+def _stats_files(paths: list[str]) -> list[pathlib.Path]:
+    files = []
+    for p in map(pathlib.Path, paths):
+        if p.is_dir():
+            files.extend(sorted(p.rglob("*-stats.json")))
+        else:
+            files.append(p)
+    return files
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--db", default=DEFAULT_PATH, help=f"profile database (default {DEFAULT_PATH})"
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+    rec = sub.add_parser("record", help="record stats files of calibration runs")
+    rec.add_argument(
+        "paths", nargs="+", help="stats files or directories to search for *-stats.json"
+    )
+    sub.add_parser("show", help="print the recorded profiles")
+    args = parser.parse_args()
+
+    profiles = ResourceProfiles(args.db)
+    if args.command == "record":
+        recorded = sum(profiles.record_stats_file(f) for f in _stats_files(args.paths))
+        profiles.save()
+        print(f"recorded {recorded} samples into {profiles.path}")
+        return 0
+
+    for key, profile in sorted(profiles.profiles.items()):
+        print(
+            f"{key}: {profile['max_rss_mb']:.1f} MB, {profile['cores']:.2f} cores "
+            f"({profile['samples']} samples)"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -52,7 +52,7 @@ distro_disk_image = system.DistroDiskImage(syst, "base")
 host0 = co.CorundumLinuxHost(syst)
 host0.name = "client-Host"
 host0.add_disk(distro_disk_image)
-host0.add_disk(system.LinuxConfigDiskImage(syst, host0))
+host0.add_disk(co.CorundumConfigDiskImage(syst, host0))
 # create client NIC
 nic0 = co.CorundumNIC(syst)
 nic0.name = "client-NIC"
@@ -63,7 +63,7 @@ host0.connect_pcie_dev(nic0)
 host1 = co.CorundumLinuxHost(syst)
 host1.name = "server-Host"
 host1.add_disk(distro_disk_image)
-host1.add_disk(system.LinuxConfigDiskImage(syst, host1))
+host1.add_disk(co.CorundumConfigDiskImage(syst, host1))
 # create server NIC
 nic1 = co.CorundumNIC(syst)
 nic1.name = "server-NIC"
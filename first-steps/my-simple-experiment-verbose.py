@@ -20,7 +20,6 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import re
 import asyncio
 
 from simbricks.orchestration import system
@@ -28,6 +27,7 @@ from simbricks.orchestration import simulation
 from simbricks.orchestration import instantiation
 from simbricks.utils import base as utils_base
 from simbricks.client.opus import base as opus_base
+from simbricks_examples import metrics
 
 
 """
@@ -130,23 +130,13 @@ if __name__ == "__main__":
     # helper function to create and parse the experiment output
     async def iperf_throughput() -> None:
 
-        # Regex to match output lines from iperf client
-        tp_pat = re.compile(
-            r"\[ *\d*\] *([0-9\.]*)- *([0-9\.]*) sec.*Bytes *([0-9\.]*) ([GM])bits.*"
-        )
-        throughputs = []
-        # iterate through host output
+        # parse the output of all simulators while the run progresses, keeping
+        # only running aggregates per simulator
+        pipeline = metrics.MetricsPipeline([metrics.IperfParser])
         line_gen = opus_base.ConsoleLineGenerator(run_id=run_id, follow=True)
-        async for _, line in line_gen.generate_lines():
-            m = tp_pat.match(line)
-            if not m:
-                continue
-            if m.group(4) == "G":
-                throughputs.append(float(m.group(3)) * 1000)
-            elif m.group(4) == "M":
-                throughputs.append(float(m.group(3)))
-
-        avg_throughput = sum(throughputs) / len(throughputs)
-        print(f"Iperf Throughput : {avg_throughput} Mbps")
+        await pipeline.consume(line_gen.generate_lines())
+
+        throughput = pipeline.total("iperf.throughput_mbps")
+        print(f"Iperf Throughput : {throughput.mean} Mbps")
 
     asyncio.run(iperf_throughput())
@@ -25,6 +25,7 @@ from simbricks.orchestration import system
 from simbricks.orchestration import simulation
 from simbricks.orchestration.helpers import instantiation as inst_helpers
 from simbricks.utils import base as utils_base
+from simbricks_examples import synchronization
 
 
 """
@@ -122,7 +123,8 @@ net_inst.add(switch_1)
 net_inst.add(switch_2)
 
 if synchronized:
-    sim.enable_synchronization(amount=500, ratio=utils_base.Time.Nanoseconds)
+    # each channel gets the largest sync period its latency allows
+    synchronization.enable(sim)
 
 
 """
@@ -25,6 +25,10 @@ from simbricks.orchestration import system
 from simbricks.orchestration import simulation
 from simbricks.orchestration.helpers import instantiation as inst_helpers
 from simbricks.utils import base as utils_base
+from simbricks_examples import disks
+from simbricks_examples import synchronization
+from simbricks_examples import topology
+from simbricks_examples import warmup
 
 
 """
@@ -45,6 +49,18 @@ amount_gem_5_sims = 1
 
 synchronized = True
 
+# boot the gem5 hosts on a fast CPU model and checkpoint them. With
+# CorundumBMNICSim, which does not support checkpoints, this is the checkpoint
+# right after boot and the driver setup still runs in detail. Only NIC
+# simulators with aligned checkpoints, i.e. CorundumVerilatorNICSim with the
+# CorundumNIC and CorundumLinuxHost of corundum/orchestration, move it to right
+# before netperf, see simbricks_examples/warmup.py
+fast_forward_setup = False
+
+# pack the config files of the hosts only once and reuse them across hosts and
+# runs, see simbricks_examples/disks.py
+cache_config_images = False
+
 link_rate = 200  # in Mbps
 link_latency = 5  # in ms
 
@@ -56,11 +72,19 @@ syst = system.System()
 
 # create disk images
 distro_disk_image = system.DistroDiskImage(syst, "base")
-
-# create switch_1
-switch_1 = system.EthSwitch(syst)
-# create switch_2
-switch_2 = system.EthSwitch(syst)
+config_disk_image = (
+    disks.CachedConfigDiskImage if cache_config_images else system.LinuxConfigDiskImage
+)
+
+# create the dumbbell topology, i.e. two switches connected by a bottleneck link
+network = topology.dumbbell(
+    syst,
+    latency=link_latency,
+    ratio=utils_base.Time.Milliseconds,
+    data_rate=f"{link_rate}Mbps",
+)
+switch_1 = network.switches["left"]
+switch_2 = network.switches["right"]
 
 hosts = []
 nics = []
@@ -68,26 +92,24 @@ for i in range(amount_gem_5_sims + amount_qemu_sims):
     # create client
     host0 = sys_host(syst)
     host0.add_disk(distro_disk_image)
-    host0.add_disk(system.LinuxConfigDiskImage(syst, host0))
+    host0.add_disk(config_disk_image(syst, host0))
     # create client NIC
     nic0 = sys_nic(syst)
-    nic0.add_ipv4("10.0.0.1")
     host0.connect_pcie_dev(nic0)
-    
-    # connect client NIC to switch
-    switch_1.connect_eth_peer_if(nic0._eth_if)
+
+    # connect client NIC to switch and assign it an address
+    network.attach_nic(nic0, switch_1)
 
     # create server
     host1 = sys_host(syst)
     host1.add_disk(distro_disk_image)
-    host1.add_disk(system.LinuxConfigDiskImage(syst, host1))
+    host1.add_disk(config_disk_image(syst, host1))
     # create server NIC
     nic1 = sys_nic(syst)
-    nic1.add_ipv4("10.0.0.2")
     host1.connect_pcie_dev(nic1)
-    
-    # connect server NIC to switch
-    switch_2.connect_eth_peer_if(nic1._eth_if)
+
+    # connect server NIC to switch and assign it an address
+    network.attach_nic(nic1, switch_2)
 
     # set client application
     client_app = system.NetperfClient(h=host0, server_ip=nic1._ip)
@@ -97,23 +119,16 @@ for i in range(amount_gem_5_sims + amount_qemu_sims):
     server_app = system.NetperfServer(h=host1)
     host1.add_app(server_app)
 
+    if fast_forward_setup and i < amount_gem_5_sims:
+        warmup.fast_forward(host0, until=client_app)
+        warmup.fast_forward(host1, until=server_app)
+
     hosts.append(host0)
     hosts.append(host1)
 
     nics.append(nic0)
     nics.append(nic1)
 
-# connect the two switches
-eth_1 = system.EthInterface(switch_1)
-switch_1.add_if(eth_1)
-eth_2 = system.EthInterface(switch_2)
-switch_2.add_if(eth_2)
-switch_to_switch_chan = system.EthChannel(eth_1, eth_2)
-# adjust channel options
-switch_to_switch_chan.set_latency(link_latency, utils_base.Time.Milliseconds)
-# NOTE: these are NS3 specific parameter
-switch_to_switch_chan.parameters = {"data_rate": f"{link_rate}Mbps"}
-
 
 """
 Simulator Choice
@@ -121,9 +136,8 @@ Simulator Choice
 sim = simulation.Simulation(name="Milestone-3-simulation", system=syst)
 
 for index, host in enumerate(hosts, 1):
-    sim_class = (
-        simulation.Gem5Sim if index <= amount_gem_5_sims * 2 else simulation.QemuSim
-    )
+    gem5_class = warmup.WarmupGem5Sim if fast_forward_setup else simulation.Gem5Sim
+    sim_class = gem5_class if index <= amount_gem_5_sims * 2 else simulation.QemuSim
     host_inst = sim_class(sim)
     host_inst.add(host)
 
@@ -136,12 +150,15 @@ net_inst.add(switch_1)
 net_inst.add(switch_2)
 
 if synchronized:
-    sim.enable_synchronization(amount=500, ratio=utils_base.Time.Nanoseconds)
+    # each channel gets the largest sync period its latency allows
+    synchronization.enable(sim)
 
 
 """
 Instantiation
 """
 instance = inst_helpers.simple_instantiation(sim)
+if fast_forward_setup:
+    instance.create_checkpoint = True
 
 instantiations.append(instance)
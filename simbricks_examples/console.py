@@ -0,0 +1,312 @@
+# Copyright 2021 Max Planck Institute for Software Systems, and
+# National University of Singapore
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Filtered, batched and resumable retrieval of the console output of runs.
+
+`ConsoleRetriever` is an alternative to `opus_base.ConsoleLineGenerator`. It
+sends a `ConsoleFilter` with every request: a regular expression for the
+lines, the names of the simulators of interest and the maximum number of
+lines per response. Backends that support these fields only send matching
+lines. Others ignore them, so the retriever applies the filter again on its
+side and the result is the same either way. The ids of the last lines
+received are kept as offset and optionally saved to a file after each batch,
+so a retriever created after a disconnect or restart continues where the
+previous one stopped. Lines of a batch that was not completely consumed are
+returned again after such a restart.
+
+`LocalConsoleServer` is an in-process stand-in for the console endpoints of
+the backend that supports the extended filter.
+
+Example:
+
+    retriever = console.ConsoleRetriever(
+        run_id, line_regex=r"Mbits/sec", simulators=["QemuSim-17"],
+        offset_file="run-42.offset",
+    )
+    async for simulator, line in retriever.lines():
+        print(simulator, line)
+"""
+
+from __future__ import annotations
+
+import asyncio
+import datetime
+import json
+import os
+import re
+import typing as tp
+
+import aiohttp
+from simbricks.schemas import base as schemas
+
+
+class ConsoleFilter(schemas.ApiRunOutputFilter):
+    simulators: list[str] | None = None
+    """Names of the simulators to return output of, None for all."""
+    proxies: bool = False
+    """Whether to return the output of proxies as well."""
+    line_regex: str | None = None
+    """Only return lines that match this regular expression (re.search)."""
+    limit: int | None = None
+    """Maximum number of lines per response, the ones with the lowest ids."""
+
+
+class ConsoleOffset:
+    """Ids of the last simulator and proxy output lines received."""
+
+    def __init__(self, simulator_line_id: int | None = None, proxy_line_id: int | None = None) -> None:
+        self.simulator_line_id = simulator_line_id
+        self.proxy_line_id = proxy_line_id
+
+    @classmethod
+    def load(cls, path: str) -> ConsoleOffset:
+        try:
+            with open(path, "r") as f:
+                json_obj = json.load(f)
+        except FileNotFoundError:
+            return cls()
+        return cls(json_obj["simulator_line_id"], json_obj["proxy_line_id"])
+
+    def save(self, path: str) -> None:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(
+                {
+                    "simulator_line_id": self.simulator_line_id,
+                    "proxy_line_id": self.proxy_line_id,
+                },
+                f,
+            )
+        os.replace(tmp, path)
+
+
+def _components(
+    comps: dict[int, schemas.ApiRunComponent],
+) -> tp.Iterator[tuple[str, schemas.ApiConsoleOutputLine]]:
+    for comp in comps.values():
+        for lines in comp.commands.values():
+            for line in lines:
+                yield comp.name, line
+
+
+class ConsoleRetriever:
+    """Console output of a run as (simulator, line) tuples, fetched in
+    batches of up to `batch_size` lines. With `follow`, keeps polling every
+    `poll_interval` seconds until the run finished. Failed requests are
+    retried up to `retries` times in a row without losing the offset.
+    `client` defaults to the configured SimBricks client."""
+
+    def __init__(
+        self,
+        run_id: int,
+        simulators: list[str] | None = None,
+        line_regex: str | None = None,
+        proxies: bool = False,
+        batch_size: int = 1000,
+        follow: bool = True,
+        offset_file: str | None = None,
+        poll_interval: float = 3.0,
+        retries: int = 5,
+        client: tp.Any = None,
+    ) -> None:
+        self.run_id = run_id
+        self.simulators = simulators
+        self.line_regex = line_regex
+        self._pattern = re.compile(line_regex) if line_regex is not None else None
+        self.proxies = proxies
+        self.batch_size = batch_size
+        self.follow = follow
+        self.offset_file = offset_file
+        self.offset = ConsoleOffset.load(offset_file) if offset_file else ConsoleOffset()
+        self.poll_interval = poll_interval
+        self.retries = retries
+        self._client = client
+
+    @property
+    def client(self) -> tp.Any:
+        if self._client is None:
+            from simbricks.client import provider
+
+            self._client = provider.client_provider.simbricks_client
+        return self._client
+
+    def _matches(self, name: str, line: str, is_proxy: bool) -> bool:
+        # like the server, the simulator names only filter simulator output
+        if self.simulators is not None and not is_proxy and name not in self.simulators:
+            return False
+        return self._pattern is None or self._pattern.search(line) is not None
+
+    async def _request(self, call: tp.Callable[[], tp.Awaitable[tp.Any]]) -> tp.Any:
+        failures = 0
+        while True:
+            try:
+                return await call()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                failures += 1
+                if failures > self.retries:
+                    raise
+                await asyncio.sleep(min(2**failures, 30))
+
+    async def fetch_batch(self) -> tuple[list[tuple[str, str]], int]:
+        """Next batch of matching lines and the number of lines received,
+        including those filtered out on this side."""
+        filter = ConsoleFilter(
+            simulator_seen_until_line_id=self.offset.simulator_line_id,
+            proxy_seen_until_line_id=self.offset.proxy_line_id,
+            simulators=self.simulators,
+            proxies=self.proxies,
+            line_regex=self.line_regex,
+            limit=self.batch_size,
+        )
+        output = await self._request(
+            lambda: self.client.get_run_console(self.run_id, filter=filter)
+        )
+
+        received = []
+        for name, line in _components(output.simulators):
+            received.append((line.id, False, name, line.output))
+        if self.proxies:
+            for name, line in _components(output.proxies):
+                received.append((line.id, True, name, line.output))
+        received.sort(key=lambda r: r[0])
+
+        lines = []
+        for line_id, is_proxy, name, text in received:
+            if is_proxy:
+                self.offset.proxy_line_id = max(self.offset.proxy_line_id or 0, line_id)
+            else:
+                self.offset.simulator_line_id = max(
+                    self.offset.simulator_line_id or 0, line_id
+                )
+            if self._matches(name, text, is_proxy):
+                lines.append((name, text))
+        return lines, len(received)
+
+    async def _running(self) -> bool:
+        run = await self._request(lambda: self.client.get_run(self.run_id))
+        return run.state in (
+            schemas.RunState.SPAWNED,
+            schemas.RunState.PENDING,
+            schemas.RunState.RUNNING,
+        )
+
+    async def lines(self) -> tp.AsyncGenerator[tuple[str, str], None]:
+        stop_after_next = not self.follow or not await self._running()
+        while True:
+            sleep_until = datetime.datetime.now() + datetime.timedelta(
+                seconds=self.poll_interval
+            )
+            lines, received = await self.fetch_batch()
+            for line in lines:
+                yield line
+            if self.offset_file:
+                self.offset.save(self.offset_file)
+            if received >= self.batch_size:
+                # more output is waiting
+                continue
+            if stop_after_next:
+                break
+            sleep_for = sleep_until - datetime.datetime.now()
+            if sleep_for > datetime.timedelta(seconds=0):
+                await asyncio.sleep(sleep_for.total_seconds())
+            if not await self._running():
+                # One more iteration to make sure we receive all output
+                stop_after_next = True
+
+
+class LocalConsoleServer:
+    """In-process stand-in for the run and console endpoints of the
+    SimBricks backend, supporting the fields of `ConsoleFilter`. Pass it as
+    `client` to a `ConsoleRetriever`. Set `fail_requests` to let the next
+    requests fail like dropped connections."""
+
+    def __init__(self) -> None:
+        self._runs: dict[int, schemas.RunState] = {}
+        # run id -> list of (line id, is proxy, component id, name, line)
+        self._lines: dict[int, list[tuple[int, bool, int, str, str]]] = {}
+        self._component_ids: dict[tuple[int, bool, str], int] = {}
+        self._next_line_id = 1
+        self.fail_requests = 0
+        self.lines_sent = 0
+        self.bytes_sent = 0
+
+    def create_run(self) -> int:
+        run_id = len(self._runs) + 1
+        self._runs[run_id] = schemas.RunState.RUNNING
+        self._lines[run_id] = []
+        return run_id
+
+    def append(self, run_id: int, name: str, line: str, proxy: bool = False) -> None:
+        key = (run_id, proxy, name)
+        comp_id = self._component_ids.setdefault(key, len(self._component_ids) + 1)
+        self._lines[run_id].append((self._next_line_id, proxy, comp_id, name, line))
+        self._next_line_id += 1
+
+    def finish(self, run_id: int, state: schemas.RunState = schemas.RunState.COMPLETED) -> None:
+        self._runs[run_id] = state
+
+    def _check_connection(self) -> None:
+        if self.fail_requests > 0:
+            self.fail_requests -= 1
+            raise aiohttp.ClientConnectionError("connection dropped")
+
+    async def get_run(self, run_id: int) -> schemas.ApiRun:
+        self._check_connection()
+        return schemas.ApiRun(id=run_id, state=self._runs[run_id])
+
+    async def get_run_console(
+        self, run_id: int, filter: schemas.ApiRunOutputFilter
+    ) -> schemas.ApiRunOutput:
+        self._check_connection()
+        f = ConsoleFilter.model_validate(filter.model_dump())
+        pattern = re.compile(f.line_regex) if f.line_regex is not None else None
+        sim_seen = f.simulator_seen_until_line_id or 0
+        proxy_seen = f.proxy_seen_until_line_id or 0
+
+        output = schemas.ApiRunOutput(run_id=run_id)
+        sent = 0
+        for line_id, proxy, comp_id, name, line in self._lines[run_id]:
+            if line_id <= (proxy_seen if proxy else sim_seen):
+                continue
+            if proxy and not f.proxies:
+                continue
+            if f.simulators is not None and not proxy and name not in f.simulators:
+                continue
+            if pattern is not None and pattern.search(line) is None:
+                continue
+            if f.limit is not None and sent >= f.limit:
+                break
+            comps = output.proxies if proxy else output.simulators
+            comp = comps.setdefault(comp_id, schemas.ApiRunComponent(name=name))
+            comp.commands.setdefault("", []).append(
+                schemas.ApiConsoleOutputLine(
+                    id=line_id,
+                    produced_at=datetime.datetime.now(),
+                    output=line,
+                    is_stderr=False,
+                )
+            )
+            sent += 1
+            self.bytes_sent += len(line)
+        self.lines_sent += sent
+        return output
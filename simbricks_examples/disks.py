@@ -0,0 +1,188 @@
+# Copyright 2021 Max Planck Institute for Software Systems, and
+# National University of Singapore
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Config disk images that are cheap to create for many hosts.
+
+The base image of the hosts is already shared: `QemuSim` gives each host a
+qcow2 overlay over it, and gem5 only reads it and keeps writes in memory. The
+config image, however, is built for every host on every run and contains all
+config files of the host, e.g. kernel modules.
+
+`CachedConfigDiskImage` packs the config files once per distinct content into
+a tar file kept in a content-addressed cache in the temporary directory of the
+instantiation, which survives between runs. The image of each host is a copy
+of that tar with the host's run script appended. The run script contains
+per-host settings such as IP addresses, so it is not part of the cache key. On
+file systems with reflinks (e.g. XFS, Btrfs) the copy does not duplicate any
+data, so only the small run scripts are written per host.
+
+`ConfigFile` handles can be returned from `config_files()` instead of open
+files. They only open their file while the image is built, and their content
+hash is only computed once per version of the file. Files passed as regular
+file handles are hashed again only when their size or modification time
+changed.
+
+Example:
+
+    host.add_disk(disks.CachedConfigDiskImage(syst, host))
+"""
+
+from __future__ import annotations
+
+import fcntl
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import typing as tp
+
+from simbricks.orchestration import system
+from simbricks.orchestration.instantiation import base as inst_base
+from simbricks.utils import file as utils_file
+
+FICLONE = 0x40049409
+
+# content hashes of files by path, modification time and size
+_digests: dict[tuple[str, int, int], str] = {}
+
+
+def _digest_path(path: str) -> str:
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    if key not in _digests:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+
+def _digest(f: tp.IO) -> str:
+    name = f.path if isinstance(f, ConfigFile) else getattr(f, "name", None)
+    if isinstance(name, str) and os.path.isfile(name):
+        return _digest_path(name)
+    f.seek(0, io.SEEK_SET)
+    return hashlib.sha256(f.read()).hexdigest()
+
+
+def clone_file(src: str, dst: str) -> None:
+    """Copy src to dst, as reflink where the file system supports it."""
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError:
+            pass
+        shutil.copyfileobj(fsrc, fdst)
+
+
+def _add_file(tar: tarfile.TarFile, name: str, f: tp.IO) -> None:
+    info = tarfile.TarInfo("guest/" + name)
+    info.mode = 0o777
+    f.seek(0, io.SEEK_END)
+    info.size = f.tell()
+    f.seek(0, io.SEEK_SET)
+    tar.addfile(tarinfo=info, fileobj=f)
+
+
+class ConfigFile:
+    """File put into the config image of a host. It behaves like the file
+    handles `config_files()` returns, but only opens the file once the image
+    is built and closes it right after. All handles of a path are the same
+    object."""
+
+    _handles: dict[str, ConfigFile] = {}
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._file: tp.BinaryIO | None = None
+
+    @classmethod
+    def get(cls, path: str) -> ConfigFile:
+        path = os.path.realpath(path)
+        if path not in cls._handles:
+            cls._handles[path] = cls(path)
+        return cls._handles[path]
+
+    def digest(self) -> str:
+        return _digest_path(self.path)
+
+    def _open(self) -> tp.BinaryIO:
+        if self._file is None:
+            self._file = open(self.path, "rb")
+        return self._file
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self._open().seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._open().tell()
+
+    def read(self, size: int = -1) -> bytes:
+        return self._open().read(size)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class CachedConfigDiskImage(system.LinuxConfigDiskImage):
+    """Config image whose config files are only packed once per distinct
+    content, the host's run script is appended to a copy of the cached
+    files."""
+
+    @staticmethod
+    def _cached_files(inst: inst_base.Instantiation, files: dict[str, tp.IO]) -> str:
+        h = hashlib.sha256()
+        for n, f in sorted(files.items()):
+            h.update(f"\0{n}\0{_digest(f)}".encode())
+        cache_dir = inst.env.tmp_simulation_files("config_cache")
+        cached = f"{cache_dir}/files-{h.hexdigest()}.tar"
+        if not os.path.exists(cached):
+            utils_file.mkdir(cache_dir)
+            tmp = f"{cached}.{os.getpid()}.tmp"
+            with tarfile.open(tmp, "w:") as tar:
+                for n, f in sorted(files.items()):
+                    _add_file(tar, n, f)
+            os.replace(tmp, cached)
+        return cached
+
+    async def _prepare_format(self, inst: inst_base.Instantiation, format: str) -> None:
+        files = self.host.config_files(inst)
+        try:
+            cached = self._cached_files(inst, files)
+        finally:
+            for f in files.values():
+                f.close()
+
+        # every host needs its own file, the simulators open images writable
+        path = self.path(inst, format)
+        clone_file(cached, path)
+        run_script = self.host.strfile(self.host.config_str(inst))
+        with tarfile.open(path, "a:") as tar:
+            _add_file(tar, "run.sh", run_script)
+        run_script.close()
@@ -0,0 +1,246 @@
+# Copyright 2021 Max Planck Institute for Software Systems, and
+# National University of Singapore
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Streaming extraction of metrics from console output.
+
+`MetricsPipeline` consumes (simulator, line) tuples as produced by
+`opus_base.ConsoleLineGenerator`, one at a time. Every simulator gets its own
+instances of the parsers, which turn lines into samples of named metrics.
+The pipeline only keeps running aggregates per simulator and metric, so its
+memory does not grow with the length of the output.
+
+Example:
+
+    pipeline = metrics.MetricsPipeline()
+    line_gen = opus_base.ConsoleLineGenerator(run_id=run_id, follow=True)
+    await pipeline.consume(line_gen.generate_lines())
+    print(pipeline.total("iperf.throughput_mbps").mean)
+"""
+
+from __future__ import annotations
+
+import abc
+import math
+import re
+import typing as tp
+
+_UNITS = {"": 1e-6, "K": 1e-3, "M": 1.0, "G": 1e3, "T": 1e6}
+
+
+class RunningStats:
+    """Count, mean, variance, minimum, maximum and last value of a series of
+    samples, updated in constant memory."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.last: float | None = None
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.last = value
+
+    def merge(self, other: RunningStats) -> None:
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self._m2 += other._m2 + delta * delta * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.last = other.last
+
+    @property
+    def stddev(self) -> float:
+        return math.sqrt(self._m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def toJSON(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "stddev": self.stddev,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "last": self.last,
+        }
+
+
+class Parser(abc.ABC):
+    """Turns the console lines of one simulator into metric samples. A new
+    instance is created for every simulator, so parsers can keep state."""
+
+    name = ""
+
+    @abc.abstractmethod
+    def parse(self, line: str) -> tp.Iterable[tuple[str, float]]:
+        """Samples of the metrics found in `line`."""
+
+
+class IperfParser(Parser):
+    """Interval and summary reports of iperf clients and servers. Interval
+    reports of the individual streams yield `throughput_mbps`, `[SUM]`
+    reports of parallel streams yield `sum_throughput_mbps`. The summary
+    report iperf prints at the end covers the whole transfer, i.e. it starts
+    at 0 again after the interval reports. It yields
+    `summary_throughput_mbps` and `sum_summary_throughput_mbps` instead, so
+    it does not skew the interval statistics. Without `-i`, the summary is
+    the only report and counts as an interval."""
+
+    name = "iperf"
+    _pat = re.compile(
+        r"\[ *(\d+|SUM)\] *([0-9.]+) *- *([0-9.]+) sec.*Bytes +([0-9.]+) ([KMGT]?)bits/sec"
+    )
+
+    def __init__(self) -> None:
+        # streams that already reported an interval
+        self._streams: set[str] = set()
+
+    def parse(self, line: str) -> tp.Iterable[tuple[str, float]]:
+        m = self._pat.search(line)
+        if not m:
+            return ()
+        stream = m.group(1)
+        mbps = float(m.group(4)) * _UNITS[m.group(5)]
+        metric = "throughput_mbps"
+        if float(m.group(2)) == 0 and stream in self._streams:
+            metric = "summary_throughput_mbps"
+        self._streams.add(stream)
+        if stream == "SUM":
+            metric = "sum_" + metric
+        return ((metric, mbps),)
+
+
+class NetperfParser(Parser):
+    """Result lines of netperf TCP_STREAM (`throughput_mbps`) and TCP_RR
+    (`transactions_per_s`) tests."""
+
+    name = "netperf"
+    _result = re.compile(r"^\s*\d+(\s+\d+){2,3}\s+[0-9.]+\s+([0-9.]+)\s*$")
+
+    def __init__(self) -> None:
+        self._test: str | None = None
+
+    def parse(self, line: str) -> tp.Iterable[tuple[str, float]]:
+        if "STREAM TEST" in line:
+            self._test = "throughput_mbps"
+            return ()
+        if "REQUEST/RESPONSE TEST" in line:
+            self._test = "transactions_per_s"
+            return ()
+        if self._test is None:
+            return ()
+        m = self._result.match(line)
+        if not m:
+            return ()
+        metric = self._test
+        self._test = None
+        return ((metric, float(m.group(2))),)
+
+
+class PingParser(Parser):
+    """Round-trip times (`rtt_ms`) and the packet loss summary (`loss_pct`)
+    of ping."""
+
+    name = "ping"
+    _rtt = re.compile(r"bytes from .* time[=<]([0-9.]+) ms")
+    _loss = re.compile(r"([0-9.]+)% packet loss")
+
+    def parse(self, line: str) -> tp.Iterable[tuple[str, float]]:
+        m = self._rtt.search(line)
+        if m:
+            return (("rtt_ms", float(m.group(1))),)
+        m = self._loss.search(line)
+        if m:
+            return (("loss_pct", float(m.group(1))),)
+        return ()
+
+
+DEFAULT_PARSERS: list[type[Parser]] = [IperfParser, NetperfParser, PingParser]
+
+
+class MetricsPipeline:
+    """Running aggregates of all metrics the parsers find, per simulator.
+    Metrics are named `<parser name>.<metric>`. `on_sample` is called with
+    the simulator, metric and value of every sample as it is parsed."""
+
+    def __init__(
+        self,
+        parsers: list[type[Parser]] = DEFAULT_PARSERS,
+        on_sample: tp.Callable[[str, str, float], None] | None = None,
+    ) -> None:
+        self.parser_types = parsers
+        self.listeners: list[tp.Callable[[str, str, float], None]] = []
+        if on_sample is not None:
+            self.listeners.append(on_sample)
+        self.stats: dict[str, dict[str, RunningStats]] = {}
+        self._parsers: dict[str, list[Parser]] = {}
+
+    def feed(self, source: str, line: str) -> None:
+        parsers = self._parsers.get(source)
+        if parsers is None:
+            parsers = [parser() for parser in self.parser_types]
+            self._parsers[source] = parsers
+            self.stats[source] = {}
+        for parser in parsers:
+            for metric, value in parser.parse(line):
+                name = f"{parser.name}.{metric}"
+                stats = self.stats[source].get(name)
+                if stats is None:
+                    stats = RunningStats()
+                    self.stats[source][name] = stats
+                stats.add(value)
+                for listener in self.listeners:
+                    listener(source, name, value)
+
+    def add_listener(self, listener: tp.Callable[[str, str, float], None]) -> None:
+        """Also call `listener` for every sample."""
+        self.listeners.append(listener)
+
+    async def consume(self, lines: tp.AsyncIterable[tuple[str, str]]) -> None:
+        async for source, line in lines:
+            self.feed(source, line)
+
+    def total(self, metric: str) -> RunningStats:
+        """Aggregate of a metric over all simulators."""
+        total = RunningStats()
+        for per_source in self.stats.values():
+            if metric in per_source:
+                total.merge(per_source[metric])
+        return total
+
+    def summary(self) -> dict[str, dict[str, dict]]:
+        return {
+            source: {name: stats.toJSON() for name, stats in per_source.items()}
+            for source, per_source in self.stats.items()
+            if per_source
+        }
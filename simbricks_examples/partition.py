@@ -0,0 +1,364 @@
+# Copyright 2021 Max Planck Institute for Software Systems, and
+# National University of Singapore
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Automatic partitioning of an instantiation into fragments.
+
+`partition()` assigns every simulator of an instantiation to one of a list of
+machines and creates one fragment per used machine. Each simulator has a cost,
+the relative amount of CPU time it needs per simulated second. The partitioner
+balances the cost per core across the machines and, within that balance,
+keeps simulators that share channels on the same machine. Channels that still
+cross fragments are assigned to one proxy pair per pair of fragments, see
+`proxies.connect_fragments()`.
+
+A single network simulator can become the bottleneck once the hosts are
+spread over several machines. `split_net()` cuts a network at given channels,
+e.g. a high-latency link between two switches, into parts that are simulated
+by separate processes. Passed as `spread`, the partitioner places the parts on
+different machines, and the latency of the cut channels gives the parts a
+large synchronization slack.
+
+Example:
+
+    nets = partition.split_net(
+        list(network.switches.values()) + background.hosts(),
+        network.border_links,
+        lambda: simulation.NS3Net(sim),
+    )
+    machines = [partition.Machine(cores=16, memory=32768) for _ in range(3)]
+    partition.partition(instance, machines, spread=[nets])
+"""
+
+from __future__ import annotations
+
+import typing as tp
+
+from simbricks.orchestration import instantiation
+from simbricks.orchestration import simulation
+from simbricks.orchestration import system
+from simbricks_examples import proxies
+
+DEFAULT_COSTS: dict[str, float] = {
+    "Gem5Sim": 10.0,
+    "QemuSim": 1.0,
+    "CorundumVerilatorNICSim": 4.0,
+    "CorundumBMNICSim": 0.5,
+    "I40eNicSim": 0.5,
+    "E1000NIC": 0.5,
+    "NS3Net": 0.2,
+    "SwitchNet": 0.2,
+    "Simulator": 1.0,
+}
+"""Cost per simulated component, by simulator class name. Subclasses use the
+cost of their closest listed base class."""
+
+DEFAULT_FLOW_COSTS: dict[str, float] = {
+    "NS3Net": 0.5,
+    "Simulator": 0.0,
+}
+"""Additional cost per application of the simulated hosts, by simulator class
+name. ns-3 simulates every packet of the flows its hosts send and receive, so
+its cost grows with their number. Other simulators run their applications
+inside the simulated host."""
+
+DEFAULT_CHANNEL_WEIGHTS: dict[str, float] = {
+    "PCIeChannel": 10.0,
+    "MemChannel": 10.0,
+    "Channel": 1.0,
+}
+"""How much it costs to proxy a channel, by channel class name. PCIe and
+memory channels carry far more messages than Ethernet channels."""
+
+
+def _lookup(table: dict[str, float], obj: tp.Any) -> float:
+    for cls in type(obj).__mro__:
+        if cls.__name__ in table:
+            return table[cls.__name__]
+    raise Exception(f"no entry for {type(obj).__name__}")
+
+
+def simulator_cost(
+    sim: simulation.Simulator,
+    costs: dict[str, float] = DEFAULT_COSTS,
+    flow_costs: dict[str, float] = DEFAULT_FLOW_COSTS,
+) -> float:
+    comps = sim.components()
+    flows = sum(
+        len(comp.applications) for comp in comps if isinstance(comp, system.Host)
+    )
+    return _lookup(costs, sim) * max(1, len(comps)) + _lookup(flow_costs, sim) * flows
+
+
+class Machine:
+    """A machine to run one fragment on. `memory` is in MB, the tags are
+    passed on to the fragment."""
+
+    def __init__(
+        self,
+        cores: int,
+        memory: int,
+        fragment_executor_tag: str | None = None,
+        runner_tags: set[str] | None = None,
+    ) -> None:
+        self.cores = cores
+        self.memory = memory
+        self.fragment_executor_tag = fragment_executor_tag
+        self.runner_tags = runner_tags
+
+
+class _Group:
+    """Simulators that are always placed together."""
+
+    def __init__(self, sims: list[simulation.Simulator], cost: float) -> None:
+        self.sims = sims
+        self.cost = cost
+        self.mem = sum(sim.resreq_mem() for sim in sims)
+        self.peers: dict[_Group, float] = {}
+        self.key = min(sim.id() for sim in sims)
+
+
+class _Bin:
+    def __init__(self, machine: Machine) -> None:
+        self.machine = machine
+        self.load = 0.0
+        self.mem = 0
+
+    def finish(self, group: _Group | None = None) -> float:
+        extra = group.cost if group is not None else 0.0
+        return (self.load + extra) / self.machine.cores
+
+    def fits(self, group: _Group) -> bool:
+        return self.mem + group.mem <= self.machine.memory
+
+    def add(self, group: _Group) -> None:
+        self.load += group.cost
+        self.mem += group.mem
+
+    def remove(self, group: _Group) -> None:
+        self.load -= group.cost
+        self.mem -= group.mem
+
+
+def _neighbors(
+    inst: instantiation.Instantiation, weights: dict[str, float]
+) -> tuple[dict[simulation.Simulator, dict[simulation.Simulator, float]], list]:
+    """Weighted simulator graph and the channels between simulators."""
+    graph: dict[simulation.Simulator, dict[simulation.Simulator, float]] = {
+        sim: {} for sim in inst.simulation.all_simulators()
+    }
+    channels: dict[int, system.Channel] = {}
+    for sim in graph:
+        for comp in sim._components:
+            for chan in comp.channels():
+                if chan.id() in channels:
+                    continue
+                sim_a = inst.find_sim_by_spec(chan.a.component)
+                sim_b = inst.find_sim_by_spec(chan.b.component)
+                if sim_a is sim_b:
+                    continue
+                channels[chan.id()] = chan
+                weight = _lookup(weights, chan)
+                graph[sim_a][sim_b] = graph[sim_a].get(sim_b, 0.0) + weight
+                graph[sim_b][sim_a] = graph[sim_b].get(sim_a, 0.0) + weight
+    return graph, list(channels.values())
+
+
+def _groups(
+    graph: dict[simulation.Simulator, dict[simulation.Simulator, float]],
+    cost: dict[simulation.Simulator, float],
+    merge_weight: float,
+) -> dict[simulation.Simulator, _Group]:
+    """Merge simulators that share channels of at least `merge_weight`."""
+    parent = {sim: sim for sim in graph}
+
+    def root(sim: simulation.Simulator) -> simulation.Simulator:
+        while parent[sim] is not sim:
+            parent[sim] = parent[parent[sim]]
+            sim = parent[sim]
+        return sim
+
+    for sim, peers in graph.items():
+        for peer, weight in peers.items():
+            if weight >= merge_weight:
+                parent[root(sim)] = root(peer)
+
+    members: dict[simulation.Simulator, list[simulation.Simulator]] = {}
+    for sim in graph:
+        members.setdefault(root(sim), []).append(sim)
+    group_of: dict[simulation.Simulator, _Group] = {}
+    for sims in members.values():
+        group = _Group(sims, sum(cost[sim] for sim in sims))
+        for sim in sims:
+            group_of[sim] = group
+
+    for sim, peers in graph.items():
+        group = group_of[sim]
+        for peer, weight in peers.items():
+            other = group_of[peer]
+            if other is not group:
+                group.peers[other] = group.peers.get(other, 0.0) + weight
+    return group_of
+
+
+def partition(
+    inst: instantiation.Instantiation,
+    machines: list[Machine],
+    costs: dict[str, float] = DEFAULT_COSTS,
+    flow_costs: dict[str, float] = DEFAULT_FLOW_COSTS,
+    channel_weights: dict[str, float] = DEFAULT_CHANNEL_WEIGHTS,
+    merge_weight: float = 10.0,
+    imbalance: float = 0.1,
+    proxy: type[instantiation.Proxy] = instantiation.TCPProxy,
+    passes: int = 10,
+    spread: tp.Iterable[tp.Iterable[simulation.Simulator]] = (),
+) -> list[instantiation.Fragment]:
+    """Assign the simulators of `inst` to `machines`, set `inst.fragments`
+    and create the proxy pairs. Simulators connected by channels weighing at
+    least `merge_weight`, e.g. a host and its PCIe NIC, always share a
+    fragment. The busiest machine may exceed the best possible balance by
+    `imbalance` to save proxied channels. The simulators of each collection
+    in `spread`, e.g. the parts returned by `split_net()`, are placed on
+    different machines as long as enough machines have memory left. Returns
+    the fragments, in the order of the machines that got simulators."""
+    if not machines:
+        raise Exception("need at least one machine")
+
+    graph, channels = _neighbors(inst, channel_weights)
+    cost = {sim: simulator_cost(sim, costs, flow_costs) for sim in graph}
+    group_of = _groups(graph, cost, merge_weight)
+    groups = sorted(set(group_of.values()), key=lambda g: (-g.cost, g.key))
+    bins = [_Bin(machine) for machine in machines]
+    placed: dict[_Group, _Bin] = {}
+
+    # groups that should not share a machine
+    apart: dict[_Group, set[_Group]] = {group: set() for group in groups}
+    for sims in spread:
+        members = {group_of[sim] for sim in sims}
+        for group in members:
+            apart[group] |= members - {group}
+
+    def affinity(group: _Group, b: _Bin) -> float:
+        return sum(w for peer, w in group.peers.items() if placed.get(peer) is b)
+
+    def conflicts(group: _Group, b: _Bin) -> bool:
+        return any(placed.get(other) is b for other in apart[group])
+
+    # Place the most expensive groups first. Among the machines that would
+    # finish close to the earliest, prefer the one with most channels.
+    for group in groups:
+        candidates = [b for b in bins if b.fits(group)]
+        if not candidates:
+            names = ", ".join(sim.full_name() for sim in group.sims)
+            raise Exception(f"no machine has enough memory left for {names}")
+        candidates = [b for b in candidates if not conflicts(group, b)] or candidates
+        earliest = min(b.finish(group) for b in candidates)
+        close = [b for b in candidates if b.finish(group) <= earliest * (1 + imbalance)]
+        best = max(close, key=lambda b: (affinity(group, b), -b.finish(group)))
+        best.add(group)
+        placed[group] = best
+
+    # Move single groups towards their peers as long as this does not push
+    # any machine past the balance bound.
+    total_cores = sum(m.cores for m in machines)
+    bound = max(
+        sum(cost.values()) / total_cores * (1 + imbalance),
+        max(b.finish() for b in bins),
+    )
+    for _ in range(passes):
+        moved = False
+        for group in sorted(groups, key=lambda g: g.key):
+            src = placed[group]
+            stay = affinity(group, src)
+            for dst in sorted({placed[peer] for peer in group.peers}, key=bins.index):
+                if dst is src or affinity(group, dst) <= stay:
+                    continue
+                if dst.finish(group) > bound or not dst.fits(group):
+                    continue
+                if conflicts(group, dst):
+                    continue
+                src.remove(group)
+                dst.add(group)
+                placed[group] = dst
+                stay = affinity(group, dst)
+                src = dst
+                moved = True
+        if not moved:
+            break
+
+    fragments: dict[_Bin, instantiation.Fragment] = {}
+    for b in bins:
+        fragments[b] = instantiation.Fragment(
+            b.machine.fragment_executor_tag, b.machine.runner_tags
+        )
+    for group in groups:
+        fragments[placed[group]].add_simulators(*group.sims)
+    inst.fragments = [f for f in fragments.values() if f.all_simulators()]
+
+    proxies.connect_fragments(inst, channels, proxy)
+    return inst.fragments
+
+
+def split_net(
+    comps: tp.Iterable[system.Component],
+    at: tp.Iterable[system.Channel],
+    new_sim: tp.Callable[[], simulation.Simulator],
+) -> list[simulation.Simulator]:
+    """Simulate the network made of `comps`, e.g. the switches of a topology
+    and the ns-3 hosts of a workload, by several network simulators, cut at
+    the channels `at`. Each part that stays connected without these channels
+    is added to its own simulator created by `new_sim`, e.g.
+    `lambda: simulation.NS3Net(sim)`, and the parts are joined by SimBricks
+    channels instead. Call this instead of adding the components to a single
+    network simulator, before synchronizing the channels and before
+    partitioning. Returns the simulators, ordered by the lowest component id
+    of their parts."""
+    comps = {comp.id(): comp for comp in comps}
+    cut = set()
+    for chan in at:
+        if chan.a.component.id() not in comps or chan.b.component.id() not in comps:
+            raise Exception(f"channel {chan.id()} is not inside the network")
+        cut.add(chan.id())
+
+    sims = []
+    seen: set[int] = set()
+    for comp in sorted(comps.values(), key=lambda c: c.id()):
+        if comp.id() in seen:
+            continue
+        seen.add(comp.id())
+        sim = new_sim()
+        stack = [comp]
+        while stack:
+            current = stack.pop()
+            sim.add(current)
+            for chan in current.channels():
+                if chan.id() in cut:
+                    continue
+                if chan.a.component is current:
+                    peer = chan.b.component
+                else:
+                    peer = chan.a.component
+                if peer.id() in comps and peer.id() not in seen:
+                    seen.add(peer.id())
+                    stack.append(peer)
+        sims.append(sim)
+    return sims
@@ -0,0 +1,82 @@
+# Copyright 2021 Max Planck Institute for Software Systems, and
+# National University of Singapore
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Proxy pairs that carry all channels between two fragments.
+
+Each `ProxyPair` runs one proxy process per side and forwards all of its
+channels over a single connection. Creating a pair per channel, as in
+
+    for nic in nics:
+        pair = instance.create_proxy_pair(instantiation.TCPProxy, frag_a, frag_b)
+        pair.assign_sim_channel(nic._eth_if.channel)
+
+therefore costs one connection and two proxy processes per channel, each
+polling its channel and forwarding messages and sync messages separately.
+`connect_fragments()` creates one pair per pair of fragments instead, and
+`multiplex_proxy_pairs()` merges the pairs of an existing instantiation.
+"""
+
+from __future__ import annotations
+
+from simbricks.orchestration import instantiation
+from simbricks.orchestration import system
+
+
+def connect_fragments(
+    inst: instantiation.Instantiation,
+    channels: list[system.Channel],
+    proxy: type[instantiation.Proxy] = instantiation.TCPProxy,
+) -> list[instantiation.ProxyPair]:
+    """Assign all `channels` whose simulators run in different fragments to
+    one proxy pair per pair of fragments. The fragments must be set."""
+    fragment_of: dict[int, instantiation.Fragment] = {}
+    for fragment in inst.fragments:
+        for sim in fragment.all_simulators():
+            fragment_of[sim.id()] = fragment
+
+    pairs: dict[tuple[int, int], instantiation.ProxyPair] = {}
+    for chan in sorted(channels, key=lambda c: c.id()):
+        frag_a = fragment_of[inst.find_sim_by_spec(chan.a.component).id()]
+        frag_b = fragment_of[inst.find_sim_by_spec(chan.b.component).id()]
+        if frag_a is frag_b:
+            continue
+        key = (min(frag_a.id(), frag_b.id()), max(frag_a.id(), frag_b.id()))
+        if key not in pairs:
+            pairs[key] = inst.create_proxy_pair(proxy, frag_a, frag_b)
+        pairs[key].assign_sim_channel(chan)
+    return list(pairs.values())
+
+
+def multiplex_proxy_pairs(
+    inst: instantiation.Instantiation,
+    proxy: type[instantiation.Proxy] = instantiation.TCPProxy,
+) -> list[instantiation.ProxyPair]:
+    """Replace the proxy pairs of `inst` by one pair per pair of fragments
+    that carries all channels of the replaced pairs."""
+    channels: list[system.Channel] = []
+    for pair in inst._proxy_pairs:
+        channels.extend(pair._channels)
+        pair.fragment_a._proxies.discard(pair.proxy_a)
+        pair.fragment_b._proxies.discard(pair.proxy_b)
+    inst._proxy_pairs = []
+    return connect_fragments(inst, channels, proxy)
@@ -0,0 +1,357 @@
+# Copyright 2021 Max Planck Institute for Software Systems, and
+# National University of Singapore
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Local columnar store for the per-interval measurements of runs.
+
+`ResultStore.add()` parses the console output of a run with a
+`metrics.MetricsPipeline` and keeps every sample, not just the aggregates.
+The samples of one simulator and metric form a series, the position of a
+sample in its series is its interval. The values of all series are stored
+back to back in one file of little-endian doubles, which is memory-mapped for
+queries. A JSON index holds per run the run id, the sweep key and the
+parameters, and per series its run, simulator, metric and slice of the
+values. With numpy installed, values are returned as `numpy.memmap` views and
+`aggregate()` reduces all selected series in a few vectorized operations.
+
+Example:
+
+    store = results.ResultStore()
+    store.add(run_id, {"link_rate": 200, **results.describe(inst)}, output)
+    table = store.aggregate("iperf.throughput_mbps", by=["link_rate"])
+    print(table["link_rate"], table["mean"])
+"""
+
+from __future__ import annotations
+
+import argparse
+import array
+import json
+import mmap
+import os
+import pathlib
+import sys
+import typing as tp
+
+from simbricks_examples import metrics
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DEFAULT_STORE = os.environ.get("SIMBRICKS_RESULTS", "~/.simbricks/results")
+STATS = ("mean", "sum", "min", "max", "count")
+
+
+def describe(inst: tp.Any) -> dict[str, tp.Any]:
+    """Parameters of an instantiation to index its runs by: the simulator
+    classes, whether channels are synchronized and the smallest sync period
+    in nanoseconds."""
+    simulators = sorted({type(sim).__name__ for sim in inst.simulation.all_simulators()})
+    channels = list(inst.simulation._chan_map.values())
+    synced = [chan for chan in channels if chan._synchronized]
+    return {
+        "simulators": ",".join(simulators),
+        "synchronized": bool(synced),
+        "sync_period_ns": min((chan.sync_period for chan in synced), default=None),
+    }
+
+
+def _matches(params: dict[str, tp.Any], where: dict[str, tp.Any]) -> bool:
+    for name, expected in where.items():
+        value = params.get(name)
+        if callable(expected):
+            if not expected(value):
+                return False
+        elif isinstance(expected, (list, tuple, set)):
+            if value not in expected:
+                return False
+        elif value != expected:
+            return False
+    return True
+
+
+class Series:
+    """Samples of one metric of one simulator in a run."""
+
+    def __init__(self, run: dict, source: str, metric: str, values: tp.Any) -> None:
+        self.run = run
+        self.source = source
+        self.metric = metric
+        self.values = values
+
+    @property
+    def run_id(self) -> int | None:
+        return self.run["run_id"]
+
+    @property
+    def params(self) -> dict[str, tp.Any]:
+        return self.run["params"]
+
+
+class ResultStore:
+    """Series of samples per run, stored in directory `path`."""
+
+    def __init__(self, path: str = DEFAULT_STORE) -> None:
+        self.path = pathlib.Path(path).expanduser()
+        self._values_path = self.path / "values.f64"
+        self._index_path = self.path / "index.json"
+        self.runs: list[dict] = []
+        self.series: list[dict] = []
+        if self._index_path.exists():
+            with open(self._index_path, "r") as f:
+                index = json.load(f)
+            self.runs = index["runs"]
+            self.series = index["series"]
+        self._keys = {run["key"] for run in self.runs if run["key"] is not None}
+        self._mapped: tp.Any = None
+        self._mapped_len = -1
+
+    def _save_index(self) -> None:
+        tmp = self._index_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"runs": self.runs, "series": self.series}, f)
+        os.replace(tmp, self._index_path)
+
+    def _values_end(self) -> int:
+        if not self.series:
+            return 0
+        last = self.series[-1]
+        return last["start"] + last["count"]
+
+    def has(self, key: str) -> bool:
+        return key in self._keys
+
+    def add(
+        self,
+        run_id: int | None,
+        params: dict[str, tp.Any],
+        output: tp.Iterable[tuple[str, str]],
+        key: str | None = None,
+        parsers: list[type[metrics.Parser]] = metrics.DEFAULT_PARSERS,
+    ) -> int:
+        """Parse the (simulator, line) tuples of a run and store its series.
+        Returns the index of the run in `runs`."""
+        samples: dict[tuple[str, str], list[float]] = {}
+        pipeline = metrics.MetricsPipeline(
+            parsers,
+            lambda source, metric, value: samples.setdefault(
+                (source, metric), []
+            ).append(value),
+        )
+        for source, line in output:
+            pipeline.feed(source, line)
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        start = self._values_end()
+        run_idx = len(self.runs)
+        series = []
+        with open(self._values_path, "ab") as f:
+            # drop values of an earlier add that did not finish
+            f.truncate(start * 8)
+            for (source, metric), values in sorted(samples.items()):
+                f.write(_pack(values))
+                series.append(
+                    {
+                        "run": run_idx,
+                        "source": source,
+                        "metric": metric,
+                        "start": start,
+                        "count": len(values),
+                    }
+                )
+                start += len(values)
+        self.runs.append({"run_id": run_id, "key": key, "params": params})
+        self.series.extend(series)
+        if key is not None:
+            self._keys.add(key)
+        self._save_index()
+        return run_idx
+
+    def _values(self) -> tp.Any:
+        end = self._values_end()
+        if self._mapped_len != end:
+            if end == 0:
+                self._mapped = np.zeros(0) if np is not None else memoryview(b"").cast("d")
+            elif np is not None:
+                self._mapped = np.memmap(self._values_path, dtype="<f8", mode="r", shape=(end,))
+            else:
+                with open(self._values_path, "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), end * 8, access=mmap.ACCESS_READ)
+                self._mapped = memoryview(mapped).cast("d")
+            self._mapped_len = end
+        return self._mapped
+
+    def select_runs(self, **where: tp.Any) -> list[int]:
+        """Indices of the runs whose parameters match. Each keyword gives a
+        value, a collection of values or a predicate for a parameter."""
+        return [i for i, run in enumerate(self.runs) if _matches(run["params"], where)]
+
+    def select(self, metric: str, **where: tp.Any) -> list[Series]:
+        """Series of `metric` in the matching runs."""
+        runs = set(self.select_runs(**where))
+        values = self._values()
+        return [
+            Series(
+                self.runs[s["run"]],
+                s["source"],
+                s["metric"],
+                values[s["start"] : s["start"] + s["count"]],
+            )
+            for s in self.series
+            if s["metric"] == metric and s["run"] in runs
+        ]
+
+    def aggregate(
+        self,
+        metric: str,
+        by: tp.Sequence[str] = (),
+        stats: tp.Iterable[str] = ("mean",),
+        **where: tp.Any,
+    ) -> dict[str, list]:
+        """One row per matching run with samples of `metric`, as columns:
+        `run_id`, the parameters named in `by` and the requested `stats`
+        over all samples of the run. Stats are lists, or numpy arrays if
+        numpy is installed."""
+        runs = set(self.select_runs(**where))
+        selected = [s for s in self.series if s["metric"] == metric and s["run"] in runs]
+        run_order = sorted({s["run"] for s in selected})
+        table: dict[str, list] = {"run_id": [self.runs[r]["run_id"] for r in run_order]}
+        for name in by:
+            table[name] = [self.runs[r]["params"].get(name) for r in run_order]
+        for stat in stats:
+            if stat not in STATS:
+                raise Exception(f"unknown statistic {stat}, expected one of {STATS}")
+            if np is not None:
+                table[stat] = self._aggregate_np(selected, run_order, stat)
+            else:
+                table[stat] = self._aggregate_py(selected, run_order, stat)
+        return table
+
+    def _aggregate_np(self, selected: list[dict], run_order: list[int], stat: str) -> tp.Any:
+        if not selected:
+            return np.zeros(0)
+        values = self._values()
+        starts = np.array([s["start"] for s in selected], dtype=np.int64)
+        counts = np.array([s["count"] for s in selected], dtype=np.int64)
+        rows = np.searchsorted(run_order, [s["run"] for s in selected])
+        # reduceat reduces values[starts[i]:starts[i + 1]], so add the gaps
+        # between the selected series as extra segments and skip them
+        bounds = np.empty(2 * len(selected), dtype=np.int64)
+        bounds[0::2] = starts
+        bounds[1::2] = starts + counts
+        if bounds[-1] == len(values):
+            # the last segment then extends to the end anyway
+            bounds = bounds[:-1]
+        n = len(run_order)
+        count = np.bincount(rows, weights=counts, minlength=n)
+        if stat == "count":
+            return count
+        if stat in ("sum", "mean"):
+            per_series = np.add.reduceat(values, bounds)[0::2]
+            total = np.bincount(rows, weights=per_series, minlength=n)
+            return total if stat == "sum" else total / count
+        ufunc = np.minimum if stat == "min" else np.maximum
+        per_series = ufunc.reduceat(values, bounds)[0::2]
+        result = np.full(n, np.inf if stat == "min" else -np.inf)
+        ufunc.at(result, rows, per_series)
+        return result
+
+    def _aggregate_py(self, selected: list[dict], run_order: list[int], stat: str) -> list:
+        values = self._values()
+        per_run: dict[int, metrics.RunningStats] = {r: metrics.RunningStats() for r in run_order}
+        total: dict[int, float] = {r: 0.0 for r in run_order}
+        for s in selected:
+            for value in values[s["start"] : s["start"] + s["count"]]:
+                per_run[s["run"]].add(value)
+                total[s["run"]] += value
+        if stat == "sum":
+            return [total[r] for r in run_order]
+        return [getattr(per_run[r], stat) for r in run_order]
+
+    def close(self) -> None:
+        self._mapped = None
+        self._mapped_len = -1
+
+
+def _pack(values: list[float]) -> bytes:
+    arr = array.array("d", values)
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _parse_where(spec: str) -> tuple[str, tp.Any]:
+    name, _, value = spec.partition("=")
+    if not value:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE, got {spec}")
+    try:
+        return name, json.loads(value)
+    except json.JSONDecodeError:
+        return name, value
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--store", default=DEFAULT_STORE, help=f"result store (default {DEFAULT_STORE})"
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+    imp = sub.add_parser("import", help="add the results of a sweep cache")
+    imp.add_argument("cache", help="sweep cache directory")
+    query = sub.add_parser("query", help="aggregate a metric per run")
+    query.add_argument("metric", help="metric, e.g. iperf.throughput_mbps")
+    query.add_argument("--by", action="append", default=[], help="parameter column")
+    query.add_argument(
+        "--stat", action="append", choices=STATS, help="statistic (default mean)"
+    )
+    query.add_argument(
+        "--where", type=_parse_where, action="append", default=[],
+        help="only runs with parameter NAME=VALUE",
+    )
+    args = parser.parse_args()
+
+    store = ResultStore(args.store)
+    if args.command == "import":
+        added = 0
+        for path in sorted(pathlib.Path(args.cache).expanduser().glob("*.json")):
+            with open(path, "r") as f:
+                result = json.load(f)
+            if store.has(result["key"]):
+                continue
+            store.add(result["run_id"], result["params"], result["output"], result["key"])
+            added += 1
+        print(f"added {added} runs to {store.path}")
+        return 0
+
+    stats = args.stat or ["mean"]
+    table = store.aggregate(args.metric, args.by, stats, **dict(args.where))
+    columns = ["run_id", *args.by, *stats]
+    print("\t".join(columns))
+    for row in zip(*(table[c] for c in columns)):
+        print("\t".join(str(v) for v in row))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,228 @@
+# Copyright 2021 Max Planck Institute for Software Systems, and
+# National University of Singapore
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Early termination of runs once their measurements reached steady state.
+
+`EarlyStop` watches the samples of one metric of a `metrics.MetricsPipeline`,
+e.g. the per-interval iperf throughput. Each simulator that reports the
+metric gets its own instance of a steady-state criterion. Once the criterion
+holds for enough simulators, `follow_until_steady()` kills the run and keeps
+the aggregates collected so far.
+
+Example:
+
+    stop = steady_state.EarlyStop(
+        "iperf.throughput_mbps",
+        lambda: steady_state.CoefficientOfVariation(window=5, threshold=0.02),
+    )
+    pipeline = await steady_state.follow_until_steady(run_id, stop)
+    print(pipeline.total("iperf.throughput_mbps").mean)
+"""
+
+from __future__ import annotations
+
+import abc
+import collections
+import math
+import statistics
+import typing as tp
+
+from simbricks_examples import console
+from simbricks_examples import metrics
+
+
+class Criterion(abc.ABC):
+    """Decides from a series of samples whether it reached steady state."""
+
+    @abc.abstractmethod
+    def add(self, value: float) -> bool:
+        """Add a sample, returns whether the series is steady."""
+
+    def describe(self) -> str:
+        """Settings of the criterion, results of runs stopped by criteria
+        with different descriptions are not interchangeable."""
+        return type(self).__name__
+
+
+class CoefficientOfVariation(Criterion):
+    """Steady once the last `window` samples after the first `warmup` ones
+    vary by at most `threshold` (standard deviation relative to the
+    mean)."""
+
+    def __init__(self, window: int = 5, threshold: float = 0.05, warmup: int = 2) -> None:
+        if window < 2:
+            raise Exception("window must hold at least two samples")
+        self.window: collections.deque[float] = collections.deque(maxlen=window)
+        self.threshold = threshold
+        self.warmup = warmup
+
+    def add(self, value: float) -> bool:
+        if self.warmup > 0:
+            self.warmup -= 1
+            return False
+        self.window.append(value)
+        if len(self.window) < self.window.maxlen:
+            return False
+        mean = statistics.fmean(self.window)
+        if mean == 0:
+            return False
+        return statistics.stdev(self.window) / abs(mean) <= self.threshold
+
+    def describe(self) -> str:
+        return (
+            f"{type(self).__name__}(window={self.window.maxlen},"
+            f"threshold={self.threshold},warmup={self.warmup})"
+        )
+
+
+class ConfidenceInterval(Criterion):
+    """Steady once the confidence interval of the mean of all samples after
+    the first `warmup` ones is narrower than `width` relative to the mean.
+    Assumes independent samples, so it suits long runs with short
+    intervals."""
+
+    def __init__(
+        self,
+        width: float = 0.05,
+        confidence: float = 0.95,
+        min_samples: int = 5,
+        warmup: int = 2,
+    ) -> None:
+        self.stats = metrics.RunningStats()
+        self.width = width
+        self.z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+        self.min_samples = min_samples
+        self.warmup = warmup
+
+    def add(self, value: float) -> bool:
+        if self.warmup > 0:
+            self.warmup -= 1
+            return False
+        self.stats.add(value)
+        if self.stats.count < self.min_samples or self.stats.mean == 0:
+            return False
+        half = self.z * self.stats.stddev / math.sqrt(self.stats.count)
+        return 2 * half / abs(self.stats.mean) <= self.width
+
+    def describe(self) -> str:
+        return (
+            f"{type(self).__name__}(width={self.width},z={self.z},"
+            f"min_samples={self.min_samples},warmup={self.warmup})"
+        )
+
+
+class EarlyStop:
+    """Tracks `metric` per simulator with a fresh criterion from
+    `criterion`. Steady once at least `sources` simulators reported the
+    metric and all of them reached steady state."""
+
+    def __init__(
+        self,
+        metric: str,
+        criterion: tp.Callable[[], Criterion] = CoefficientOfVariation,
+        sources: int = 1,
+    ) -> None:
+        self.metric = metric
+        self.criterion = criterion
+        self.sources = sources
+        self._criteria: dict[str, Criterion] = {}
+        self._steady: set[str] = set()
+
+    def on_sample(self, source: str, metric: str, value: float) -> None:
+        if metric != self.metric:
+            return
+        criterion = self._criteria.get(source)
+        if criterion is None:
+            criterion = self.criterion()
+            self._criteria[source] = criterion
+        # a source that left its steady state again no longer counts
+        if criterion.add(value):
+            self._steady.add(source)
+        else:
+            self._steady.discard(source)
+
+    def describe(self) -> str:
+        return f"{self.metric}:{self.sources}:{self.criterion().describe()}"
+
+    @property
+    def steady(self) -> bool:
+        return (
+            len(self._criteria) >= self.sources
+            and len(self._steady) == len(self._criteria)
+        )
+
+
+async def kill_run(run_id: int) -> None:
+    """Ask the runners executing the run to kill it."""
+    from simbricks.client import provider
+    from simbricks.client.opus import base as opus_base
+    from simbricks.schemas import base as schemas
+
+    client = provider.client_provider.simbricks_client
+    runner_ids = {
+        fragment.runner_id
+        for fragment in await client.get_all_run_fragments(run_id)
+        if fragment.runner_id is not None
+    }
+    for runner_id in sorted(runner_ids):
+        event = schemas.ApiRunEventCreate(
+            runner_id=runner_id, run_id=run_id, run_event_type=schemas.RunEventType.KILL
+        )
+        await opus_base.create_event(provider.client_provider.runner_client(runner_id), event)
+
+
+async def consume_until_steady(
+    lines: tp.AsyncIterable[tuple[str, str]],
+    pipeline: metrics.MetricsPipeline,
+    stop: EarlyStop,
+    on_steady: tp.Callable[[], tp.Awaitable[None]],
+) -> bool:
+    """Feed `lines` into `pipeline` and call `on_steady` once when `stop`
+    reached steady state. Keeps consuming until the lines end, so output
+    produced while the run shuts down is still parsed. Returns whether the
+    run was stopped early."""
+    pipeline.add_listener(stop.on_sample)
+    stopped = False
+    async for source, line in lines:
+        pipeline.feed(source, line)
+        if not stopped and stop.steady:
+            stopped = True
+            await on_steady()
+    return stopped
+
+
+async def follow_until_steady(
+    run_id: int,
+    stop: EarlyStop,
+    pipeline: metrics.MetricsPipeline | None = None,
+    retriever: console.ConsoleRetriever | None = None,
+) -> metrics.MetricsPipeline:
+    """Follow the console output of a run and kill the run once `stop`
+    reached steady state. A `retriever` with a filter limits the output
+    transferred to the lines of interest."""
+    pipeline = pipeline or metrics.MetricsPipeline()
+    retriever = retriever or console.ConsoleRetriever(run_id)
+    await consume_until_steady(
+        retriever.lines(), pipeline, stop, lambda: kill_run(run_id)
+    )
+    return pipeline
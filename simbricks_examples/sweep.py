@@ -0,0 +1,508 @@
+# Copyright 2021 Max Planck Institute for Software Systems, and
+# National University of Singapore
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Parameter sweeps over virtual prototypes.
+
+A sweep builds one instantiation per point of a parameter grid and runs them
+concurrently, at most `max_parallel` at a time. Every run is keyed by a hash
+of its serialized system, simulation and instantiation, with object ids and
+generated names normalized. Results of completed runs are cached under that
+key, so points whose configuration did not change are not simulated again.
+The key covers the configuration and the backend's `cache_salt()`, which
+tells apart results of the stand-in backend and of runs stopped early. Pass a
+different `salt` to rerun after changing simulator binaries or images.
+
+Runs are executed by a backend. `OpusBackend` submits them to the SimBricks
+backend, `LocalBackend` calls a function instead and serves as a stand-in
+when trying out sweeps without simulating anything. The command line keeps
+the results of `--local` sweeps in a separate cache.
+
+Example:
+
+    python3 -m simbricks_examples.sweep networking-case-study/milestone-4.py \\
+        -p link_rate=100,200 -p num_background_flows=1,4,16 --parallel 4
+"""
+
+from __future__ import annotations
+
+import abc
+import argparse
+import ast
+import asyncio
+import hashlib
+import inspect
+import itertools
+import json
+import os
+import pathlib
+import re
+import sys
+import typing as tp
+
+from simbricks.orchestration import instantiation
+from simbricks_examples import metrics
+from simbricks_examples import results as result_store
+from simbricks_examples import steady_state
+
+DEFAULT_CACHE = os.environ.get("SIMBRICKS_SWEEP_CACHE", "~/.simbricks/sweep_cache")
+LOCAL_CACHE = os.environ.get(
+    "SIMBRICKS_SWEEP_LOCAL_CACHE", "~/.simbricks/sweep_cache_local"
+)
+
+# keys of the serialized configuration that hold ids of other objects
+_REF_KEYS = {
+    "system", "simulation", "instantiation", "component", "channel", "host",
+    "interface_a", "interface_b", "eth_if", "pci_if", "mem_if", "left", "right",
+    "sys_channel", "fragment_a", "fragment_b", "proxy_a", "proxy_b",
+}
+_REF_LIST_KEYS = {"interfaces", "disks", "components", "simulators", "proxies", "channels"}
+# serialized from sets, so their order is arbitrary
+_UNORDERED_KEYS = {"components", "simulators", "proxies", "channels", "runner_tags"}
+_VOLATILE_KEYS = {"input_artifact_name", "output_artifact_name"}
+_UUID = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+def _collect_ids(obj: tp.Any, ids: set[int]) -> None:
+    if isinstance(obj, dict):
+        if type(obj.get("id")) is int and "type" in obj:
+            ids.add(obj["id"])
+        for value in obj.values():
+            _collect_ids(value, ids)
+    elif isinstance(obj, list):
+        for value in obj:
+            _collect_ids(value, ids)
+
+
+def _sort_key(obj: tp.Any) -> tuple:
+    if isinstance(obj, dict):
+        return (2, obj.get("id", 0))
+    return (0, obj) if type(obj) is int else (1, str(obj))
+
+
+def _canonical(obj: tp.Any, rank: dict[int, int]) -> tp.Any:
+    def ref(value: tp.Any) -> tp.Any:
+        if type(value) is int:
+            return rank.get(value, value)
+        return _canonical(value, rank)
+
+    if isinstance(obj, list):
+        return [_canonical(value, rank) for value in obj]
+    if isinstance(obj, str):
+        return _UUID.sub("<uuid>", obj)
+    if not isinstance(obj, dict):
+        return obj
+
+    result = {}
+    for key, value in obj.items():
+        if key in _VOLATILE_KEYS:
+            continue
+        if key == "id" or key in _REF_KEYS:
+            result[key] = ref(value)
+        elif key in _REF_LIST_KEYS and isinstance(value, list):
+            items = [ref(v) for v in value]
+            if key in _UNORDERED_KEYS:
+                items.sort(key=_sort_key)
+            result[key] = items
+        elif key == "inf_socktype_assignment":
+            result[key] = {str(rank.get(int(i), i)): t for i, t in value.items()}
+        elif key == "chan_map":
+            result[key] = [[ref(i), _canonical(c, rank)] for i, c in value]
+        elif key == "name" and isinstance(value, str) and type(obj.get("id")) is int:
+            # default simulator names end in their id
+            suffix = f"-{obj['id']}"
+            if value.endswith(suffix):
+                value = f"{value[:-len(suffix)]}-{rank[obj['id']]}"
+            result[key] = _canonical(value, rank)
+        else:
+            result[key] = _canonical(value, rank)
+    return result
+
+
+def canonical_json(inst: instantiation.Instantiation) -> str:
+    """Serialized configuration of `inst`, independent of the ids and
+    generated names of its objects."""
+    inst.finalize_validate()
+    simulation = inst.simulation
+    objs = [simulation.system.toJSON(), simulation.toJSON(), inst.toJSON()]
+    ids: set[int] = set()
+    _collect_ids(objs, ids)
+    rank = {ident: i for i, ident in enumerate(sorted(ids))}
+    return json.dumps(_canonical(objs, rank), sort_keys=True, separators=(",", ":"))
+
+
+def instantiation_key(inst: instantiation.Instantiation, salt: str = "") -> str:
+    return hashlib.sha256((salt + canonical_json(inst)).encode()).hexdigest()
+
+
+class RunResult:
+    """Outcome of the run of one sweep point."""
+
+    def __init__(
+        self,
+        key: str,
+        params: dict[str, tp.Any],
+        run_id: int | None,
+        state: str,
+        output: list[tuple[str, str]],
+    ) -> None:
+        self.key = key
+        self.params = params
+        self.run_id = run_id
+        self.state = state
+        self.output = output
+        self.cached = False
+
+    @property
+    def completed(self) -> bool:
+        return self.state in ("completed", "steady")
+
+    def toJSON(self) -> dict:
+        return {
+            "key": self.key,
+            "params": self.params,
+            "run_id": self.run_id,
+            "state": self.state,
+            "output": [list(line) for line in self.output],
+        }
+
+    @classmethod
+    def fromJSON(cls, json_obj: dict) -> RunResult:
+        return cls(
+            json_obj["key"],
+            json_obj["params"],
+            json_obj["run_id"],
+            json_obj["state"],
+            [tuple(line) for line in json_obj["output"]],
+        )
+
+
+class ResultCache:
+    """Results of completed runs, one JSON file per key."""
+
+    def __init__(self, path: str = DEFAULT_CACHE) -> None:
+        self.path = pathlib.Path(path).expanduser()
+
+    def _file(self, key: str) -> pathlib.Path:
+        return self.path / f"{key}.json"
+
+    def get(self, key: str) -> RunResult | None:
+        try:
+            with open(self._file(key), "r") as f:
+                result = RunResult.fromJSON(json.load(f))
+        except FileNotFoundError:
+            return None
+        result.cached = True
+        return result
+
+    def put(self, result: RunResult) -> None:
+        if not result.completed:
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp = self._file(result.key).with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(result.toJSON(), f)
+        os.replace(tmp, self._file(result.key))
+
+
+class Backend(abc.ABC):
+    @abc.abstractmethod
+    async def run(
+        self, inst: instantiation.Instantiation
+    ) -> tuple[int | None, str, list[tuple[str, str]]]:
+        """Run `inst` to completion, returns the run id, the final state and
+        the console output as (simulator, line) tuples."""
+
+    def cache_salt(self) -> str:
+        """Added to the key of each run, backends whose results differ from
+        those of complete simulated runs return a non-empty salt."""
+        return ""
+
+
+class OpusBackend(Backend):
+    """Runs on the SimBricks backend the client is configured for. With
+    `early_stop`, runs are followed and killed once the `EarlyStop` it
+    returns reached steady state. Their state is then `steady`."""
+
+    def __init__(
+        self,
+        poll_interval: float = 5.0,
+        early_stop: tp.Callable[[], steady_state.EarlyStop] | None = None,
+    ) -> None:
+        self.poll_interval = poll_interval
+        self.early_stop = early_stop
+
+    def cache_salt(self) -> str:
+        # runs stopped at steady state have shorter output than full runs
+        if self.early_stop is None:
+            return ""
+        return f"early_stop:{self.early_stop().describe()}"
+
+    async def run(
+        self, inst: instantiation.Instantiation
+    ) -> tuple[int | None, str, list[tuple[str, str]]]:
+        from simbricks.client import provider
+        from simbricks.client.opus import base as opus_base
+
+        run_id = await opus_base.create_run(inst)
+        if self.early_stop is not None:
+            output: list[tuple[str, str]] = []
+
+            async def record() -> tp.AsyncIterator[tuple[str, str]]:
+                line_gen = opus_base.ConsoleLineGenerator(run_id=run_id, follow=True)
+                async for line in line_gen.generate_lines():
+                    output.append(line)
+                    yield line
+
+            stopped = await steady_state.consume_until_steady(
+                record(),
+                metrics.MetricsPipeline(),
+                self.early_stop(),
+                lambda: steady_state.kill_run(run_id),
+            )
+            if stopped:
+                return run_id, "steady", output
+
+        while await opus_base.still_running(run_id):
+            await asyncio.sleep(self.poll_interval)
+        run = await provider.client_provider.simbricks_client.get_run(run_id)
+        if self.early_stop is None:
+            line_gen = opus_base.ConsoleLineGenerator(run_id=run_id, follow=False)
+            output = [line async for line in line_gen.generate_lines()]
+        return run_id, run.state.value, output
+
+
+class LocalBackend(Backend):
+    """Stand-in backend that calls `handler` with each instantiation. The
+    handler returns the console output, or raises to mark the run failed.
+    It may be a coroutine function."""
+
+    def __init__(
+        self,
+        handler: tp.Callable[[instantiation.Instantiation], tp.Any] | None = None,
+    ) -> None:
+        self.handler = handler
+        self.runs = 0
+
+    def cache_salt(self) -> str:
+        if self.handler is None:
+            return "local"
+        return f"local:{self.handler.__module__}.{self.handler.__qualname__}"
+
+    async def run(
+        self, inst: instantiation.Instantiation
+    ) -> tuple[int | None, str, list[tuple[str, str]]]:
+        self.runs += 1
+        run_id = self.runs
+        if self.handler is None:
+            return run_id, "completed", []
+        try:
+            output = self.handler(inst)
+            if inspect.isawaitable(output):
+                output = await output
+        except Exception as e:
+            return run_id, "error", [("sweep", f"{type(e).__name__}: {e}")]
+        return run_id, "completed", list(output)
+
+
+def grid(**axes: list[tp.Any]) -> list[dict[str, tp.Any]]:
+    """All combinations of the given parameter values."""
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+
+def script_builder(
+    path: str, index: int = 0
+) -> tp.Callable[[dict[str, tp.Any]], instantiation.Instantiation]:
+    """Builder for an experiment script like the milestones. The parameters
+    replace the values of the script's top-level assignments of the same
+    name, the result is the script's `instantiations[index]`."""
+    source = pathlib.Path(path).read_text()
+
+    def build(params: dict[str, tp.Any]) -> instantiation.Instantiation:
+        tree = ast.parse(source, path)
+        missing = set(params)
+        for node in tree.body:
+            if (
+                isinstance(node, ast.Assign)
+                and len(node.targets) == 1
+                and isinstance(node.targets[0], ast.Name)
+                and node.targets[0].id in params
+            ):
+                node.value = ast.Constant(params[node.targets[0].id])
+                missing.discard(node.targets[0].id)
+        if missing:
+            raise Exception(f"{path} does not assign {', '.join(sorted(missing))}")
+        module = {"__name__": "sweep_point", "__file__": path}
+        exec(compile(ast.fix_missing_locations(tree), path, "exec"), module)
+        return module["instantiations"][index]
+
+    return build
+
+
+class Sweep:
+    """Runs the instantiations that `build` creates for each point. With a
+    `store`, the samples of completed runs are added to it, indexed by the
+    point and `results.describe()` of the instantiation."""
+
+    def __init__(
+        self,
+        build: tp.Callable[[dict[str, tp.Any]], instantiation.Instantiation],
+        backend: Backend,
+        max_parallel: int = 4,
+        cache: ResultCache | None = None,
+        salt: str = "",
+        store: result_store.ResultStore | None = None,
+    ) -> None:
+        self.build = build
+        self.backend = backend
+        self.max_parallel = max_parallel
+        self.cache = cache if cache is not None else ResultCache()
+        self.salt = salt
+        self.store = store
+
+    async def run(self, points: list[dict[str, tp.Any]]) -> list[RunResult]:
+        """Results in the order of `points`. Points with the same
+        configuration share one run."""
+        semaphore = asyncio.Semaphore(self.max_parallel)
+        pending: dict[str, asyncio.Task] = {}
+
+        async def execute(
+            key: str, inst: instantiation.Instantiation, params: dict[str, tp.Any]
+        ) -> RunResult:
+            # a failing point must not abort the others, like a failing
+            # handler of LocalBackend
+            try:
+                async with semaphore:
+                    run_id, state, output = await self.backend.run(inst)
+            except Exception as e:
+                run_id, state, output = None, "error", [
+                    ("sweep", f"{type(e).__name__}: {e}")
+                ]
+            result = RunResult(key, params, run_id, state, output)
+            self.cache.put(result)
+            return result
+
+        salt = self.salt
+        backend_salt = self.backend.cache_salt()
+        if backend_salt:
+            salt += f"\0{backend_salt}"
+        tasks = []
+        described = []
+        results = []
+        try:
+            for params in points:
+                inst = self.build(params)
+                key = instantiation_key(inst, salt)
+                if self.store is not None:
+                    described.append(result_store.describe(inst))
+                cached = self.cache.get(key)
+                if cached is not None:
+                    cached.params = params
+                    tasks.append(cached)
+                    continue
+                if key not in pending:
+                    pending[key] = asyncio.create_task(execute(key, inst, params))
+                tasks.append(pending[key])
+
+            for params, task in zip(points, tasks):
+                if isinstance(task, RunResult):
+                    results.append(task)
+                    continue
+                result = await task
+                if result.params is not params:
+                    shared = RunResult(
+                        result.key, params, result.run_id, result.state, result.output
+                    )
+                    shared.cached = True
+                    result = shared
+                results.append(result)
+        finally:
+            # only left early on an error or cancellation, the runs that
+            # were started are then no longer awaited
+            outstanding = [t for t in pending.values() if not t.done()]
+            for t in outstanding:
+                t.cancel()
+            await asyncio.gather(*outstanding, return_exceptions=True)
+
+        if self.store is not None:
+            for result, description in zip(results, described):
+                if result.completed and not self.store.has(result.key):
+                    self.store.add(
+                        result.run_id, {**description, **result.params},
+                        result.output, result.key,
+                    )
+        return results
+
+
+def _parse_axis(spec: str) -> tuple[str, list[tp.Any]]:
+    name, _, values = spec.partition("=")
+    if not values:
+        raise argparse.ArgumentTypeError(f"expected NAME=V1,V2,..., got {spec}")
+
+    def parse(value: str) -> tp.Any:
+        try:
+            return json.loads(value)
+        except json.JSONDecodeError:
+            return value
+
+    return name, [parse(v) for v in values.split(",")]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("script", help="experiment script to sweep")
+    parser.add_argument(
+        "-p", "--param", type=_parse_axis, action="append", default=[],
+        help="parameter values as NAME=V1,V2,...",
+    )
+    parser.add_argument("--parallel", type=int, default=4, help="concurrent runs")
+    parser.add_argument(
+        "--cache",
+        help=f"result cache (default {DEFAULT_CACHE}, with --local {LOCAL_CACHE})",
+    )
+    parser.add_argument("--salt", default="", help="invalidate earlier results")
+    parser.add_argument(
+        "--store", nargs="?", const=result_store.DEFAULT_STORE,
+        help=f"add samples to a result store (default {result_store.DEFAULT_STORE})",
+    )
+    parser.add_argument(
+        "--local", action="store_true", help="use the local stand-in backend"
+    )
+    args = parser.parse_args()
+
+    backend = LocalBackend() if args.local else OpusBackend()
+    cache = args.cache or (LOCAL_CACHE if args.local else DEFAULT_CACHE)
+    sweep = Sweep(
+        script_builder(args.script), backend, args.parallel,
+        ResultCache(cache), args.salt,
+        result_store.ResultStore(args.store) if args.store else None,
+    )
+    results = asyncio.run(sweep.run(grid(**dict(args.param))))
+    for result in results:
+        source = "cached" if result.cached else f"run {result.run_id}"
+        print(f"{json.dumps(result.params)}: {result.state} ({source}, {result.key[:12]})")
+    return 0 if all(r.completed for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
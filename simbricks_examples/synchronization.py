@@ -0,0 +1,61 @@
+# Copyright 2021 Max Planck Institute for Software Systems, and
+# National University of Singapore
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Synchronization with a sync period per channel.
+
+`Simulation.enable_synchronization()` gives every channel the same sync
+period, which has to fit the channel with the lowest latency. Channels with a
+higher latency, e.g. a 5 ms link between two switches, then exchange sync
+messages far more often than needed. A channel is only required to carry a
+message at least once per latency, so `enable()` sets the sync period of each
+channel to its own latency instead.
+
+Simulators that support one sync period per interface, like ns-3 and the
+Corundum adapter, use these periods as given. Others use the smallest period
+of their channels, which is still safe.
+
+Example:
+
+    synchronization.enable(sim)
+"""
+
+from __future__ import annotations
+
+from simbricks.orchestration import simulation
+from simbricks.utils import base as utils_base
+
+
+def enable(
+    sim: simulation.Simulation,
+    max_amount: int | None = None,
+    ratio: utils_base.Time = utils_base.Time.Nanoseconds,
+) -> None:
+    """Synchronize all channels of `sim` with the largest sync period their
+    latency allows, at most `max_amount` times `ratio` if given."""
+    for chan in sim.get_all_channels():
+        chan._synchronized = True
+        period = chan.sys_channel.latency
+        if max_amount is not None:
+            period = min(period, max_amount * ratio)
+        chan.set_sync_period(amount=period, ratio=utils_base.Time.Nanoseconds)
+
@@ -0,0 +1,352 @@
+# Copyright 2021 Max Planck Institute for Software Systems, and
+# National University of Singapore
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Builders for larger Ethernet topologies.
+
+A `Topology` wraps the `system.EthSwitch`es of a network and hands out unique
+IPv4 addresses to the endpoints attached to it. Endpoints behind the same edge
+switch get their addresses from the same block of the address space, e.g. a
+/24. Building the topology and attaching endpoints takes constant time per
+switch, link and endpoint, so topologies with thousands of endpoints are
+built in linear time.
+
+Example:
+
+    topo = topology.dumbbell(syst, latency=5, ratio=utils_base.Time.Milliseconds,
+                             data_rate="200Mbps")
+    client_ip = topo.attach_nic(nic0, topo.switches["left"])
+    server_ip = topo.attach_nic(nic1, topo.switches["right"])
+    topo.add_to(net_inst)
+"""
+
+from __future__ import annotations
+
+import ipaddress
+import typing as tp
+
+from simbricks.orchestration import system
+from simbricks.utils import base as utils_base
+
+
+class AddressAllocator:
+    """Unique IPv4 addresses from `network`, carved into blocks with prefix
+    length `block_prefixlen`. Each key, e.g. an edge switch, allocates from its
+    own block and gets a new one once that is used up."""
+
+    def __init__(
+        self, network: str = "10.0.0.0/8", block_prefixlen: int = 24
+    ) -> None:
+        self.network = ipaddress.IPv4Network(network)
+        if not self.network.prefixlen <= block_prefixlen <= 32:
+            raise Exception(
+                f"block prefix length {block_prefixlen} does not fit into {network}"
+            )
+        self.block_prefixlen = block_prefixlen
+        self._block_size = 1 << (32 - block_prefixlen)
+        self._next_block = int(self.network.network_address)
+        self._end = int(self.network.broadcast_address) + 1
+        # key -> [next address, end of block]
+        self._blocks: dict[tp.Hashable, list[int]] = {}
+
+    def _new_block(self) -> list[int]:
+        start = self._next_block
+        if start >= self._end:
+            raise Exception(f"address space {self.network} exhausted")
+        self._next_block += self._block_size
+        end = start + self._block_size
+        # skip the network and broadcast address of each block
+        if self._block_size >= 4:
+            return [start + 1, end - 1]
+        return [start, end]
+
+    def allocate(self, key: tp.Hashable = None) -> str:
+        block = self._blocks.get(key)
+        if block is None or block[0] >= block[1]:
+            block = self._new_block()
+            self._blocks[key] = block
+        address = block[0]
+        block[0] += 1
+        return str(ipaddress.IPv4Address(address))
+
+    def cidr(self, address: str) -> str:
+        """Address with the prefix length of the whole network."""
+        return f"{address}/{self.network.prefixlen}"
+
+
+class Topology:
+    """Switches and links of an Ethernet network and the endpoints attached
+    to its edge switches.
+
+    SimBricks' network simulators bridge frames without loop prevention. With
+    `spanning_tree` (the default), `link()` therefore drops links that would
+    close a loop, so multi-path topologies only keep a spanning tree of their
+    links."""
+
+    def __init__(
+        self,
+        syst: system.System,
+        addresses: AddressAllocator | None = None,
+        spanning_tree: bool = True,
+    ) -> None:
+        self.system = syst
+        self.addresses = addresses or AddressAllocator()
+        self.spanning_tree = spanning_tree
+        self.switches: dict[str, system.EthSwitch] = {}
+        self.edge_switches: list[system.EthSwitch] = []
+        self.links: list[system.EthChannel] = []
+        self.border_links: list[system.EthChannel] = []
+        self._parent: dict[int, int] = {}
+        self._next_edge = 0
+        self._routed_hosts: set[int] = set()
+
+    def add_switch(self, name: str, edge: bool = False) -> system.EthSwitch:
+        if name in self.switches:
+            raise Exception(f"switch {name} already exists")
+        switch = system.EthSwitch(self.system)
+        switch.name = name
+        self.switches[name] = switch
+        self._parent[switch.id()] = switch.id()
+        if edge:
+            self.edge_switches.append(switch)
+        return switch
+
+    def _root(self, ident: int) -> int:
+        while self._parent[ident] != ident:
+            self._parent[ident] = self._parent[self._parent[ident]]
+            ident = self._parent[ident]
+        return ident
+
+    @staticmethod
+    def _configure(
+        chan: system.EthChannel,
+        latency: int | None,
+        ratio: utils_base.Time,
+        data_rate: str | None,
+    ) -> None:
+        if latency is not None:
+            chan.set_latency(latency, ratio)
+        if data_rate is not None:
+            # NOTE: this is an NS3 specific parameter
+            chan.parameters["data_rate"] = data_rate
+
+    def link(
+        self,
+        a: system.EthSwitch,
+        b: system.EthSwitch,
+        latency: int | None = None,
+        ratio: utils_base.Time = utils_base.Time.Nanoseconds,
+        data_rate: str | None = None,
+        border: bool = False,
+    ) -> system.EthChannel | None:
+        """Connect two switches. Returns None if the link was dropped to keep
+        the topology loop free.
+
+        With `border`, the link gets a border switch at each end, so that it
+        can be cut between two network simulators (see
+        `partition.split_net()`). The channel between the border switches has
+        the latency and is returned and recorded in `border_links`, the
+        channels to the border switches have the data rate. A cut link thus
+        keeps its rate limit, at the cost of one more transmission delay per
+        packet."""
+        root_a = self._root(a.id())
+        root_b = self._root(b.id())
+        if root_a == root_b and self.spanning_tree:
+            return None
+        if border:
+            name_a = a.name or str(a.id())
+            name_b = b.name or str(b.id())
+            border_a = self.add_switch(f"{name_a}-to-{name_b}")
+            border_b = self.add_switch(f"{name_b}-to-{name_a}")
+            self.link(a, border_a, 0, data_rate=data_rate)
+            self.link(border_b, b, 0, data_rate=data_rate)
+            chan = self.link(border_a, border_b, latency, ratio)
+            self.border_links.append(chan)
+            return chan
+        self._parent[root_a] = root_b
+
+        if_a = system.EthInterface(a)
+        a.add_if(if_a)
+        if_b = system.EthInterface(b)
+        b.add_if(if_b)
+        chan = system.EthChannel(if_a, if_b)
+        self._configure(chan, latency, ratio, data_rate)
+        self.links.append(chan)
+        return chan
+
+    def _edge_switch(self, switch: system.EthSwitch | None) -> system.EthSwitch:
+        if switch is not None:
+            return switch
+        if not self.edge_switches:
+            raise Exception("topology has no edge switches")
+        switch = self.edge_switches[self._next_edge]
+        self._next_edge = (self._next_edge + 1) % len(self.edge_switches)
+        return switch
+
+    def attach(
+        self,
+        interface: system.EthInterface,
+        switch: system.EthSwitch | None = None,
+        latency: int | None = None,
+        ratio: utils_base.Time = utils_base.Time.Nanoseconds,
+        data_rate: str | None = None,
+    ) -> str:
+        """Connect an endpoint interface to `switch`, or to the edge switches
+        in round robin order, and return a new address for it."""
+        switch = self._edge_switch(switch)
+        chan = switch.connect_eth_peer_if(interface)
+        self._configure(chan, latency, ratio, data_rate)
+        return self.addresses.allocate(switch.id())
+
+    def attach_nic(
+        self,
+        nic: system.EthSimpleNIC,
+        switch: system.EthSwitch | None = None,
+        **kwargs,
+    ) -> str:
+        """Attach a NIC and assign it its address. Connect the NIC to its host
+        before attaching it."""
+        address = self.attach(nic._eth_if, switch, **kwargs)
+        nic.add_ipv4(address)
+        self._add_route(nic)
+        return address
+
+    def _add_route(self, nic: system.EthSimpleNIC) -> None:
+        # LinuxHost configures NIC addresses as /24. Larger networks need an
+        # additional route so that the other blocks are reachable.
+        if self.addresses.network.prefixlen >= 24:
+            return
+        pci_if = getattr(nic, "_pci_if", None)
+        if pci_if is None or not pci_if.is_connected():
+            return
+        host = pci_if.get_opposing_interface().component
+        if not isinstance(host, system.LinuxHost) or host.id() in self._routed_hosts:
+            return
+        self._routed_hosts.add(host.id())
+
+        # same interface naming as LinuxHost.prepare_post_cp()
+        index = 0
+        for host_if in system.Interface.filter_by_type(
+            host.interfaces(), system.PCIeHostInterface
+        ):
+            if not host_if.is_connected():
+                continue
+            dev = host_if.get_opposing_interface().component
+            if dev is nic:
+                break
+            if isinstance(dev, (system.EthSimpleNIC, system.SimplePCIeNIC)):
+                index += 1
+        route = system.GenericRawCommandApplication(
+            host, [f"ip route add {self.addresses.network} dev eth{index}"]
+        )
+        host.applications.insert(0, route)
+
+    def attach_ns3_host(
+        self,
+        host: system.Host,
+        switch: system.EthSwitch | None = None,
+        **kwargs,
+    ) -> str:
+        """Give a host simulated by ns-3 an interface, attach it and set its
+        `ip` parameter."""
+        interface = system.EthInterface(host)
+        host.add_if(interface)
+        address = self.attach(interface, switch, **kwargs)
+        host.parameters["ip"] = self.addresses.cidr(address)
+        return address
+
+    def add_to(self, net_sim) -> None:
+        """Add all switches to a network simulator, e.g. `NS3Net`."""
+        for switch in self.switches.values():
+            net_sim.add(switch)
+
+
+def dumbbell(
+    syst: system.System,
+    latency: int | None = None,
+    ratio: utils_base.Time = utils_base.Time.Nanoseconds,
+    data_rate: str | None = None,
+    addresses: AddressAllocator | None = None,
+    border: bool = False,
+) -> Topology:
+    """Two edge switches `left` and `right`, connected by a bottleneck
+    link. With `border`, the bottleneck link can be cut between two network
+    simulators, see `Topology.link()`."""
+    topo = Topology(syst, addresses)
+    left = topo.add_switch("left", edge=True)
+    right = topo.add_switch("right", edge=True)
+    topo.link(left, right, latency, ratio, data_rate, border)
+    return topo
+
+
+def leaf_spine(
+    syst: system.System,
+    leaves: int,
+    spines: int,
+    latency: int | None = None,
+    ratio: utils_base.Time = utils_base.Time.Nanoseconds,
+    data_rate: str | None = None,
+    addresses: AddressAllocator | None = None,
+    spanning_tree: bool = True,
+) -> Topology:
+    """Edge switches `leaf<i>`, each connected to every `spine<j>`. Leaf i
+    links to spine i % spines first, so a spanning tree spreads the leaves
+    over the spines."""
+    topo = Topology(syst, addresses, spanning_tree)
+    spine_switches = [topo.add_switch(f"spine{j}") for j in range(spines)]
+    for i in range(leaves):
+        leaf = topo.add_switch(f"leaf{i}", edge=True)
+        for j in range(spines):
+            topo.link(
+                leaf, spine_switches[(i + j) % spines], latency, ratio, data_rate
+            )
+    return topo
+
+
+def fat_tree(
+    syst: system.System,
+    k: int,
+    latency: int | None = None,
+    ratio: utils_base.Time = utils_base.Time.Nanoseconds,
+    data_rate: str | None = None,
+    addresses: AddressAllocator | None = None,
+    spanning_tree: bool = True,
+) -> Topology:
+    """k-ary fat tree with k pods of k/2 edge switches `pod<p>-edge<e>` and
+    k/2 aggregation switches `pod<p>-agg<a>` each, and (k/2)^2 switches
+    `core<c>`. Fully populated, it connects k^3/4 endpoints."""
+    if k < 2 or k % 2:
+        raise Exception(f"fat tree arity must be even, got {k}")
+    half = k // 2
+    topo = Topology(syst, addresses, spanning_tree)
+    cores = [topo.add_switch(f"core{c}") for c in range(half * half)]
+    for p in range(k):
+        aggs = [topo.add_switch(f"pod{p}-agg{a}") for a in range(half)]
+        for a, agg in enumerate(aggs):
+            for c in range(half):
+                core = cores[a * half + (p + c) % half]
+                topo.link(agg, core, latency, ratio, data_rate)
+        for e in range(half):
+            edge = topo.add_switch(f"pod{p}-edge{e}", edge=True)
+            for a in range(half):
+                topo.link(edge, aggs[(e + a) % half], latency, ratio, data_rate)
+    return topo
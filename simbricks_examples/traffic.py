@@ -0,0 +1,328 @@
+# Copyright 2021 Max Planck Institute for Software Systems, and
+# National University of Singapore
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Background traffic for ns-3 that does not grow with the number of flows.
+
+Modelling every background flow as its own pair of `system.Host`s makes ns-3
+create a node, a device and a queue per flow endpoint. A `Workload` instead
+describes the background traffic between edge switches as a traffic matrix
+and realizes it on a single ns-3 host per switch:
+
+- `add_bulk()` adds long-running transfers. Each of them is a
+  `BulkSendApplication` on the host of the source switch.
+- `add()` adds short flows with a flow size distribution and an arrival
+  process. These are modelled by a fixed number of `OnOffApplication`s per
+  matrix entry. Each "on" period is a flow that sends a flow size drawn from
+  `flow_size` at `flow_rate`, each "off" period the time until the source's
+  next flow. The number of simulated flows therefore only changes the
+  parameters of the random variables, not the number of ns-3 objects. The
+  short flows use UDP by default: over TCP, an `OnOffApplication` keeps a
+  single connection open for all its on periods, so there is no handshake
+  or slow start per flow and an on period is not a flow of its own.
+
+Each host that is the destination of traffic runs one `PacketSink` for all
+flows towards it. The hosts and their applications are regular system
+components, so `NS3Net` simulates them without any changes.
+
+Example:
+
+    background = traffic.Workload(network)
+    background.add_bulk(switch_1, switch_2, flows=4)
+    background.add(
+        switch_1,
+        switch_2,
+        flow_size=traffic.Pareto.with_mean(100_000, shape=1.5),
+        arrivals=traffic.poisson(200),
+    )
+    background.add_to(net_inst)
+"""
+
+from __future__ import annotations
+
+import abc
+import math
+import re
+
+from simbricks.orchestration import system
+from simbricks_examples import topology
+
+_RATE = re.compile(r"^\s*([0-9.eE+-]+)\s*([kKMG]?)(i?)(b|B)ps\s*$")
+
+
+def rate_bps(rate: str) -> float:
+    """Bits per second of an ns-3 data rate string such as `200Mbps`."""
+    match = _RATE.match(rate)
+    if match is None:
+        raise Exception(f"cannot parse data rate {rate}")
+    value, prefix, binary, unit = match.groups()
+    base = 1024 if binary else 1000
+    value = float(value) * base ** " KMG".index(prefix.upper() or " ")
+    return value * 8 if unit == "B" else value
+
+
+class Distribution(abc.ABC):
+    """Random variable that ns-3 draws from, e.g. for the `OnTime` of an
+    `OnOffApplication`."""
+
+    type_id = ""
+
+    @abc.abstractmethod
+    def parameters(self) -> dict[str, float]:
+        pass
+
+    @abc.abstractmethod
+    def scaled(self, factor: float) -> Distribution:
+        """Distribution of the values multiplied by `factor`."""
+
+    def ns3_value(self) -> str:
+        params = "|".join(
+            f"{key}={float(value)}" for key, value in self.parameters().items()
+        )
+        return f"{self.type_id}[{params}]"
+
+
+class Constant(Distribution):
+    type_id = "ns3::ConstantRandomVariable"
+
+    def __init__(self, value: float) -> None:
+        self.value = value
+
+    def parameters(self) -> dict[str, float]:
+        return {"Constant": self.value}
+
+    def scaled(self, factor: float) -> Constant:
+        return Constant(self.value * factor)
+
+
+class Uniform(Distribution):
+    type_id = "ns3::UniformRandomVariable"
+
+    def __init__(self, low: float, high: float) -> None:
+        self.low = low
+        self.high = high
+
+    def parameters(self) -> dict[str, float]:
+        return {"Min": self.low, "Max": self.high}
+
+    def scaled(self, factor: float) -> Uniform:
+        return Uniform(self.low * factor, self.high * factor)
+
+
+class Exponential(Distribution):
+    type_id = "ns3::ExponentialRandomVariable"
+
+    def __init__(self, mean: float, bound: float = 0) -> None:
+        self.mean = mean
+        self.bound = bound
+
+    def parameters(self) -> dict[str, float]:
+        return {"Mean": self.mean, "Bound": self.bound}
+
+    def scaled(self, factor: float) -> Exponential:
+        return Exponential(self.mean * factor, self.bound * factor)
+
+
+class Pareto(Distribution):
+    """Pareto distribution with minimum `scale`, values above `bound` are
+    drawn again if `bound` is set."""
+
+    type_id = "ns3::ParetoRandomVariable"
+
+    def __init__(self, scale: float, shape: float, bound: float = 0) -> None:
+        self.scale = scale
+        self.shape = shape
+        self.bound = bound
+
+    @classmethod
+    def with_mean(cls, mean: float, shape: float, bound: float = 0) -> Pareto:
+        """Pareto distribution whose unbounded mean is `mean`."""
+        if shape <= 1:
+            raise Exception(f"Pareto distribution with shape {shape} has no mean")
+        return cls(mean * (shape - 1) / shape, shape, bound)
+
+    def parameters(self) -> dict[str, float]:
+        return {"Scale": self.scale, "Shape": self.shape, "Bound": self.bound}
+
+    def scaled(self, factor: float) -> Pareto:
+        return Pareto(self.scale * factor, self.shape, self.bound * factor)
+
+
+class LogNormal(Distribution):
+    type_id = "ns3::LogNormalRandomVariable"
+
+    def __init__(self, mu: float, sigma: float) -> None:
+        self.mu = mu
+        self.sigma = sigma
+
+    def parameters(self) -> dict[str, float]:
+        return {"Mu": self.mu, "Sigma": self.sigma}
+
+    def scaled(self, factor: float) -> LogNormal:
+        return LogNormal(self.mu + math.log(factor), self.sigma)
+
+
+def poisson(flows_per_second: float) -> Exponential:
+    """Inter-arrival times in seconds of flows that arrive as a Poisson
+    process."""
+    return Exponential(1 / flows_per_second)
+
+
+class Workload:
+    """Background traffic between the switches of `topo`, simulated by one
+    ns-3 host per switch that sends or receives traffic.
+
+    `flow_rate` is the rate at which a short flow sends, `packet_size` the size
+    of its packets. `start` and `stop` limit all traffic to a time window in
+    seconds. Long-running transfers use `protocol` and send as fast as it
+    allows, short flows choose their protocol in `add()`."""
+
+    def __init__(
+        self,
+        topo: topology.Topology,
+        flow_rate: str = "1Gbps",
+        packet_size: int = 1448,
+        protocol: str = "ns3::TcpSocketFactory",
+        port: int = 2000,
+        start: float | None = None,
+        stop: float | None = None,
+    ) -> None:
+        self.topology = topo
+        self.flow_rate = flow_rate
+        self.packet_size = packet_size
+        self.protocol = protocol
+        self.port = port
+        self.start = start
+        self.stop = stop
+        self._hosts: dict[int, system.Host] = {}
+        self._ips: dict[int, str] = {}
+        self._sinks: set[tuple[int, str]] = set()
+
+    def _host(self, switch: system.EthSwitch) -> system.Host:
+        host = self._hosts.get(switch.id())
+        if host is None:
+            host = system.Host(self.topology.system)
+            host.name = f"background-{switch.name}" if switch.name else "background"
+            self._ips[switch.id()] = self.topology.attach_ns3_host(host, switch)
+            self._hosts[switch.id()] = host
+        return host
+
+    def _app(
+        self,
+        host: system.Host,
+        type_id: str,
+        ns3_params: dict[str, str],
+        protocol: str | None = None,
+    ) -> system.Application:
+        app = system.Application(host)
+        app.parameters["type_id"] = type_id
+        app.parameters["ns3_params"] = {
+            "Protocol": protocol or self.protocol,
+            **ns3_params,
+        }
+        if self.start is not None:
+            app.parameters["start_time"] = f"{self.start}s"
+        if self.stop is not None:
+            app.parameters["stop_time"] = f"{self.stop}s"
+        host.add_app(app)
+        return app
+
+    def _remote(self, dst: system.EthSwitch, protocol: str | None = None) -> str:
+        host = self._host(dst)
+        protocol = protocol or self.protocol
+        if (dst.id(), protocol) not in self._sinks:
+            self._sinks.add((dst.id(), protocol))
+            self._app(
+                host,
+                "ns3::PacketSink",
+                {"Local(InetSocketAddress)": f"0.0.0.0:{self.port}"},
+                protocol,
+            )
+        return f"{self._ips[dst.id()]}:{self.port}"
+
+    def add_bulk(
+        self, src: system.EthSwitch, dst: system.EthSwitch, flows: int = 1
+    ) -> None:
+        """Add `flows` long-running transfers from `src` to `dst`."""
+        if flows <= 0:
+            return
+        remote = self._remote(dst)
+        host = self._host(src)
+        for _ in range(flows):
+            self._app(
+                host,
+                "ns3::BulkSendApplication",
+                {"Remote(InetSocketAddress)": remote, "SendSize": str(self.packet_size)},
+            )
+
+    def add(
+        self,
+        src: system.EthSwitch,
+        dst: system.EthSwitch,
+        flow_size: Distribution,
+        arrivals: Distribution,
+        sources: int = 8,
+        protocol: str = "ns3::UdpSocketFactory",
+    ) -> None:
+        """Add short flows from `src` to `dst` with sizes in bytes drawn from
+        `flow_size` and inter-arrival times in seconds drawn from `arrivals`.
+
+        The flows are spread over `sources` on-off sources, each of which
+        sends one flow at a time. A source waits for its share of the
+        inter-arrival times only after its previous flow, so `sources` should
+        be large enough that the sources are mostly idle, i.e. well above the
+        offered load divided by `flow_rate`.
+
+        The flows are sent over UDP at `flow_rate`. With
+        `ns3::TcpSocketFactory` as `protocol`, each source keeps one TCP
+        connection for all its flows. The on periods then only pace that
+        connection and do not go through connection setup or slow start, so
+        they do not behave like separate short TCP flows."""
+        if sources <= 0:
+            raise Exception(f"need at least one source, got {sources}")
+        remote = self._remote(dst, protocol)
+        host = self._host(src)
+        on_time = flow_size.scaled(8 / rate_bps(self.flow_rate))
+        off_time = arrivals.scaled(sources)
+        for _ in range(sources):
+            self._app(
+                host,
+                "ns3::OnOffApplication",
+                {
+                    "Remote(InetSocketAddress)": remote,
+                    "DataRate": self.flow_rate,
+                    "PacketSize": str(self.packet_size),
+                    "OnTime": on_time.ns3_value(),
+                    "OffTime": off_time.ns3_value(),
+                },
+                protocol,
+            )
+
+    def hosts(self) -> list[system.Host]:
+        return list(self._hosts.values())
+
+    def add_to(self, net_sim) -> None:
+        """Add the hosts of the workload to a network simulator, e.g.
+        `NS3Net`. It has to simulate their switches as well."""
+        for host in self._hosts.values():
+            net_sim.add(host)
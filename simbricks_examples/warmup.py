@@ -0,0 +1,170 @@
+# Copyright 2021 Max Planck Institute for Software Systems, and
+# National University of Singapore
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Fast-forwarding gem5 hosts through boot and setup.
+
+gem5 hosts support checkpoints. When the instantiation creates checkpoints,
+a first run boots the hosts on a fast CPU model (`cpu_type_cp`, KVM by
+default) and saves a checkpoint at `m5 checkpoint`. A second run restores the
+checkpoint on the detailed CPU model (`cpu_type`). By default
+`BaseLinuxHost.config_str()` takes the checkpoint right after boot, so loading
+drivers, configuring interfaces and starting applications still happens in
+detailed simulation.
+
+`fast_forward()` inserts a `WarmupMarker` into the application sequence of a
+host and moves the checkpoint there, e.g. right before `NetperfClient`.
+Everything up to the marker then runs on the fast CPU model. This requires a
+`WarmupGem5Sim` for the host and simulators that support checkpoints for all
+its PCIe devices, since the devices are set up by their drivers before the
+checkpoint. Otherwise the checkpoint stays right after boot. Before the
+checkpoint, the host runs the `checkpoint_commands()` of these simulators,
+e.g. to let the Corundum adapter save the NIC at the same point. `WarmupGem5Sim`
+also uses `AtomicSimpleCPU` instead of KVM on runners without `/dev/kvm`.
+
+Example:
+
+    marker = warmup.fast_forward(client, until=client_app)
+    host_inst = warmup.WarmupGem5Sim(sim)
+    host_inst.add(client)
+    ...
+    instance.create_checkpoint = True
+"""
+
+from __future__ import annotations
+
+import os
+
+import typing_extensions as tpe
+from simbricks.orchestration import simulation
+from simbricks.orchestration import system
+from simbricks.orchestration.instantiation import base as inst_base
+from simbricks.orchestration.simulation import base as sim_base
+from simbricks.orchestration.system import pcie as sys_pcie
+from simbricks.orchestration.system.host import app as sys_app
+from simbricks.utils import base as utils_base
+
+
+class WarmupMarker(sys_app.BaseLinuxApplication):
+    """End of the warm-up in the application sequence of a host. Simulators
+    supporting it switch to detailed simulation here."""
+
+    def run_cmds(self, inst: inst_base.Instantiation) -> list[str]:
+        sim = inst.find_sim_by_spec(spec=self.host)
+        if inst.create_checkpoint and isinstance(sim, WarmupGem5Sim):
+            if sim.marker_effective():
+                return sim.warmup_end_commands()
+        return []
+
+
+def fast_forward(
+    host: system.BaseLinuxHost,
+    until: sys_app.BaseLinuxApplication | None = None,
+) -> WarmupMarker:
+    """Ends the warm-up of `host` right before application `until`, or
+    after all its applications."""
+    marker = WarmupMarker(host)
+    if until is None:
+        host.applications.append(marker)
+    else:
+        host.applications.insert(host.applications.index(until), marker)
+    return marker
+
+
+class WarmupGem5Sim(simulation.Gem5Sim):
+    """gem5 that takes its checkpoint at the `WarmupMarker` of its host."""
+
+    def __init__(self, simulation: sim_base.Simulation):
+        super().__init__(simulation)
+        self.cpu_type_cp_fallback = "AtomicSimpleCPU"
+        """Fast CPU model to use instead of KVM if the runner lacks /dev/kvm."""
+
+    def _host(self) -> system.BaseLinuxHost | None:
+        hosts = self.filter_components_by_type(ty=system.BaseLinuxHost)
+        return hosts[0] if len(hosts) == 1 else None
+
+    def _device_sims(self) -> list[sim_base.Simulator]:
+        """Simulators of the PCIe devices of the host."""
+        host = self._host()
+        if host is None:
+            return []
+        sims = []
+        for intf in system.Interface.filter_by_type(
+            interfaces=host.interfaces(), ty=sys_pcie.PCIeHostInterface
+        ):
+            if not intf.is_connected():
+                continue
+            sim = self._simulation.find_sim(intf.get_opposing_interface().component)
+            if sim not in sims:
+                sims.append(sim)
+        return sims
+
+    def marker_effective(self) -> bool:
+        """Whether the host has a `WarmupMarker` and all simulators of its
+        PCIe devices support checkpoints."""
+        host = self._host()
+        if host is None:
+            return False
+        if not any(isinstance(a, WarmupMarker) for a in host.applications):
+            return False
+        return all(sim.supports_checkpointing() for sim in self._device_sims())
+
+    def _host_checkpoint_commands(self) -> list[str]:
+        # Device simulators that save their own checkpoints need the host to
+        # ask them right before its checkpoint, so that both line up.
+        cmds = []
+        for sim in self._device_sims():
+            if sim.supports_checkpointing():
+                cmds += sim.checkpoint_commands()
+        return cmds + super().checkpoint_commands()
+
+    def checkpoint_commands(self) -> list[str]:
+        # with an effective marker, the checkpoint is taken there instead
+        if self.marker_effective():
+            return []
+        return self._host_checkpoint_commands()
+
+    def warmup_end_commands(self) -> list[str]:
+        return self._host_checkpoint_commands()
+
+    def run_cmd(self, inst: inst_base.Instantiation) -> str:
+        # evaluated on the runner that executes the simulator
+        cpu_type_cp = self.cpu_type_cp
+        if "Kvm" in cpu_type_cp and not os.path.exists("/dev/kvm"):
+            self.cpu_type_cp = self.cpu_type_cp_fallback
+        try:
+            return super().run_cmd(inst)
+        finally:
+            self.cpu_type_cp = cpu_type_cp
+
+    def toJSON(self) -> dict:
+        json_obj = super().toJSON()
+        json_obj["cpu_type_cp_fallback"] = self.cpu_type_cp_fallback
+        return json_obj
+
+    @classmethod
+    def fromJSON(cls, simulation: sim_base.Simulation, json_obj: dict) -> tpe.Self:
+        instance = super().fromJSON(simulation, json_obj)
+        instance.cpu_type_cp_fallback = utils_base.get_json_attr_top(
+            json_obj, "cpu_type_cp_fallback"
+        )
+        return instance